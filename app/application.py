@@ -2,22 +2,89 @@
 """
 
 
-import client as oaic
+import threading
 import base
 import mainform
+import remote
+import snapshot
+import worker
+from constants import SNAPSHOT_CHATS
 from labels import Lang
 
 
 class App(base.AppBase):
   """The main application class
+
+  The client is built on a background thread while the main form is drawn
+  from the snapshot of the last session. It is attached to the form as soon
+  as it is ready, or when it is used before. If the daemon is running, the
+  app connects to it instead of building a client.
   """
-  client:base.ClientBase
   form:base.MainFormBase
+  snapshot:snapshot.Snapshot
+  keypress_timeout_default = 1 # poll background requests every 100ms
 
-  def __init__(self, client:oaic.Client) -> None:
+  def __init__(self, client:base.ClientBase=None) -> None:
     super().__init__()
-    self.client = client
     self.form = None
+    self.snapshot = snapshot.load() if client is None else snapshot.Snapshot()
+    self._client:base.ClientBase = None
+    self._built:base.ClientBase = client
+    self._error:Exception = None
+    self._requests:worker.RequestPool = None
+    self._loader = threading.Thread(target=self._build_client, name="startup", daemon=True)
+    if client is None:
+      self._loader.start()
+
+  @property
+  def client(self) -> base.ClientBase:
+    """The client, waits until it is built
+
+    Raises:
+        Exception: The error that was raised while the client was built
+    """
+    if self._client is None:
+      if self._loader.is_alive():
+        self._loader.join()
+      if self._error is not None:
+        raise self._error
+      self._client = self._built
+      self._client.max_yx = self.get_chat_max_yx
+      if isinstance(self._client, remote.RemoteClient):
+        self._requests = self._client.requests
+      else:
+        self._requests = worker.RequestPool(self._client)
+      if self.form is not None and not self.form.attached:
+        self.form.attach()
+    return self._client
+
+  @property
+  def requests(self) -> worker.RequestPool:
+    """The pool that sends the prompts, waits until the client is built
+    """
+    self.client
+    return self._requests
+
+  def client_ready(self) -> bool:
+    """Check if the client can be used without waiting
+
+    Returns:
+        bool: True if the client was built or building it failed
+    """
+    return self._client is not None or not self._loader.is_alive()
+
+  def _build_client(self) -> None:
+    """Connect to the daemon or import the OpenAI SDK and load the conversations on the startup thread
+    """
+    try:
+      channel = remote.connect()
+      if channel is not None:
+        self._built = remote.RemoteClient(channel)
+        return
+      import client as oaic
+      self._built = oaic.Client()
+    except Exception as e:
+      self._error = e
 
   def onStart(self) -> None:
     """Start the application
@@ -25,6 +92,28 @@ class App(base.AppBase):
     #npyscreen.setTheme(npyscreen.Themes.ColorfulTheme)
     self.form = self.addForm("MAIN", mainform.MainForm, name=Lang.cur.app_title)
 
+  def close(self) -> None:
+    """Stop the requests, close the client and write the snapshot for the next start
+
+    Requests that are still running are cancelled and save the answers they
+    got so far, the requests of the daemon keep running. Closing the client
+    waits for the background renames and writes the queued saves and the
+    search index.
+    """
+    if self._requests is None:
+      return
+    self._requests.shutdown(wait=True)
+    self._client.close()
+    if self.form is None:
+      return
+    self.snapshot = snapshot.Snapshot(
+      self._client.recency.page(0, SNAPSHOT_CHATS),
+      self._client.current_conversation,
+      self._client.max_yx()[1],
+      list(self.form.chat.values)
+    )
+    snapshot.save(self.snapshot)
+
   def get_chat_max_yx(self) -> tuple[int, int]:
     """Get the maximum x value for the chat view
 
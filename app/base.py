@@ -4,13 +4,24 @@
 
 from typing import Callable
 import npyscreen
-from openai import OpenAI
+import search
+import storage
+import recency
+import telemetry
 
 
-class ClientBase(OpenAI):
+class ClientBase:
   """Base Class
+
+  Does not derive from the OpenAI client, so the user interface can be
+  imported without the OpenAI SDK.
   """
   max_yx:Callable[[], tuple[int, int]]
+  storage:storage.Storage
+  search_index:search.SearchIndex
+  recency:recency.RecencyIndex
+  telemetry:telemetry.MetricsLog
+  models:list[str]
 
 
 class MainFormBase(npyscreen.FormBaseNew):
@@ -0,0 +1,161 @@
+"""Sends prompts from a JSON lines file without the user interface
+
+Every input line is a JSON object with the prompt and the key of the
+conversation to continue, a missing key starts a new conversation that is
+named like in the app:
+
+  {"conversation": "PythonTips", "prompt": "How do I sort a dict?"}
+  {"prompt": "Write a haiku about rain", "id": 7}
+
+Prompts of the same conversation are sent one after another, different
+conversations are sent in parallel. Every answer is saved to the storage
+and written to the output as one JSON line as soon as it arrived:
+
+  {"line": 2, "conversation": "WriteAHaikuAboutRain", "role": "system", "content": "...", "id": 7}
+
+A conversation that is named after its first answer is reported with a
+{"renamed": old_key, "conversation": new_key} line.
+"""
+
+
+import json
+import threading
+from typing import Iterable, TextIO
+from concurrent.futures import ThreadPoolExecutor
+from constants import MAX_REQUESTS_PER_MODEL
+import conversation
+import base
+
+
+class BatchRequest:
+  """A prompt read from the input
+  """
+  line:int
+  conv_key:str
+  prompt:str
+  request_id:object
+
+  def __init__(self, line:int, conv_key:str, prompt:str, request_id:object=None) -> None:
+    self.line = line
+    self.conv_key = conv_key
+    self.prompt = prompt
+    self.request_id = request_id
+
+
+def parse(line_number:int, line:str) -> BatchRequest:
+  """Read a request from an input line
+
+  Args:
+      line_number (int): The number of the line, starting at 1
+      line (str): The JSON object
+
+  Raises:
+      ValueError: If the line is no JSON object with a prompt
+
+  Returns:
+      BatchRequest: The request
+  """
+  data = json.loads(line)
+  if not isinstance(data, dict):
+    raise ValueError("expected a JSON object")
+  prompt = data.get("prompt")
+  if not isinstance(prompt, str) or len(prompt.strip()) <= 0:
+    raise ValueError("missing prompt")
+  conv_key = data.get("conversation")
+  if conv_key is not None and (not isinstance(conv_key, str) or len(conv_key) <= 0):
+    raise ValueError("conversation must be a non empty string")
+  return BatchRequest(line_number, conv_key, prompt, data.get("id"))
+
+
+class BatchRunner:
+  """Runs the requests of a batch on a pool of worker threads
+  """
+  client:base.ClientBase
+  output:TextIO
+  workers:int
+  errors:int
+
+  def __init__(self, client:base.ClientBase, output:TextIO, workers:int=MAX_REQUESTS_PER_MODEL) -> None:
+    self.client = client
+    self.output = output
+    self.workers = max(workers, 1)
+    self.errors = 0
+    self._lock = threading.Lock()
+
+  def run(self, lines:Iterable[str]) -> int:
+    """Send the prompts of all input lines and wait for the answers
+
+    The client is closed at the end, after the new conversations got their names.
+
+    Args:
+        lines (Iterable[str]): The JSON lines
+
+    Returns:
+        int: The number of lines that failed
+    """
+    groups:dict[str, list[BatchRequest]] = {}
+    for number, line in enumerate(lines, 1):
+      if len(line.strip()) <= 0:
+        continue
+      try:
+        request = parse(number, line)
+      except ValueError as e:
+        self._write({"line": number, "error": str(e)}, failed=True)
+        continue
+      if request.conv_key is None:
+        # new conversations get their provisional names here, not on the workers
+        request.conv_key = self.client.new_conversation(request.prompt)
+      groups.setdefault(request.conv_key, []).append(request)
+    self.client.rename_callbacks.append(self._renamed)
+    try:
+      with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as executor:
+        for requests in groups.values():
+          executor.submit(self._run, requests)
+    finally:
+      self.client.close()
+      self.client.rename_callbacks.remove(self._renamed)
+    return self.errors
+
+  def _run(self, requests:list[BatchRequest]) -> None:
+    """Send the prompts of one conversation in order
+
+    Args:
+        requests (list[BatchRequest]): The requests of the conversation
+    """
+    conv_key = requests[0].conv_key
+    if conv_key not in self.client.conversations:
+      self.client.conversations[conv_key] = conversation.Conversation(conv_key, self.client)
+    # follow the conversation object, it may be renamed between two prompts
+    conv = self.client.conversations[conv_key]
+    for request in requests:
+      try:
+        conv_key = self.client.send(conv.name, request.prompt)
+        message = conv.messages[-1]
+        result = {"line": request.line, "conversation": conv_key, "role": message["role"], "content": message["content"]}
+      except Exception as e:
+        result = {"line": request.line, "conversation": conv.name, "error": str(e)}
+      if request.request_id is not None:
+        result["id"] = request.request_id
+      self._write(result, failed="error" in result or result["role"] == "error")
+
+  def _renamed(self, old_key:str, new_key:str) -> None:
+    """Report a conversation that got its name
+
+    Args:
+        old_key (str): The provisional conversation key
+        new_key (str): The new conversation key
+    """
+    self._write({"renamed": old_key, "conversation": new_key})
+
+  def _write(self, result:dict, failed:bool=False) -> None:
+    """Write a line to the output
+
+    Args:
+        result (dict): The JSON object
+        failed (bool, optional): Count the line as failed. Defaults to False.
+    """
+    with self._lock:
+      if failed:
+        self.errors += 1
+      self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+      self.output.flush()
@@ -0,0 +1,319 @@
+"""An on-disk cache for chat model responses
+
+Responses are stored under a hash of the model, the normalized messages and
+the request parameters. Identical requests that run at the same time share
+one upstream call, the followers replay the deltas of the first request.
+A follower stops waiting when its own request is cancelled or runs past
+its deadline.
+"""
+
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Callable, Iterator
+from constants import CACHE_FOLDER_NAME, CACHE_MAX_SIZE, CACHE_TTL, CACHE_MODE_ENV
+from cancel import CancelToken
+import functions
+
+
+MODE_OFF = "off"
+MODE_ON = "on"
+MODE_ONLY = "only"
+
+
+class CacheMissError(Exception):
+  """Raised in cache only mode when a response is not cached
+  """
+
+
+class _InFlight:
+  """The deltas of a running request that other requests wait for
+  """
+
+  def __init__(self) -> None:
+    self.chunks:list[str] = []
+    self.finished = False
+    self.error:BaseException = None
+    self.condition = threading.Condition()
+
+  def add(self, delta:str) -> None:
+    """Publish a delta
+
+    Args:
+        delta (str): The content delta
+    """
+    with self.condition:
+      self.chunks.append(delta)
+      self.condition.notify_all()
+
+  def finish(self, error:BaseException=None) -> None:
+    """Mark the request as finished
+
+    Args:
+        error (BaseException, optional): The error the request failed with. Defaults to None.
+    """
+    with self.condition:
+      self.finished = True
+      self.error = error
+      self.condition.notify_all()
+
+  def follow(self, cancel:CancelToken=None) -> Iterator[str]:
+    """Replay the deltas of the request as they arrive
+
+    Args:
+        cancel (CancelToken, optional): Stops waiting for the request. Defaults to None.
+
+    Raises:
+        Cancelled: The token was cancelled or its deadline has passed
+
+    Yields:
+        str: The content deltas
+    """
+    if cancel is not None:
+      cancel.on_cancel(self._wake)
+    position = 0
+    while True:
+      with self.condition:
+        while position >= len(self.chunks) and not self.finished and not (cancel is not None and cancel.cancelled):
+          self.condition.wait()
+        chunks = self.chunks[position:]
+        finished = self.finished
+        error = self.error
+      position += len(chunks)
+      yield from chunks
+      if finished and position >= len(self.chunks):
+        if isinstance(error, Exception):
+          raise error
+        if error is not None:
+          raise RuntimeError("The shared request was aborted.")
+        return
+      if cancel is not None:
+        cancel.check()
+
+  def _wake(self) -> None:
+    """Wake up the followers, e.g. because one of them was cancelled
+    """
+    with self.condition:
+      self.condition.notify_all()
+
+
+def normalize_messages(messages:list[dict[str,str]]) -> list[dict[str,str]]:
+  """Normalize messages so that insignificant differences share a cache entry
+
+  Args:
+      messages (list[dict[str,str]]): The messages
+
+  Returns:
+      list[dict[str,str]]: The messages with stripped content and unix line endings
+  """
+  return [
+    {"role": message["role"], "content": message["content"].replace("\r\n", "\n").strip()}
+    for message in messages
+  ]
+
+
+class ResponseCache:
+  """A content addressed response cache with LRU eviction and expiry
+  """
+  folder:str
+  mode:str
+  max_size:int
+  ttl:float
+
+  def __init__(self, folder:str="", mode:str=None, max_size:int=CACHE_MAX_SIZE, ttl:float=CACHE_TTL) -> None:
+    if len(folder) <= 0:
+      folder = functions.get_config_path(CACHE_FOLDER_NAME)
+    if mode is None:
+      mode = os.environ.get(CACHE_MODE_ENV, MODE_OFF)
+    self.folder = folder
+    self.mode = mode
+    self.max_size = max_size
+    self.ttl = ttl
+    self._size:int = None
+    self._lock = threading.Lock()
+    self._in_flight:dict[str, _InFlight] = {}
+
+  def key(self, model:str, messages:list[dict[str,str]], params:dict) -> str:
+    """Hash a request
+
+    Args:
+        model (str): The model name
+        messages (list[dict[str,str]]): The messages
+        params (dict): Other request parameters
+
+    Returns:
+        str: The cache key
+    """
+    data = json.dumps({
+      "model": model,
+      "messages": normalize_messages(messages),
+      "params": params,
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+  def path(self, key:str) -> str:
+    """Get the file path of a cache entry
+
+    Args:
+        key (str): The cache key
+
+    Returns:
+        str: The path to the entry
+    """
+    return os.path.join(self.folder, key[:2], key + ".json")
+
+  def get(self, key:str) -> str:
+    """Read a cached response
+
+    Args:
+        key (str): The cache key
+
+    Returns:
+        str: The response content or None if it is not cached, expired or damaged
+    """
+    path = self.path(key)
+    try:
+      with open(path, "r", encoding='utf-8') as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(entry, dict) or not isinstance(entry.get("created"), (int, float)) or not isinstance(entry.get("content"), str):
+      return None
+    if time.time() - entry["created"] > self.ttl:
+      self._remove(path)
+      return None
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+    return entry["content"]
+
+  def put(self, key:str, content:str) -> None:
+    """Store a response and evict old entries if the cache is too big
+
+    Args:
+        key (str): The cache key
+        content (str): The response content
+    """
+    path = self.path(key)
+    functions.create_folder(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+      json.dump({"created": time.time(), "content": content}, f)
+    os.replace(tmp_path, path)
+    with self._lock:
+      if self._size is None:
+        self._size = self._scan_size()
+      else:
+        self._size += os.path.getsize(path)
+      if self._size > self.max_size:
+        self._evict()
+
+  def stream(self, model:str, messages:list[dict[str,str]], params:dict, request:Callable[[], Iterator[str]],
+             cancel:CancelToken=None) -> Iterator[str]:
+    """Stream a response from the cache, a running identical request or upstream
+
+    Args:
+        model (str): The model name
+        messages (list[dict[str,str]]): The messages
+        params (dict): Other request parameters
+        request (Callable[[], Iterator[str]]): Starts the upstream request
+        cancel (CancelToken, optional): Stops waiting for a running identical request,
+          the upstream request is stopped by its own token. Defaults to None.
+
+    Raises:
+        CacheMissError: In cache only mode if the response is not cached
+        Cancelled: The token was cancelled while the request followed another one
+
+    Yields:
+        str: The content deltas
+    """
+    if self.mode == MODE_OFF:
+      yield from request()
+      return
+    key = self.key(model, messages, params)
+    content = self.get(key)
+    if content is not None:
+      yield content
+      return
+    if self.mode == MODE_ONLY:
+      raise CacheMissError("The response is not cached and the cache only mode is on.")
+    with self._lock:
+      flight = self._in_flight.get(key)
+      leader = flight is None
+      if leader:
+        flight = _InFlight()
+        self._in_flight[key] = flight
+    if not leader:
+      yield from flight.follow(cancel)
+      return
+    try:
+      for delta in request():
+        flight.add(delta)
+        yield delta
+    except BaseException as e:
+      flight.finish(e)
+      with self._lock:
+        self._in_flight.pop(key, None)
+      raise
+    flight.finish()
+    try:
+      self.put(key, "".join(flight.chunks))
+    except OSError:
+      # the answer was received, it is only not cached
+      pass
+    finally:
+      with self._lock:
+        self._in_flight.pop(key, None)
+
+  def _entries(self) -> list[tuple[float, int, str]]:
+    """List the cache files
+
+    Returns:
+        list[tuple[float, int, str]]: The last use time, size and path of every entry
+    """
+    entries:list[tuple[float, int, str]] = []
+    if not os.path.exists(self.folder):
+      return entries
+    for folder in os.scandir(self.folder):
+      if not folder.is_dir():
+        continue
+      for file in os.scandir(folder.path):
+        if file.name.endswith(".json"):
+          stat = file.stat()
+          entries.append((stat.st_mtime, stat.st_size, file.path))
+    return entries
+
+  def _scan_size(self) -> int:
+    """Sum up the size of all cache files
+
+    Returns:
+        int: The size in bytes
+    """
+    return sum(size for _, size, _ in self._entries())
+
+  def _evict(self) -> None:
+    """Remove expired and least recently used entries until the cache is below 90% of its size
+    """
+    entries = sorted(self._entries())
+    self._size = sum(size for _, size, _ in entries)
+    now = time.time()
+    for used, size, path in entries:
+      if self._size <= self.max_size * 0.9 and now - used <= self.ttl:
+        continue
+      self._remove(path)
+      self._size -= size
+
+  def _remove(self, path:str) -> None:
+    """Remove a cache file
+
+    Args:
+        path (str): The path to the entry
+    """
+    try:
+      os.remove(path)
+    except OSError:
+      pass
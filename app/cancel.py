@@ -0,0 +1,145 @@
+"""Stopping running requests by hand or when their deadline has passed
+
+A CancelToken goes along with a request. Waiting for the rate limits and
+reading the stream check it and stop with Cancelled as soon as it is
+cancelled. Closing the open response is registered with the token, so a
+request that waits for the next chunk stops at once as well.
+"""
+
+
+import time
+import threading
+from typing import Callable
+
+
+CANCELLED = "cancelled"
+DEADLINE = "deadline"
+
+
+class Cancelled(Exception):
+  """Raised by a request that was stopped
+  """
+  reason:str
+
+  def __init__(self, reason:str) -> None:
+    super().__init__("The request was stopped" if reason == CANCELLED else "The request ran past its deadline")
+    self.reason = reason
+
+
+class CancelToken:
+  """Tells a request to stop, cancelled by the UI or by a deadline
+  """
+  reason:str
+  deadline:float
+
+  def __init__(self, timeout:float=None) -> None:
+    self.reason = None
+    self.deadline = None
+    self._event = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks:list[Callable[[], None]] = []
+    self._timer:threading.Timer = None
+    self.limit(timeout)
+
+  @property
+  def cancelled(self) -> bool:
+    """True if the request should stop
+    """
+    return self._event.is_set()
+
+  def limit(self, timeout:float) -> None:
+    """Let the request run for at most a number of seconds from now
+
+    An earlier deadline is kept.
+
+    Args:
+        timeout (float): The seconds or None for no deadline
+    """
+    if timeout is None:
+      return
+    deadline = time.monotonic() + max(timeout, 0)
+    with self._lock:
+      if self.deadline is not None and self.deadline <= deadline:
+        return
+      self.deadline = deadline
+      if self._timer is not None:
+        self._timer.cancel()
+      self._timer = threading.Timer(max(timeout, 0), self.cancel, [DEADLINE])
+      self._timer.daemon = True
+      self._timer.start()
+
+  def remaining(self) -> float:
+    """Get the seconds until the deadline
+
+    Returns:
+        float: The seconds, 0 if it has passed, None without a deadline
+    """
+    if self.deadline is None:
+      return None
+    return max(self.deadline - time.monotonic(), 0)
+
+  def cancel(self, reason:str=CANCELLED) -> bool:
+    """Stop the request and close its open response
+
+    Args:
+        reason (str, optional): CANCELLED or DEADLINE. Defaults to CANCELLED.
+
+    Returns:
+        bool: False if it was already cancelled
+    """
+    with self._lock:
+      if self._event.is_set():
+        return False
+      self.reason = reason
+      self._event.set()
+      callbacks = self._callbacks
+      self._callbacks = []
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception:
+        pass
+    return True
+
+  def on_cancel(self, callback:Callable[[], None]) -> None:
+    """Call a function when the request is cancelled, e.g. to close its response
+
+    Args:
+        callback (Callable[[], None]): The function, called right away if it is already cancelled
+    """
+    with self._lock:
+      if not self._event.is_set():
+        self._callbacks.append(callback)
+        return
+    callback()
+
+  def check(self) -> None:
+    """Stop the request if it was cancelled or its deadline has passed
+
+    Raises:
+        Cancelled: The request should stop
+    """
+    if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+      self.cancel(DEADLINE)
+    if self._event.is_set():
+      raise Cancelled(self.reason)
+
+  def sleep(self, seconds:float) -> None:
+    """Wait a number of seconds unless the request is cancelled before
+
+    Args:
+        seconds (float): The seconds
+
+    Raises:
+        Cancelled: The request was cancelled while it waited
+    """
+    self._event.wait(seconds)
+    self.check()
+
+  def finish(self) -> None:
+    """Stop the deadline timer of a request that is done
+    """
+    with self._lock:
+      if self._timer is not None:
+        self._timer.cancel()
+      self._callbacks = []
@@ -0,0 +1,208 @@
+"""An on-disk index of the saved conversations
+
+The catalog keeps the name, path, modification time, size and message count
+of every conversation file, so the chat list can be shown without reading
+the conversations themselves. The size of a cold journal is its size once
+it is decompressed.
+
+Saving a conversation only changes the entry in memory, the file is written
+CATALOG_SAVE_INTERVAL seconds later and when the catalog is closed. It is
+written next to the old one, synced and moved over it. A catalog that is
+older than the files after a crash is brought up to date by load.
+"""
+
+
+import os
+import json
+import lzma
+import threading
+from constants import CATALOG_FILE_NAME, CATALOG_SAVE_INTERVAL, LEGACY_FILE_EXTENSION, COLD_FILE_EXTENSION
+import functions
+import journal
+
+
+class CatalogEntry:
+  """The metadata of a saved conversation
+  """
+  name:str
+  path:str
+  mtime:float
+  size:int
+  message_count:int
+
+  def __init__(self, name:str, path:str, mtime:float, size:int, message_count:int) -> None:
+    self.name = name
+    self.path = path
+    self.mtime = mtime
+    self.size = size
+    self.message_count = message_count
+
+  def to_dict(self) -> dict:
+    """Convert the entry to a JSON serializable dict
+
+    Returns:
+        dict: The entry without its name
+    """
+    return {
+      "path": self.path,
+      "mtime": self.mtime,
+      "size": self.size,
+      "message_count": self.message_count,
+    }
+
+
+def count_messages(path:str) -> int:
+  """Count the messages in a conversation file
+
+  Args:
+      path (str): The path to a journal or legacy JSON file
+
+  Returns:
+      int: The number of messages
+  """
+  try:
+    if path.endswith(LEGACY_FILE_EXTENSION):
+      with open(path, "r", encoding='utf-8') as f:
+        return len(json.load(f))
+    messages, _, _ = journal.read(path)
+    return len(messages)
+  except (OSError, ValueError, EOFError, lzma.LZMAError):
+    return 0
+
+
+class Catalog:
+  """The index of all saved conversations
+  """
+  path:str
+  entries:dict[str, CatalogEntry]
+
+  def __init__(self, path:str="") -> None:
+    if len(path) <= 0:
+      path = functions.get_config_path(CATALOG_FILE_NAME)
+    self.path = path
+    self.entries = {}
+    self.lock = threading.Lock()
+    self._dirty = False
+    self._timer:threading.Timer = None
+    self._write_lock = threading.Lock()
+
+  def load(self) -> None:
+    """Load the catalog and bring it up to date with the conversation files
+
+    Only files that are new or changed since the catalog was written are read.
+    Cold journals do not change, the entries of known ones are used without
+    looking at the files.
+    """
+    stored:dict[str, dict] = {}
+    try:
+      with open(self.path, "r", encoding='utf-8') as f:
+        stored = json.load(f)
+    except (OSError, ValueError):
+      pass
+    changed = False
+    entries:dict[str, CatalogEntry] = {}
+    for name, path in functions.list_conversation_files().items():
+      data = stored.get(name)
+      if path.endswith(COLD_FILE_EXTENSION) and data is not None and data.get("path") == path:
+        entries[name] = CatalogEntry(name, path, data.get("mtime", 0), data.get("size", 0), data.get("message_count", 0))
+        continue
+      try:
+        stat = os.stat(path)
+        size = journal.size(path)
+      except (OSError, EOFError, lzma.LZMAError):
+        continue
+      if data is not None and data.get("path") == path and data.get("mtime") == stat.st_mtime and data.get("size") == size:
+        entries[name] = CatalogEntry(name, path, stat.st_mtime, size, data.get("message_count", 0))
+      else:
+        entries[name] = CatalogEntry(name, path, stat.st_mtime, size, count_messages(path))
+        changed = True
+    if len(entries) != len(stored):
+      changed = True
+    with self.lock:
+      self.entries = entries
+    if changed:
+      self.save()
+
+  def save(self) -> None:
+    """Write the catalog file now
+
+    The file is written next to the old one, synced and moved over it, so it
+    is never left half written.
+    """
+    with self._write_lock:
+      with self.lock:
+        self._dirty = False
+        data = json.dumps({name: entry.to_dict() for name, entry in self.entries.items()})
+      folder = os.path.dirname(self.path)
+      tmp_path = self.path + ".tmp"
+      functions.create_folder(folder)
+      with open(tmp_path, "w", encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self.path)
+      journal.sync_folder(folder)
+
+  def save_later(self) -> None:
+    """Write the catalog file CATALOG_SAVE_INTERVAL seconds from now
+
+    Changes until then are written together.
+    """
+    with self.lock:
+      self._dirty = True
+      if self._timer is not None:
+        return
+      self._timer = threading.Timer(CATALOG_SAVE_INTERVAL, self.flush)
+      self._timer.daemon = True
+      self._timer.start()
+
+  def flush(self) -> None:
+    """Write the catalog file if it changed since it was written
+    """
+    with self.lock:
+      self._timer = None
+      dirty = self._dirty
+    if dirty:
+      try:
+        self.save()
+      except OSError:
+        # load brings an old catalog up to date
+        pass
+
+  def close(self) -> None:
+    """Stop the timer and write the changes
+    """
+    with self.lock:
+      if self._timer is not None:
+        self._timer.cancel()
+    self.flush()
+
+  def update(self, name:str, path:str, message_count:int, size:int=None, save:bool=True) -> None:
+    """Update the entry of a conversation after it was saved
+
+    Args:
+        name (str): The conversation name
+        path (str): The path to the conversation file
+        message_count (int): The number of saved messages
+        size (int, optional): The size of the conversation. Defaults to the file size.
+        save (bool, optional): Write the catalog file later. Defaults to True.
+    """
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return
+    with self.lock:
+      self.entries[name] = CatalogEntry(name, path, stat.st_mtime, stat.st_size if size is None else size, message_count)
+    if save:
+      self.save_later()
+
+  def remove(self, name:str) -> None:
+    """Remove the entry of a deleted conversation
+
+    Args:
+        name (str): The conversation name
+    """
+    with self.lock:
+      if self.entries.pop(name, None) is None:
+        return
+    self.save_later()
@@ -2,89 +2,637 @@
 """
 
 
-from typing import Callable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+import os
+import threading
+import time
+from openai import OpenAI, NOT_GIVEN
+from constants import LOADED_CONVERSATIONS_BUDGET, NAMING_EXCHANGE_CHARS, FAN_OUT_MODELS_ENV, DEFAULT_FAN_OUT_MODELS, PARTIAL_SAVE_INTERVAL, REQUEST_DEADLINE
+from cancel import CancelToken, Cancelled
 import functions
+import cache
+from journal import PARTIAL_KEY
+import context
 import conversation
+import message as msg
+import scheduler
+import search
+import storage
+import recency
+import telemetry
+import saver
 import base
 
 
-class Client(base.ClientBase):
+PROVISIONAL_NAME_KEY = "provisional_name"
+DEADLINE_KEY = "deadline"
+NAMING_PROMPT = (
+  "Generate a name for this conversation. " +
+  "Max of 25 characters and UpperCamelCase! " +
+  "Your answer should only contain this name! " +
+  "No formatting not special characters!"
+)
+
+
+class Client(base.ClientBase, OpenAI):
   """A client for the OpenAI ChatGPT API
   """
   model:str
+  models:list[str]
+  naming_model:str
+  stream:bool
+  deadline:float
+  memory_budget:int
   conversations:dict[str, conversation.Conversation]
   current_conversation:str
+  storage:storage.Storage
+  search_index:search.SearchIndex
+  recency:recency.RecencyIndex
+  telemetry:telemetry.MetricsLog
+  saver:saver.Saver
+  context:context.ContextBuilder
+  cache:cache.ResponseCache
+  scheduler:scheduler.RequestScheduler
+  rename_callbacks:list[Callable[[str, str], None]]
 
   def __init__(self, *args, **kwargs) -> None:
+    # retries are done by the scheduler
+    kwargs.setdefault("max_retries", 0)
     super().__init__(*args, **kwargs)
     # https://platform.openai.com/docs/models/gpt-4-and-gpt-4-turbo
     #self.model = "gpt-3.5-turbo-0125"
     self.model = "gpt-4-turbo-preview"
+    self.naming_model = None # use self.model
+    self.models = [
+      model.strip() for model in os.environ.get(FAN_OUT_MODELS_ENV, ",".join(DEFAULT_FAN_OUT_MODELS)).split(",")
+      if len(model.strip()) > 0
+    ]
+    self.stream = True
+    self.deadline = REQUEST_DEADLINE
+    self.memory_budget = LOADED_CONVERSATIONS_BUDGET
     self.conversations:dict[str, conversation.Conversation] = {}
     self.current_conversation:str = None
     #self.conversations[self.current_conversation] = Conversation(self.current_conversation, self)
     #self.conversations["chat2"] = Conversation("chat2", self)
     self.max_yx:Callable[[], int] = lambda: 20, 80
-    conversation_list = functions.list_conversation_files()
-    for [key, path] in conversation_list.items():
+    self._loaded:OrderedDict[int, conversation.Conversation] = OrderedDict()
+    self._loaded_lock = threading.Lock()
+    self.context = context.ContextBuilder(self)
+    self.cache = cache.ResponseCache()
+    self.scheduler = scheduler.RequestScheduler()
+    self.rename_callbacks = []
+    self._naming:set[int] = set()
+    self._naming_lock = threading.Lock()
+    self._naming_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="naming")
+    self._running:dict[int, list[CancelToken]] = {}
+    self._running_lock = threading.Lock()
+    self.search_index = search.SearchIndex()
+    self.storage = storage.open_storage()
+    self.recency = recency.RecencyIndex()
+    self.telemetry = telemetry.MetricsLog()
+    self.telemetry.memory = self.memory_report
+    self.saver = saver.Saver()
+    entries = self.storage.entries()
+    for key in entries.keys():
       conv = conversation.Conversation(key, self)
-      conv.load(path)
+      conv.load(lazy=True)
       self.conversations[key] = conv
-    if len(self.conversations) > 0:
-      self.current_conversation = list(self.conversations.keys())[0]
+    self.recency.load({key: entry.mtime for key, entry in entries.items()})
+    self.current_conversation = self.recency.first()
+    # conversations that were not written for a while are compressed
+    threading.Thread(target=self.storage.archive, name="archiver", daemon=True).start()
 
   def get_conversation(self) -> list[str]:
-    """Get a list of conversation names
+    """Get a list of conversation names, the most recently used first
+    """
+    return self.recency.names()
+
+  def new_conversation(self, prompt:str) -> str:
+    """Create a conversation under a provisional name derived from its first prompt
+
+    The conversation is renamed in the background after the first answer.
+
+    Args:
+        prompt (str): The first message
+
+    Returns:
+        str: The conversation key
+    """
+    name = functions.conversation_name(prompt, self.conversations.keys())
+    conv = conversation.Conversation(name, self)
+    conv.meta[PROVISIONAL_NAME_KEY] = True
+    self.conversations[name] = conv
+    self.recency.touch(name)
+    return name
+
+  def rename(self, old_key:str, new_key:str) -> str:
+    """Rename a conversation in the storage
+
+    Args:
+        old_key (str): The current conversation key
+        new_key (str): The new name, made unique if it is already used
+
+    Returns:
+        str: The conversation key after renaming
+    """
+    if old_key == new_key or old_key not in self.conversations:
+      return old_key
+    new_key = functions.unique_name(new_key, self.conversations.keys())
+    conv = self.conversations.pop(old_key)
+    conv.rename(new_key)
+    self.conversations[new_key] = conv
+    self.recency.rename(old_key, new_key)
+    for callback in self.rename_callbacks:
+      callback(old_key, new_key)
+    return new_key
+
+  def delete(self, conv_key:str) -> None:
+    """Delete a conversation from the storage
+
+    The running requests of the conversation are cancelled, it is not saved
+    or named anymore when they finish.
+
+    Args:
+        conv_key (str): The conversation key
+    """
+    conv = self.conversations.pop(conv_key, None)
+    self.recency.remove(conv_key)
+    if conv is None:
+      return
+    conv.delete()
+    self.saver.discard(conv)
+    with self._running_lock:
+      tokens = self._running.pop(id(conv), [])
+    for token in tokens:
+      token.cancel()
+
+  def _started(self, conv:conversation.Conversation, cancel:CancelToken) -> None:
+    """Remember the token of a running request, so deleting the conversation cancels it
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        cancel (CancelToken): The token of the request
+    """
+    with self._running_lock:
+      self._running.setdefault(id(conv), []).append(cancel)
+    if conv.deleted:
+      cancel.cancel()
+
+  def _stopped(self, conv:conversation.Conversation, cancel:CancelToken) -> None:
+    """Forget the token of a request that is done
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        cancel (CancelToken): The token of the request
+    """
+    with self._running_lock:
+      tokens = self._running.get(id(conv), [])
+      if cancel in tokens:
+        tokens.remove(cancel)
+      if len(tokens) <= 0:
+        self._running.pop(id(conv), None)
+
+  def name_later(self, conv:conversation.Conversation) -> None:
+    """Replace the provisional name of a conversation on a background thread
+
+    Args:
+        conv (conversation.Conversation): The conversation
     """
-    l:list[str] = []
-    if self.conversations is None:
-      self.conversations = {}
-    for [_, conv] in self.conversations.items():
-      l.append(conv.name)
-    return l
+    if conv.deleted:
+      return
+    with self._naming_lock:
+      if id(conv) in self._naming:
+        return
+      self._naming.add(id(conv))
+    self._naming_executor.submit(self._name, conv)
+
+  def _name(self, conv:conversation.Conversation) -> None:
+    """Ask the naming model for a name using only the truncated first exchange
+
+    Args:
+        conv (conversation.Conversation): The conversation
+    """
+    cancel = CancelToken()
+    self._started(conv, cancel)
+    try:
+      if conv.deleted:
+        return
+      exchange = context.to_api_messages(conv.messages)[:2]
+      if len(exchange) < 2:
+        return
+      for message in exchange:
+        message["content"] = message["content"][:NAMING_EXCHANGE_CHARS]
+      model = self.naming_model or self.model
+      request = exchange + [{"role": "user", "content": NAMING_PROMPT}]
+      metrics = telemetry.RequestMetrics(model, telemetry.TASK_NAMING)
+      try:
+        answer = "".join(self.cache.stream(model, request, {}, lambda: iter([self.complete(model, request, metrics, cancel)]), cancel))
+      except (*scheduler.REQUEST_ERRORS, cache.CacheMissError):
+        # the provisional name is kept, the next answer tries again
+        metrics.finish(self.context.count_all(request), 0, error=True)
+        self.telemetry.record(metrics)
+        return
+      if conv.deleted:
+        return
+      used = [key for key in self.conversations.keys() if key != conv.name]
+      name = functions.conversation_name(answer, used)
+      conv.meta.pop(PROVISIONAL_NAME_KEY, None)
+      self.rename(conv.name, name)
+      self.saver.save_later(conv)
+    finally:
+      cancel.finish()
+      self._stopped(conv, cancel)
+      with self._naming_lock:
+        self._naming.discard(id(conv))
+
+  def close(self) -> None:
+    """Wait until the conversations are named and saved and the search index is written
+
+    The client can not name conversations anymore afterwards.
+    """
+    self._naming_executor.shutdown(wait=True)
+    self.saver.close()
+    self.search_index.flush()
+    self.storage.close()
+    self.telemetry.close()
+
+  def search(self, query:str, limit:int=50) -> list[search.SearchResult]:
+    """Search the messages of all conversations
+
+    The index is read on the first search.
+
+    Args:
+        query (str): Terms and quoted phrases
+        limit (int, optional): The maximum number of results. Defaults to 50.
+
+    Returns:
+        list[search.SearchResult]: The matching messages, the best first
+    """
+    if not self.search_index.loaded:
+      sizes = {name: entry.size for name, entry in self.storage.entries().items()}
+      self.search_index.load(sizes, lambda name: (self.storage.read(name) or ([],))[0])
+    return [
+      result for result in self.search_index.search(query, limit)
+      if result.conv_key in self.conversations
+    ]
+
+  def touch(self, conv:conversation.Conversation) -> None:
+    """Mark a conversation as recently used
+
+    When a conversation is loaded into memory, the messages of the least
+    recently used conversations are dropped until the loaded conversation
+    files fit into the memory budget again.
+
+    Args:
+        conv (conversation.Conversation): The conversation that was used
+    """
+    with self._loaded_lock:
+      key = id(conv)
+      if key in self._loaded:
+        self._loaded.move_to_end(key)
+        return
+      self._loaded[key] = conv
+      total = sum(loaded.size for loaded in self._loaded.values())
+      for old_key in list(self._loaded.keys())[:-1]:
+        if total <= self.memory_budget:
+          break
+        old = self._loaded[old_key]
+        if old.unload():
+          total -= old.size
+          self._loaded.pop(old_key)
+
+  def memory_report(self) -> dict[str, msg.MemoryReport]:
+    """Estimate the memory of the conversations that are loaded
+
+    Returns:
+        dict[str, msg.MemoryReport]: The report of every loaded conversation by name
+    """
+    with self._loaded_lock:
+      loaded = list(self._loaded.values())
+    return {conv.name: conv.memory() for conv in loaded if conv.loaded}
+
+  def stream_completion(self, messages:list[dict[str,str]], model:str=None, metrics:telemetry.RequestMetrics=None,
+                        cancel:CancelToken=None) -> Iterator[str]:
+    """Request a completion as a stream of content deltas
+
+    The response cache answers repeated requests without calling the API.
+
+    Args:
+        messages (list[dict[str,str]]): The messages to send
+        model (str, optional): The model to ask. Defaults to None for self.model.
+        metrics (telemetry.RequestMetrics, optional): Gets the measurements of the API request. Defaults to None.
+        cancel (CancelToken, optional): Stops the request. Defaults to None.
+
+    Returns:
+        Iterator[str]: The content deltas in the order they arrive
+    """
+    model = model or self.model
+    return self.cache.stream(model, messages, {}, lambda: self._request(messages, model, metrics, cancel), cancel)
+
+  def complete(self, model:str, messages:list[dict[str,str]], metrics:telemetry.RequestMetrics=None,
+               cancel:CancelToken=None) -> str:
+    """Request a completion from the API without streaming
+
+    Args:
+        model (str): The model name
+        messages (list[dict[str,str]]): The messages to send
+        metrics (telemetry.RequestMetrics, optional): Gets the measurements of the request. Defaults to None.
+        cancel (CancelToken, optional): Stops the request. Defaults to None.
 
-  def send(self, conv_key:str, prompt:str) -> None:
+    Returns:
+        str: The content of the answer
+    """
+    def consume(completion) -> Iterator[str]:
+      self._usage(completion, metrics)
+      return iter([completion.choices[0].message.content])
+    return "".join(self.scheduler.run(
+      model,
+      self.context.count_all(messages),
+      lambda: self.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        timeout=self._timeout(cancel)
+      ),
+      consume,
+      metrics,
+      cancel
+    ))
+
+  def _request(self, messages:list[dict[str,str]], model:str=None, metrics:telemetry.RequestMetrics=None,
+               cancel:CancelToken=None) -> Iterator[str]:
+    """Request a completion from the API
+
+    Args:
+        messages (list[dict[str,str]]): The messages to send
+        model (str, optional): The model to ask. Defaults to None for self.model.
+        metrics (telemetry.RequestMetrics, optional): Gets the measurements of the request. Defaults to None.
+        cancel (CancelToken, optional): Stops the request. Defaults to None.
+
+    Returns:
+        Iterator[str]: The content deltas, the whole content at once if streaming is off
+    """
+    model = model or self.model
+    if not self.stream:
+      return iter([self.complete(model, messages, metrics, cancel)])
+    return self.scheduler.run(
+      model,
+      self.context.count_all(messages),
+      lambda: self.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        timeout=self._timeout(cancel)
+      ),
+      lambda stream: self._deltas(stream, metrics),
+      metrics,
+      cancel
+    )
+
+  def _timeout(self, cancel:CancelToken) -> float:
+    """Get the HTTP timeout of a request, so it does not wait past its deadline
+
+    Args:
+        cancel (CancelToken): The token of the request or None
+
+    Returns:
+        float: The seconds until the deadline or NOT_GIVEN for the default timeout
+    """
+    remaining = None if cancel is None else cancel.remaining()
+    return NOT_GIVEN if remaining is None else max(remaining, 0.001)
+
+  def deadline_of(self, conv:conversation.Conversation) -> float:
+    """Get the seconds a request of a conversation may take
+
+    Args:
+        conv (conversation.Conversation): The conversation
+
+    Returns:
+        float: The deadline set for the conversation, else self.deadline, None for no deadline
+    """
+    return conv.meta.get(DEADLINE_KEY, self.deadline)
+
+  def set_deadline(self, conv_key:str, seconds:float) -> None:
+    """Set the seconds the requests of a conversation may take, saved with the conversation
+
+    Args:
+        conv_key (str): The conversation key
+        seconds (float): The deadline or None to use self.deadline again
+    """
+    conv = self.conversations[conv_key]
+    if seconds is None:
+      conv.meta.pop(DEADLINE_KEY, None)
+    else:
+      conv.meta[DEADLINE_KEY] = seconds
+    self.saver.save_later(conv)
+
+  def _usage(self, completion, metrics:telemetry.RequestMetrics) -> None:
+    """Store the token counts the API reported for a completion
+
+    Args:
+        completion (Any): A completion or the last chunk of a streamed completion
+        metrics (telemetry.RequestMetrics): The measurements or None
+    """
+    usage = getattr(completion, "usage", None)
+    if metrics is None or usage is None:
+      return
+    metrics.prompt_tokens = usage.prompt_tokens
+    metrics.completion_tokens = usage.completion_tokens
+
+  def _deltas(self, stream:Iterator, metrics:telemetry.RequestMetrics=None) -> Iterator[str]:
+    """Get the content deltas of a streamed completion
+
+    Args:
+        stream (Iterator): The chunks of the completion
+        metrics (telemetry.RequestMetrics, optional): Gets the token counts of the last chunk. Defaults to None.
+
+    Yields:
+        str: The content deltas in the order they arrive
+    """
+    for chunk in stream:
+      self._usage(chunk, metrics)
+      if len(chunk.choices) <= 0:
+        continue
+      delta = chunk.choices[0].delta.content
+      if delta:
+        yield delta
+
+  def send(self, conv_key:str, prompt:str, on_delta:Callable[[conversation.Conversation], None]=None,
+           cancel:CancelToken=None) -> str:
     """Send a message to the chat model
 
+    The request is stopped when the token is cancelled or the deadline of the
+    conversation has passed, the answer so far is kept and marked as truncated.
+
     Args:
         conv_key (str): The conversation key
         prompt (str): The message to send
+        on_delta (Callable[[Conversation], None], optional): Called after each streamed
+          delta was appended to the last message of the conversation. Defaults to None.
+        cancel (CancelToken, optional): Stops the request, may have an earlier
+          deadline of its own. Defaults to None.
+
+    Returns:
+        str: The conversation key
     """
     prompt = prompt.strip()
     if len(prompt) == 0:
       return
-    conv:conversation.Conversation
     if conv_key is None:
-      conv = conversation.Conversation("<<new>>", self)
+      conv_key = self.new_conversation(prompt)
     elif conv_key not in self.conversations:
       self.conversations[conv_key] = conversation.Conversation(conv_key, self)
-      conv = self.conversations[conv_key]
-    else:
-      conv = self.conversations[conv_key]
+    conv = self.conversations[conv_key]
+    self.recency.touch(conv_key)
+    cancel = cancel or CancelToken()
+    cancel.limit(self.deadline_of(conv))
     messages = conv.messages
     messages.append({"role": "user", "content": prompt})
+    metrics = telemetry.RequestMetrics(self.model)
+    request = self.context.build(conv)
+    answer = {"role":"system", "content":"", PARTIAL_KEY: True}
+    saved = time.monotonic()
+    self._started(conv, cancel)
     try:
-      completion = self.chat.completions.create(
-        model=self.model,
-        messages=messages
-      )
-      conv.messages.append({"role":"system", "content":completion.choices[0].message.content})
+      for delta in self.stream_completion(request, metrics=metrics, cancel=cancel):
+        if len(answer["content"]) <= 0:
+          metrics.first_delta()
+          conv.messages.append(answer)
+        answer["content"] += delta
+        if on_delta is not None:
+          on_delta(conv)
+        saved = self._save_partial(conv, saved)
+    except Cancelled as e:
+      if len(answer["content"]) > 0:
+        answer[conversation.TRUNCATED_KEY] = e.reason
+      else:
+        conv.messages.append({"role":"error", "content":str(e)})
     except Exception as e:
       conv.messages.append({"role":"error", "content":str(e)})
+    self._stopped(conv, cancel)
+    cancel.finish()
+    answer.pop(PARTIAL_KEY, None)
+    # an empty answer is not appended, its measurements are only recorded
+    self._measured(metrics, request, answer["content"], answer if conv.messages[-1]["role"] == "user" else conv.messages[-1])
+    self.saver.save_later(conv)
+    if conv.meta.get(PROVISIONAL_NAME_KEY, False):
+      self.name_later(conv)
+    return conv.name
+
+  def _save_partial(self, conv:conversation.Conversation, saved:float) -> float:
+    """Save a conversation with a streamed answer every PARTIAL_SAVE_INTERVAL seconds
+
+    The answer is marked as partial until it is complete, so an answer that
+    was cut off by a crash is kept and can be told apart.
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        saved (float): The monotonic time of the last save
+
+    Returns:
+        float: The monotonic time of the last save
+    """
+    now = time.monotonic()
+    if now - saved < PARTIAL_SAVE_INTERVAL:
+      return saved
+    self.saver.save_later(conv)
+    return now
+
+  def _measured(self, metrics:telemetry.RequestMetrics, request:list[dict[str,str]], content:str, message:dict) -> None:
+    """Finish the measurements of a request, attach them to its message and record them
+
+    Args:
+        metrics (telemetry.RequestMetrics): The measurements
+        request (list[dict[str,str]]): The messages that were sent
+        content (str): The content of the answer
+        message (dict): The answer or the error message
+    """
+    metrics.finish(
+      self.context.count_all(request),
+      self.context.estimator(content),
+      error=message["role"] == "error"
+    )
+    message["metrics"] = metrics.to_dict()
+    self.telemetry.record(metrics)
+
+  def fan_out(self, conv_key:str, prompt:str, models:list[str]=None, on_delta:Callable[[conversation.Conversation], None]=None,
+              cancel:CancelToken=None) -> str:
+    """Send a message to several chat models at once to compare their answers
+
+    Every model gets the same context and answers into its own message. The
+    answers are tagged with the index of the prompt, so they are shown side by
+    side and only the first one is sent with later prompts. The time to the
+    first token, the total time and the tokens per second are stored with
+    every answer. Cancelling the token stops all models. Without any model
+    to compare, the message is sent to the chat model like send does.
+
+    Args:
+        conv_key (str): The conversation key
+        prompt (str): The message to send
+        models (list[str], optional): The models to ask. Defaults to None for self.models.
+        on_delta (Callable[[Conversation], None], optional): Called after each streamed
+          delta was appended to one of the answers. Defaults to None.
+        cancel (CancelToken, optional): Stops the requests. Defaults to None.
+
+    Returns:
+        str: The conversation key
+    """
+    prompt = prompt.strip()
+    if len(prompt) == 0:
+      return
+    models = models or self.models
+    if len(models) <= 0:
+      return self.send(conv_key, prompt, on_delta, cancel)
     if conv_key is None:
-      # get conv name
-      name_completion = self.chat.completions.create(
-        model=self.model,
-        messages= messages + [{
-          "role": "user",
-          "content": "Generate a name for this conversation. " +
-                    "Max of 25 characters and UpperCamelCase! " +
-                    "Your answer should only contain this name! " +
-                    "No formatting not special characters!"
-        }],
-      )
-      conv_key = name_completion.choices[0].message.content
-      conv.name = conv_key
-      self.conversations[conv_key] = conv
-    conv.save()
-    return conv_key
+      conv_key = self.new_conversation(prompt)
+    elif conv_key not in self.conversations:
+      self.conversations[conv_key] = conversation.Conversation(conv_key, self)
+    conv = self.conversations[conv_key]
+    self.recency.touch(conv_key)
+    cancel = cancel or CancelToken()
+    cancel.limit(self.deadline_of(conv))
+    messages = conv.messages
+    messages.append({"role": "user", "content": prompt})
+    request = self.context.build(conv)
+    group = len(messages) - 1
+    answers = [
+      {"role": "system", "content": "", "model": model, conversation.FAN_OUT_KEY: group, PARTIAL_KEY: True}
+      for model in models
+    ]
+    messages.extend(answers)
+    saved = [time.monotonic()]
+    saved_lock = threading.Lock()
+
+    def answer(answer:dict) -> None:
+      metrics = telemetry.RequestMetrics(answer["model"])
+      try:
+        for delta in self.stream_completion(request, answer["model"], metrics, cancel):
+          metrics.first_delta()
+          answer["content"] += delta
+          if on_delta is not None:
+            on_delta(conv)
+          with saved_lock:
+            saved[0] = self._save_partial(conv, saved[0])
+      except Cancelled as e:
+        if len(answer["content"]) > 0:
+          answer[conversation.TRUNCATED_KEY] = e.reason
+        else:
+          answer["role"] = "error"
+          answer["content"] = str(e)
+      except Exception as e:
+        answer["role"] = "error"
+        answer["content"] = str(e)
+      answer.pop(PARTIAL_KEY, None)
+      self._measured(metrics, request, answer["content"], answer)
+
+    self._started(conv, cancel)
+    with ThreadPoolExecutor(max_workers=len(answers), thread_name_prefix="fanout") as executor:
+      list(executor.map(answer, answers))
+    self._stopped(conv, cancel)
+    cancel.finish()
+    self.saver.save_later(conv)
+    if conv.meta.get(PROVISIONAL_NAME_KEY, False):
+      self.name_later(conv)
+    return conv.name
@@ -4,5 +4,44 @@
 
 CONFIG_FOLDER_NAME = '.openai-chat'
 CONVERSATIONS_FOLDER_NAME = 'conversations'
+CONFIG_FOLDER_PATH = f"/{CONFIG_FOLDER_NAME}/"
 CONVERSATIONS_FOLDER_PATH = f"/{CONFIG_FOLDER_NAME}/{CONVERSATIONS_FOLDER_NAME}/"
-FILE_EXTENSION = '.json'
+FILE_EXTENSION = '.jsonl'
+LEGACY_FILE_EXTENSION = '.json'
+COLD_FILE_EXTENSION = '.jsonl.xz'
+MAX_PARALLEL_REQUESTS = 4
+CATALOG_FILE_NAME = 'catalog.json'
+CATALOG_SAVE_INTERVAL = 5 # seconds a changed catalog waits before it is written
+LOADED_CONVERSATIONS_BUDGET = 64 * 1024 * 1024 # bytes of conversation files kept in memory
+CONTEXT_TOKEN_BUDGET = 8000 # estimated tokens of the messages sent with a prompt
+NAMING_EXCHANGE_CHARS = 500 # characters of the first prompt and answer sent to name a conversation
+CACHE_FOLDER_NAME = 'cache'
+CACHE_MAX_SIZE = 256 * 1024 * 1024 # bytes
+CACHE_TTL = 30 * 24 * 60 * 60 # seconds
+CACHE_MODE_ENV = 'OPENAI_CHAT_CACHE' # off, on or only
+MAX_REQUESTS_PER_MODEL = 8
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 0.5 # seconds
+RETRY_MAX_DELAY = 60 # seconds
+SEARCH_FOLDER_NAME = 'search'
+STORAGE_ENV = 'OPENAI_CHAT_STORAGE' # files or sqlite
+DATABASE_FILE_NAME = 'conversations.db'
+FAN_OUT_MODELS_ENV = 'OPENAI_CHAT_MODELS' # comma separated models that answer in compare mode
+DEFAULT_FAN_OUT_MODELS = ('gpt-4-turbo-preview', 'gpt-3.5-turbo-0125')
+SNAPSHOT_FILE_NAME = 'snapshot.json'
+SNAPSHOT_CHATS = 256 # names of the chat list kept for the first frame
+METRICS_FILE_NAME = 'metrics.jsonl'
+METRICS_PROMETHEUS_FILE_NAME = 'metrics.prom'
+METRICS_PROMETHEUS_INTERVAL = 10 # seconds a finished request waits before metrics.prom is written
+METRICS_SAMPLES = 1000 # latest latencies per model the percentiles are computed from
+PARTIAL_SAVE_INTERVAL = 2 # seconds between saves of an answer that is streamed
+COLD_STORAGE_AGE = 30 * 24 * 60 * 60 # seconds a conversation is not written before its journal is compressed
+LAZY_CONTENT_MIN_CHARS = 256 # shorter contents of messages read from a journal are kept in memory
+DECODED_CONTENTS = 8 # long contents read from a journal that are kept decoded for the next use
+CONTEXT_MODE_ENV = 'OPENAI_CHAT_CONTEXT' # summary, retrieval or retrieval-all
+RETRIEVAL_RECENT_MESSAGES = 6 # newest messages that are always sent in the retrieval modes
+RETRIEVAL_TOP_K = 8 # most relevant earlier messages sent in the retrieval modes
+RETRIEVAL_DIMENSIONS = 256 # of the hashed n-gram vectors
+VECTORS_FOLDER_NAME = 'vectors' # vectors of the conversations that are not in memory, for retrieval-all
+REQUEST_DEADLINE = 300 # seconds an answer may take before it is cut off, None for no deadline
+DAEMON_SOCKET_NAME = 'daemon.sock' # Unix socket in the config folder the chat windows connect to
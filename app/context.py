@@ -0,0 +1,457 @@
+"""Builds the messages that are sent to the chat model
+
+The newest messages of a conversation are sent as they are as long as they
+fit into a token budget. Older messages are replaced by a summary that is
+created in the background and cached in the conversation metadata.
+
+With OPENAI_CHAT_CONTEXT=retrieval only the newest few messages are sent,
+together with the earlier messages that are most similar to the prompt
+(see the retrieval module). retrieval-all also sends the most similar
+messages of the other conversations. The vectors of the conversations that
+are not in memory are built on a background thread and kept in files, the
+ones that were used last are kept in memory within the memory budget of the
+client.
+"""
+
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from constants import CONTEXT_TOKEN_BUDGET, CONTEXT_MODE_ENV, RETRIEVAL_RECENT_MESSAGES, RETRIEVAL_TOP_K, VECTORS_FOLDER_NAME
+import conversation
+import functions
+import retrieval
+import scheduler
+import telemetry
+import base
+
+
+SUMMARY_KEY = "summary"
+SUMMARY_PROMPT = (
+  "Summarize the following conversation between a user and an assistant. " +
+  "Keep all facts, decisions, names, numbers and open questions that could be needed later. " +
+  "Answer only with the summary."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+RELATED_PREFIX = "Relevant messages from other conversations:\n"
+MESSAGE_OVERHEAD_TOKENS = 4
+
+MODE_SUMMARY = "summary"
+MODE_RETRIEVAL = "retrieval"
+MODE_RETRIEVAL_ALL = "retrieval-all"
+
+
+def estimate_tokens(text:str) -> int:
+  """Estimate the number of tokens of a text without a tokenizer
+
+  Assumes about four characters per token for english text and prose.
+
+  Args:
+      text (str): The text
+
+  Returns:
+      int: The estimated number of tokens
+  """
+  return (len(text) + 3) // 4
+
+
+def to_api_messages(messages:list[dict[str,str]]) -> list[dict[str,str]]:
+  """Convert conversation messages to the format the API expects
+
+  Error messages are skipped and only role and content are kept. Of the
+  answers of a fan out only the first one that is no error is sent.
+
+  Args:
+      messages (list[dict[str,str]]): The conversation messages
+
+  Returns:
+      list[dict[str,str]]: The messages for the API
+  """
+  api_messages:list[dict[str,str]] = []
+  groups:set = set()
+  for message in messages:
+    if message["role"] == "error":
+      continue
+    group = message.get(conversation.FAN_OUT_KEY)
+    if group is not None:
+      if group in groups:
+        continue
+      groups.add(group)
+    api_messages.append({"role": message["role"], "content": message["content"]})
+  return api_messages
+
+
+class ContextBuilder:
+  """Assembles token bounded requests from conversations
+  """
+  client:base.ClientBase
+  budget:int
+  estimator:Callable[[str], int]
+  summary_model:str
+  mode:str
+  recent:int
+  top_k:int
+  folder:str
+
+  def __init__(self, client:base.ClientBase, budget:int=CONTEXT_TOKEN_BUDGET, estimator:Callable[[str], int]=estimate_tokens, mode:str=None,
+               folder:str="") -> None:
+    if mode is None:
+      mode = os.environ.get(CONTEXT_MODE_ENV, MODE_SUMMARY)
+    if len(folder) <= 0:
+      folder = functions.get_config_path(VECTORS_FOLDER_NAME)
+    self.client = client
+    self.budget = budget
+    self.estimator = estimator
+    self.summary_model = None
+    self.mode = mode
+    self.recent = RETRIEVAL_RECENT_MESSAGES
+    self.top_k = RETRIEVAL_TOP_K
+    self.folder = folder
+    self._summarizing:set[int] = set()
+    self._indexes:weakref.WeakKeyDictionary[conversation.Conversation, retrieval.VectorIndex] = weakref.WeakKeyDictionary()
+    # the least recently used last, by conversation name with the stored size they were built from
+    self._stored:OrderedDict[str, tuple[int, retrieval.VectorIndex]] = OrderedDict()
+    self._building:set[str] = set()
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+    self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vectors")
+
+  def count(self, message:dict[str,str]) -> int:
+    """Estimate the tokens of a message including its overhead
+
+    Args:
+        message (dict[str,str]): A message object with a role and content
+
+    Returns:
+        int: The estimated number of tokens
+    """
+    return self.estimator(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+  def count_all(self, messages:list[dict[str,str]]) -> int:
+    """Estimate the tokens of a list of messages
+
+    Args:
+        messages (list[dict[str,str]]): The messages
+
+    Returns:
+        int: The estimated number of tokens
+    """
+    return sum(self.count(message) for message in messages)
+
+  def build(self, conv:conversation.Conversation) -> list[dict[str,str]]:
+    """Build the messages to send for a conversation
+
+    Args:
+        conv (conversation.Conversation): The conversation
+
+    Returns:
+        list[dict[str,str]]: The messages for the API
+    """
+    if self.mode == MODE_RETRIEVAL or self.mode == MODE_RETRIEVAL_ALL:
+      return self.retrieve(conv, self.mode == MODE_RETRIEVAL_ALL)
+    messages = conv.messages
+    total = 0
+    start = len(messages)
+    while start > 0:
+      message = messages[start - 1]
+      if message["role"] != "error":
+        tokens = self.count(message)
+        if total + tokens > self.budget and start < len(messages):
+          break
+        total += tokens
+      start -= 1
+    if start <= 0:
+      return to_api_messages(messages)
+    # keep a quarter of the budget for the summary
+    summary_budget = self.budget // 4
+    while total > self.budget - summary_budget and start < len(messages) - 1:
+      if messages[start]["role"] != "error":
+        total -= self.count(messages[start])
+      start += 1
+    summary = conv.meta.get(SUMMARY_KEY)
+    if summary is None or summary["upto"] < start:
+      self.summarize_later(conv, start)
+    if summary is None:
+      return to_api_messages(messages[start:])
+    head = {"role": "system", "content": SUMMARY_PREFIX + summary["content"]}
+    # the messages after an older summary are sent until the new one covers them, as many as fit
+    total += self.count(head)
+    while start > summary["upto"]:
+      message = messages[start - 1]
+      tokens = 0 if message["role"] == "error" else self.count(message)
+      if total + tokens > self.budget:
+        break
+      total += tokens
+      start -= 1
+    return [head] + to_api_messages(messages[max(start, summary["upto"]):])
+
+  def retrieve(self, conv:conversation.Conversation, other_conversations:bool=False) -> list[dict[str,str]]:
+    """Build the messages to send from the newest messages and the earlier ones most similar to the prompt
+
+    The newest recent messages are sent as long as they fit into the
+    budget, the top_k most similar earlier messages as long as the rest of
+    the budget allows, in the order of the conversation.
+
+    Args:
+        conv (conversation.Conversation): The conversation, the newest message is the prompt
+        other_conversations (bool, optional): Also send the most similar messages of the
+          other conversations. Defaults to False.
+
+    Returns:
+        list[dict[str,str]]: The messages for the API
+    """
+    messages = conv.messages
+    total = 0
+    start = len(messages)
+    while start > 0 and len(messages) - start < self.recent:
+      message = messages[start - 1]
+      if message["role"] != "error":
+        tokens = self.count(message)
+        if total + tokens > self.budget and start < len(messages):
+          break
+        total += tokens
+      start -= 1
+    if start <= 0 and not other_conversations:
+      return to_api_messages(messages)
+    query = retrieval.embed(messages[-1]["content"]) if len(messages) > 0 else {}
+    selected:list[int] = []
+    for i, _ in self.index(conv).search(query, self.top_k, start):
+      tokens = self.count(messages[i])
+      if total + tokens <= self.budget:
+        total += tokens
+        selected.append(i)
+    api_messages = to_api_messages([messages[i] for i in sorted(selected)] + messages[start:])
+    if not other_conversations:
+      return api_messages
+    related:list[str] = []
+    for name, message in self.related(conv, query, self.top_k):
+      text = f"{name} ({message['role']}): {message['content']}"
+      tokens = self.estimator(text) + MESSAGE_OVERHEAD_TOKENS
+      if total + tokens <= self.budget:
+        total += tokens
+        related.append(text)
+    if len(related) <= 0:
+      return api_messages
+    return [{"role": "system", "content": RELATED_PREFIX + "\n\n".join(related)}] + api_messages
+
+  def related(self, conv:conversation.Conversation, query:dict[int, float], k:int) -> list[tuple[str, dict[str,str]]]:
+    """Find the messages of the other conversations that are most similar to a query
+
+    The conversations that are not in memory are not loaded. Their indexes
+    are read from the vector files, the ones that are missing or outdated
+    are built in the background and searched by later requests. Only the
+    conversations with the most similar messages are read for the messages.
+
+    Args:
+        conv (conversation.Conversation): The conversation that is not searched
+        query (dict[int, float]): The vector of the query from retrieval.embed
+        k (int): The maximum number of messages
+
+    Returns:
+        list[tuple[str, dict[str,str]]]: The conversation names and messages, the most similar first
+    """
+    found:list[tuple[float, conversation.Conversation, int]] = []
+    entries = self.client.storage.entries()
+    for other in list(self.client.conversations.values()):
+      if other is conv:
+        continue
+      if other.loaded:
+        index = self.index(other)
+      else:
+        with self._lock:
+          # the vectors of unloaded messages are not kept with the conversation
+          self._indexes.pop(other, None)
+        entry = entries.get(other.name)
+        index = None if entry is None else self.stored_index(other.name, entry.size)
+        if index is None:
+          continue
+      for i, score in index.search(query, k):
+        found.append((score, other, i))
+    found.sort(key=lambda item: item[0], reverse=True)
+    related:list[tuple[str, dict[str,str]]] = []
+    for _, other, i in found[:k]:
+      if other.loaded:
+        messages = other.messages
+      else:
+        messages = (self.client.storage.read(other.name) or ([],))[0]
+      if i < len(messages):
+        related.append((other.name, messages[i]))
+    return related
+
+  def index(self, conv:conversation.Conversation) -> retrieval.VectorIndex:
+    """Get the up to date vector index of a conversation, the messages are loaded
+
+    Args:
+        conv (conversation.Conversation): The conversation
+
+    Returns:
+        retrieval.VectorIndex: The index
+    """
+    with self._lock:
+      index = self._indexes.get(conv)
+      if index is None:
+        index = retrieval.VectorIndex()
+        self._indexes[conv] = index
+    index.update(conv.messages)
+    return index
+
+  def vector_path(self, name:str) -> str:
+    """Get the path of the vector file of a conversation
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        str: The path to the file
+    """
+    return os.path.join(self.folder, name + ".vec")
+
+  def stored_index(self, name:str, size:int) -> retrieval.VectorIndex:
+    """Get the vector index of a stored conversation without reading the conversation
+
+    Args:
+        name (str): The conversation name
+        size (int): The stored size of the conversation
+
+    Returns:
+        retrieval.VectorIndex: The index, None if it is built in the background first
+    """
+    with self._lock:
+      stored = self._stored.get(name)
+      if stored is not None and stored[0] == size:
+        self._stored.move_to_end(name)
+        return stored[1]
+    index = retrieval.VectorIndex.load(self.vector_path(name), size)
+    if index is None:
+      self.build_later(name)
+      return None
+    self._remember(name, size, index)
+    return index
+
+  def build_later(self, name:str) -> None:
+    """Build and write the vector index of a stored conversation on the background thread
+
+    Args:
+        name (str): The conversation name
+    """
+    with self._lock:
+      if name in self._building:
+        return
+      self._building.add(name)
+    self._builder.submit(self._build, name)
+
+  def _build(self, name:str) -> None:
+    """Build the vector index of a stored conversation and write it to its file
+
+    Args:
+        name (str): The conversation name
+    """
+    try:
+      stored = self.client.storage.read(name)
+      if stored is None:
+        return
+      messages, _, size = stored
+      index = retrieval.VectorIndex()
+      index.update(messages)
+      try:
+        index.save(self.vector_path(name), size)
+      except OSError:
+        # it is built again in the next session
+        pass
+      self._remember(name, size, index)
+    except (OSError, ValueError):
+      return
+    finally:
+      with self._lock:
+        self._building.discard(name)
+
+  def _remember(self, name:str, size:int, index:retrieval.VectorIndex) -> None:
+    """Keep the vector index of a stored conversation in memory
+
+    The indexes that were used least recently are dropped until the indexes
+    fit into the memory budget of the client, they are read from their files
+    again when they are used.
+
+    Args:
+        name (str): The conversation name
+        size (int): The stored size the index was built from
+        index (retrieval.VectorIndex): The index
+    """
+    with self._lock:
+      self._stored[name] = (size, index)
+      self._stored.move_to_end(name)
+      total = sum(stored.memory() for _, stored in self._stored.values())
+      while total > self.client.memory_budget and len(self._stored) > 1:
+        _, (_, old) = self._stored.popitem(last=False)
+        total -= old.memory()
+
+  def summarize_later(self, conv:conversation.Conversation, upto:int) -> None:
+    """Refresh the summary of a conversation on the background thread
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        upto (int): The number of messages the summary should cover
+    """
+    with self._lock:
+      if id(conv) in self._summarizing:
+        return
+      self._summarizing.add(id(conv))
+    self._executor.submit(self._summarize, conv, upto)
+
+  def _summarize(self, conv:conversation.Conversation, upto:int) -> None:
+    """Extend the summary of a conversation until it covers upto messages
+
+    The messages are summarized in chunks that fit into the budget,
+    each chunk is summarized together with the summary so far.
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        upto (int): The number of messages the summary should cover
+    """
+    model = self.summary_model or self.client.model
+    try:
+      old = conv.meta.get(SUMMARY_KEY)
+      summary = old or {"content": "", "upto": 0}
+      messages = conv.messages[:upto]
+      done = summary["upto"]
+      while done < upto:
+        chunk:list[str] = []
+        tokens = self.estimator(summary["content"])
+        end = done
+        while end < upto:
+          message = messages[end]
+          if message["role"] != "error":
+            message_tokens = self.count(message)
+            if tokens + message_tokens > self.budget and len(chunk) > 0:
+              break
+            tokens += message_tokens
+            chunk.append(message["role"] + ": " + message["content"])
+          end += 1
+        text = "\n\n".join(chunk)
+        if len(summary["content"]) > 0:
+          text = SUMMARY_PREFIX + summary["content"] + "\n\n" + text
+        request = [
+          {"role": "system", "content": SUMMARY_PROMPT},
+          {"role": "user", "content": text},
+        ]
+        metrics = telemetry.RequestMetrics(model, telemetry.TASK_SUMMARY)
+        try:
+          content = self.client.complete(model, request, metrics)
+        except scheduler.REQUEST_ERRORS:
+          # the chunks summarized so far are kept, the next request tries again
+          metrics.finish(self.count_all(request), 0, error=True)
+          self.client.telemetry.record(metrics)
+          break
+        summary = {"content": content, "upto": end}
+        done = end
+      if summary is old or summary["upto"] <= 0:
+        return
+      conv.meta[SUMMARY_KEY] = summary
+      if conv.stored:
+        self.client.saver.save_later(conv)
+    finally:
+      with self._lock:
+        self._summarizing.discard(id(conv))
@@ -2,12 +2,138 @@
 """
 
 
+import curses
+from typing import Callable
 import npyscreen
 import base
+import recency
 from labels import Lang
 
 
-class MultiSelectHandled(npyscreen.MultiSelect):
+ROW_STATE = ("name", "value", "hide", "show_bold", "important", "highlight", "color")
+
+
+class DamageTracked:
+  """A mixin for multi line widgets that repaints only the rows that changed
+
+  The rows remember what they show, so the rows of the new values can be
+  compared with them before anything is drawn. When the values scrolled by
+  a few lines, the rows on screen are moved with a curses scroll instead of
+  being repainted and only the uncovered rows are drawn.
+  """
+  _my_widgets:list[npyscreen.widget.Widget]
+
+  def redraw(self) -> None:
+    """Repaint the rows whose content or highlighting changed
+    """
+    if self.hidden:
+      return
+    if self.values is None:
+      self.values = []
+    if not hasattr(self.value, "append"):
+      self.value = [] if self.value is None else [self.value]
+    rows = self._my_widgets
+    self._filtered_values_cache = self.get_filtered_indexes()
+    self._keep_cursor_visible()
+    start = self.start_display_at
+    if len(self.values) > start + len(rows) or start != self._last_start_display_at:
+      # the "more" label or a moved view, let npyscreen handle it
+      self.update(clear=True)
+      return
+    before = [self._row_state(row) for row in rows]
+    shift = self._find_shift(before, [self._value_name(start + i) for i in range(len(rows))])
+    if shift != 0 and self._scroll_rows(shift):
+      before = [before[i + shift] if 0 <= i + shift < len(rows) else None for i in range(len(rows))]
+    for i, row in enumerate(rows):
+      self._print_line(row, start + i)
+      if (self.editing or self.always_show_cursor) and start + i == self.cursor_line:
+        self.set_is_line_cursor(row, True)
+      if self._row_state(row) != before[i]:
+        row.update(clear=True)
+    self._last_values = list(self.values)
+    self._last_value = list(self.value)
+    self._last_cursor_line = self.cursor_line
+
+  def _keep_cursor_visible(self) -> None:
+    """Move the view to the cursor the same way MultiLine.update does
+    """
+    if not (self.editing or self.always_show_cursor):
+      return
+    rows = len(self._my_widgets)
+    self.cursor_line = max(0, min(self.cursor_line, len(self.values) - 1))
+    if self.slow_scroll:
+      if self.cursor_line > self.start_display_at + rows - 1:
+        self.start_display_at = self.cursor_line - (rows - 1)
+      if self.cursor_line < self.start_display_at:
+        self.start_display_at = self.cursor_line
+    else:
+      if self.cursor_line > self.start_display_at + rows - 2:
+        self.start_display_at = self.cursor_line
+      if self.cursor_line < self.start_display_at:
+        self.start_display_at = max(self.cursor_line - (rows - 2), 0)
+
+  def _value_name(self, index:int) -> str:
+    """Get the text a row shows for a value
+
+    Args:
+        index (int): The value index
+
+    Returns:
+        str: The display text or None for an empty row
+    """
+    if index >= len(self.values):
+      return None
+    return self.display_value(self.values[index])
+
+  def _row_state(self, row:npyscreen.widget.Widget) -> tuple:
+    """Get what a row shows
+
+    Args:
+        row (npyscreen.widget.Widget): The row widget
+
+    Returns:
+        tuple: The attributes that change the look of the row
+    """
+    return tuple(getattr(row, name, None) for name in ROW_STATE)
+
+  def _find_shift(self, before:list[tuple], names:list[str]) -> int:
+    """Find out by how many rows the content scrolled
+
+    Args:
+        before (list[tuple]): The states of the rows on screen
+        names (list[str]): The texts of the rows to show
+
+    Returns:
+        int: Positive if the content moved up, negative if it moved down, 0 if it did not scroll
+    """
+    shown = [None if state[2] else state[0] for state in before]
+    count = len(names)
+    for shift in range(1, count // 2 + 1):
+      if shown[shift:] == names[:count - shift] and shown[:shift] != names[:shift]:
+        return shift
+      if shown[:count - shift] == names[shift:] and shown[count - shift:] != names[count - shift:]:
+        return -shift
+    return 0
+
+  def _scroll_rows(self, shift:int) -> bool:
+    """Move the rows on screen with a curses scroll
+
+    Args:
+        shift (int): The number of rows to scroll, negative to scroll down
+
+    Returns:
+        bool: False if the terminal area could not be scrolled
+    """
+    try:
+      area = self.parent.curses_pad.subpad(len(self._my_widgets), self.width, self.rely, self.relx)
+      area.scrollok(True)
+      area.scroll(shift)
+      return True
+    except curses.error:
+      return False
+
+
+class MultiSelectHandled(DamageTracked, npyscreen.MultiSelect):
   """A multi select widget with a custom handler
   """
 
@@ -51,43 +177,45 @@ class ChatView(npyscreen.BoxTitle):
     self.scroll_up_callback = self.entry_widget.scroll_up_callback
     self.scroll_down_callback = self.entry_widget.scroll_down_callback
 
+  def redraw(self, values:list[str]) -> None:
+    """Show new values, repainting only the rows that changed
+
+    Args:
+        values (list[str]): The new values to display
+    """
+    self.entry_widget.values = values
+    self.entry_widget.redraw()
+    self.parent.refresh()
+
 
 class InputField(npyscreen.TitleText):
   """A field for entering chat messages
   """
   scroll_offset:int = 0
 
-  def invoke(self) -> None:
-    """Send the message to the chat model
+  def invoke(self, models:list[str]=None, prompt:str=None) -> None:
+    """Send the message to the chat model in the background
+
+    Args:
+        models (list[str], optional): Send it to these models to compare their
+          answers. Defaults to None for the chat model.
+        prompt (str, optional): The message, e.g. one entered before the client
+          was ready. Defaults to None for the value of the field.
     """
     self.scroll_offset = 0
     app:base.AppBase = self.find_parent_app()
-    prompt = self.value
-    self.value = ""
+    if prompt is None:
+      prompt = self.value
+      self.value = ""
     if len(prompt) > 0:
-      app.form.chat.values.append(Lang.cur.conversation_generated_response)
-      app.form.chat.clear()
-      app.form.chat.display()
-      self.display()
-      new_conf_key = app.client.send(app.client.current_conversation, prompt)
-      if app.client.current_conversation != new_conf_key:
-        app.client.current_conversation = new_conf_key
-        app.form.chat_list.values = app.client.get_conversation()
-        app.form.chat_list.entry_widget.value = [list(app.client.conversations.keys()).index(app.client.current_conversation)]
-        app.form.chat_list.display()
-      if app.client.current_conversation is not None:
-        if app.client.current_conversation in app.client.conversations:
-          conv = app.client.conversations[app.client.current_conversation]
-          chat_view = app.form.chat
-          chat_view.values = conv.values(self.scroll_offset)
-          chat_view.entry_widget.value = []
-          chat_view.entry_widget.cursor_line = len(chat_view.values) - 1 - 1
-          chat_view.display()
-    self.value = ""
+      app.form.chat.redraw(app.form.chat.values + [Lang.cur.conversation_generated_response])
+      conv_key = app.requests.submit(app.client.current_conversation, prompt, models)
+      app.client.current_conversation = conv_key
+      app.form.chat_list.select(conv_key)
     self.display()
 
 
-class SelectOneHandled(npyscreen.SelectOne):
+class SelectOneHandled(DamageTracked, npyscreen.SelectOne):
   """A select one widget with a custom handler
   """
 
@@ -95,6 +223,47 @@ class SelectOneHandled(npyscreen.SelectOne):
     super().__init__(*args, **kwargs)
     self.callbacks = []
     self.selected_itm = None
+    self.is_in_flight:Callable[[str], bool] = lambda _: False
+    self.page:Callable[[int], bool] = lambda _: False
+
+  def display_value(self, vl:str) -> str:
+    """Prefix conversations that are waiting for an answer with a marker
+
+    Args:
+        vl (str): The conversation name
+
+    Returns:
+        str: The text to display
+    """
+    if self.is_in_flight(vl):
+      return Lang.cur.main_form_chat_in_flight_prefix + super().display_value(vl)
+    return super().display_value(vl)
+
+  def h_cursor_line_up(self, ch:int) -> None:
+    """Move the cursor up, turning to the previous page at the first row
+    """
+    if self.cursor_line <= 0 and self.page(-1):
+      return
+    super().h_cursor_line_up(ch)
+
+  def h_cursor_line_down(self, ch:int) -> None:
+    """Move the cursor down, turning to the next page at the last row
+    """
+    if self.cursor_line >= len(self.values) - 1 and self.page(1):
+      return
+    super().h_cursor_line_down(ch)
+
+  def h_cursor_page_up(self, ch:int) -> None:
+    """Turn to the previous page
+    """
+    if not self.page(-len(self._my_widgets)):
+      super().h_cursor_page_up(ch)
+
+  def h_cursor_page_down(self, ch:int) -> None:
+    """Turn to the next page
+    """
+    if not self.page(len(self._my_widgets)):
+      super().h_cursor_page_down(ch)
 
   def when_check_value_changed(self) -> bool:
     """Handle the check value changed event
@@ -114,9 +283,74 @@ class SelectOneHandled(npyscreen.SelectOne):
 
 class SelectList(npyscreen.BoxTitle):
   """A list for selecting chat conversations
+
+  The list shows one page of the recency index of the client at a time,
+  so its rows never hold more names than fit into the box.
   """
   _contained_widget = SelectOneHandled
+  source:recency.RecencyIndex
+  page_start:int
 
   def __init__(self, *args, **keywords) -> None:
     super().__init__(*args, **keywords)
     self.callbacks = self.entry_widget.callbacks
+    self.source = recency.RecencyIndex()
+    self.page_start = 0
+    self.entry_widget.page = self.turn_page
+
+  def select(self, name:str) -> None:
+    """Select a conversation and turn to its page
+
+    Args:
+        name (str): The conversation name or None to clear the selection
+    """
+    self.entry_widget.selected_itm = name
+    position = None if name is None else self.source.position(name)
+    rows = len(self.entry_widget._my_widgets)
+    if position is not None:
+      if position < self.page_start:
+        self.page_start = position
+      elif position >= self.page_start + rows:
+        self.page_start = position - rows + 1
+    self.redraw()
+
+  def turn_page(self, rows:int) -> bool:
+    """Move the page by a number of rows
+
+    Args:
+        rows (int): The number of rows, negative to move towards the most recent conversations
+
+    Returns:
+        bool: False if the page is already at the start or the end
+    """
+    page_start = self._clamp(self.page_start + rows)
+    if page_start == self.page_start:
+      return False
+    self.page_start = page_start
+    self.redraw()
+    return True
+
+  def redraw(self) -> None:
+    """Read the current page and repaint the rows that changed
+    """
+    entry = self.entry_widget
+    self.page_start = self._clamp(self.page_start)
+    entry.values = self.source.page(self.page_start, len(entry._my_widgets))
+    position = None if entry.selected_itm is None else self.source.position(entry.selected_itm)
+    if position is not None and 0 <= position - self.page_start < len(entry.values):
+      entry.value = [position - self.page_start]
+    else:
+      entry.value = []
+    entry.redraw()
+    self.parent.refresh()
+
+  def _clamp(self, page_start:int) -> int:
+    """Keep a page start inside the index
+
+    Args:
+        page_start (int): The position of the first row
+
+    Returns:
+        int: The position moved so the page is as full as possible
+    """
+    return max(0, min(page_start, len(self.source) - len(self.entry_widget._my_widgets)))
@@ -2,59 +2,242 @@
 """
 
 
-import os
-import json
-from constants import CONVERSATIONS_FOLDER_PATH, FILE_EXTENSION
-import functions
+import bisect
+import threading
+from typing import Callable
+import cancel
+import journal
+import message as msg
+import wrap
 import base
 from labels import Lang
 
 
+FAN_OUT_KEY = "fanout"
+TRUNCATED_KEY = "truncated"
+
+
+def truncated_label(reason:str) -> str:
+  """Get the note shown below an answer that was cut off
+
+  Args:
+      reason (str): cancel.CANCELLED or cancel.DEADLINE
+
+  Returns:
+      str: The note
+  """
+  if reason == cancel.DEADLINE:
+    return Lang.cur.conversation_truncated_deadline
+  return Lang.cur.conversation_truncated_cancelled
+
+
+def _content_of(message:dict) -> str|Callable[[], str]:
+  """Get the content of a message to wrap it
+
+  Args:
+      message (dict): A dict or a Message
+
+  Returns:
+      str|Callable[[], str]: The content, a function that reads it for a content that is not in memory
+  """
+  if isinstance(message, msg.Message) and message.lazy:
+    return message.content_key().read
+  return message["content"]
+
+
 class Conversation:
   """A conversation object to hold messages and manage the conversation
   """
   name:str
-  messages:list[dict[str,str]]
   client:base.ClientBase
-  path:str
+  stored:bool
+  deleted:bool
+  size:int
 
   def __init__(self, name:str, client:base.ClientBase) -> None:
     self.name:str = name
-    self.messages:list[dict[str,str]] = []
+    self._messages:list[dict[str,str]] = []
     self.client = client
+    self.stored = False
+    self.deleted = False
+    self.size = 0
+    self._lock = threading.RLock()
+    self._meta:dict = {}
+    self._saved:list[dict[str,str]] = []
+    self._saved_meta:dict = {}
+    self._line_cache:list[tuple[tuple, wrap.WrappedText]] = []
+    self._line_offsets:list[int] = [0]
+    self._prefixes:dict[str, tuple[str, str]] = {}
 
-  def save(self, path="") -> None:
-    """Save the conversation to a file
+  @property
+  def messages(self) -> list[dict[str,str]]:
+    """The messages of the conversation, read from the storage on first access
     """
-    if len(path) <= 0:
-      self.path = functions.get_home_folder() + CONVERSATIONS_FOLDER_PATH + self.name + FILE_EXTENSION
-    else:
-      self.path = path
-    json_str = json.dumps(self.messages, indent=2)
-    with open(self.path, "w+", encoding='utf-8') as f:
-      f.write(json_str)
+    messages = self._messages
+    if messages is None:
+      with self._lock:
+        if self._messages is None:
+          self._read()
+        messages = self._messages
+    if self.client is not None:
+      self.client.touch(self)
+    return messages
 
-  def load(self, path="") -> None:
-    """Load the conversation from a file
+  @messages.setter
+  def messages(self, messages:list[dict[str,str]]) -> None:
+    self._messages = messages
+
+  @property
+  def meta(self) -> dict:
+    """Metadata of the conversation that is saved along with the messages
+    """
+    if self._messages is None:
+      _ = self.messages
+    return self._meta
+
+  @property
+  def loaded(self) -> bool:
+    """True if the messages are in memory
+    """
+    return self._messages is not None
+
+  def save(self) -> None:
+    """Save the conversation to the storage of the client
+
+    Only the messages that changed since the last save are written. The
+    messages are copied first, an answer may still grow while it is saved.
+    Contents that are not in memory are compared by their place in the file.
+    A deleted conversation is not saved again.
     """
-    if len(path) <= 0:
-      self.path = functions.get_home_folder() + CONVERSATIONS_FOLDER_PATH + self.name + FILE_EXTENSION
-    else:
-      self.path = path
+    with self._lock:
+      if self.deleted:
+        return
+      storage = self.client.storage
+      messages = [msg.copy(message) for message in self.messages]
+      meta = dict(self._meta)
+      changed:list[int] = None
+      if not self.stored:
+        self.size = storage.write(self.name, messages, meta)
+        self._saved = messages
+        self._saved_meta = meta
+        self.stored = True
+      else:
+        records = journal.diff(self._saved, messages) + journal.diff_meta(self._saved_meta, meta)
+        if len(records) > 0:
+          self.size = storage.append(self.name, records)
+        for record in records:
+          journal.apply(self._saved, self._saved_meta, record)
+        # only these and the appended messages are indexed again
+        changed = [record["index"] for record in records if record["op"] == "update"]
+      saved = list(self._saved)
+    self.client.search_index.update(self.name, saved, self.size, changed)
+
+  def load(self, lazy=False) -> None:
+    """Load the conversation from the storage of the client
+
+    Args:
+        lazy (bool, optional): Only read the messages when they are used. Defaults to False.
+    """
+    with self._lock:
+      if lazy:
+        self._messages = None
+        self.stored = True
+      else:
+        self._read()
+
+  def rename(self, name:str) -> None:
+    """Rename the conversation in the storage without rewriting it
+
+    Args:
+        name (str): The new name
+    """
+    with self._lock:
+      old_name = self.name
+      if self.stored:
+        self.client.storage.rename(old_name, name)
+      self.name = name
+    self.client.search_index.rename(old_name, name)
+
+  def unload(self) -> bool:
+    """Drop the messages from memory if they are saved and not in use
+
+    Returns:
+        bool: True if the messages are not in memory anymore
+    """
+    if not self._lock.acquire(blocking=False):
+      return False
     try:
-      with open(self.path, "r", encoding='utf-8') as f:
-        json_str = f.read()
-        self.messages = json.loads(json_str)
-    except FileNotFoundError:
-      pass
+      if self._messages is None:
+        return True
+      if not self.stored:
+        return False
+      if len(journal.diff(self._saved, self._messages)) > 0:
+        return False
+      if len(journal.diff_meta(self._saved_meta, self._meta)) > 0:
+        return False
+      self._messages = None
+      self._meta = {}
+      self._saved = []
+      self._saved_meta = {}
+      self._line_cache = []
+      self._line_offsets = [0]
+      return True
+    finally:
+      self._lock.release()
+
+  def memory(self) -> msg.MemoryReport:
+    """Estimate the memory the conversation uses
+
+    Returns:
+        msg.MemoryReport: The report, empty if the messages are not in memory
+    """
+    report = msg.MemoryReport()
+    with self._lock:
+      messages = self._messages
+      if messages is None:
+        return report
+      report.messages = len(messages)
+      for message in messages:
+        report.resident += msg.resident(message)
+        if isinstance(message, msg.Message) and message.lazy:
+          report.lazy += 1
+          report.mapped += len(message.content_key())
+      for _, wrapped in self._line_cache:
+        if isinstance(wrapped, wrap.WrappedText):
+          report.display += wrapped.memory()
+        elif isinstance(wrapped, wrap.Columns):
+          report.display += sum(column.memory() for column in wrapped.columns)
+    return report
+
+  def _read(self) -> None:
+    """Read the messages from the storage
+    """
+    self._messages = []
+    self._meta = {}
+    self._saved = []
+    self._saved_meta = {}
+    stored = self.client.storage.read(self.name)
+    self.stored = stored is not None
+    if stored is None:
+      return
+    messages, self._meta, self.size = stored
+    self._messages = [msg.Message.of(message) for message in messages]
+    self._saved = [message.copy() for message in self._messages]
+    self._saved_meta = dict(self._meta)
 
   def delete(self) -> None:
-    """Delete the conversation file
+    """Delete the conversation from the storage
     """
-    if len(self.path) <= 0:
-      self.path = functions.get_home_folder() + CONVERSATIONS_FOLDER_PATH + self.name + FILE_EXTENSION
-    if os.path.exists(self.path):
-      os.remove(self.path)
+    with self._lock:
+      self.deleted = True
+      self.client.storage.delete(self.name)
+      if self._messages is None:
+        self._messages = []
+        self._meta = {}
+      self._saved = []
+      self._saved_meta = {}
+      self.stored = False
+    self.client.search_index.remove(self.name)
 
   def add(self, message:dict[str,str]) -> None:
     """Add a message to the conversation
@@ -67,57 +250,240 @@ class Conversation:
   def values(self, scroll_offset:int) -> list[str]:
     """Return the messages in a format suitable for display
 
+    Only the lines inside the view are copied, the wrapped lines of each
+    message are cached and only rebuilt when the message or the width changes.
+
     Returns:
         list[str]: A list of strings to display
     """
-    prefixes = {
-      "user": Lang.cur.conversation_user_prefix,
-      "system": Lang.cur.conversation_system_prefix,
-      "error": Lang.cur.conversation_error_prefix
-    }
-    values:list[str] = ['']
     max_y, max_x = self.client.max_yx()
+    head:list[str] = ['']
     if len(self.messages) <= 0:
-      values.append(Lang.cur.conversation_new_conversation_line1)
-      values.append(Lang.cur.conversation_new_conversation_line2)
-    for message in self.messages:
-      role = message["role"]
-      content = message["content"]
-      first = True
-      prefix = prefixes[role]
-      mx = max_x - len(prefix) - 12
-      lines = []
-      for content_line in content.split("\n"):
-        words = content_line.split(" ")
-        line = ""
-        for word in words:
-          if len(line) + len(word) + 1 < mx:
-            line += word + " "
-          else:
-            lines.append(line)
-            line = word + " "
-        if len(line) > 0:
-          lines.append(line)
-      for line in lines:
-        if first:
-          values.append(prefix + line + " ")
-          first = False
-        else:
-          values.append(" " * len(prefix) + line + " ")
-      if role == "user":
+      head.append(Lang.cur.conversation_new_conversation_line1)
+      head.append(Lang.cur.conversation_new_conversation_line2)
+    self._update_line_cache(max_x)
+    total = len(head) + self._line_offsets[-1] + 1
+    my = max_y - 4
+    if total < my:
+      return self._lines(head, 0, total)
+    start = total - my - scroll_offset
+    if start < 0:
+      start = 0
+    if start + my > total:
+      start = total - my
+    end = start + my
+    return self._lines(head, start, end)
+
+  def scroll_offset_of(self, index:int) -> int:
+    """Get the scroll offset that shows a message at the top of the chat view
+
+    Args:
+        index (int): The message index
+
+    Returns:
+        int: The scroll offset to pass to values
+    """
+    max_y, max_x = self.client.max_yx()
+    self._update_line_cache(max_x)
+    index = min(max(index, 0), len(self._line_cache))
+    total = 1 + self._line_offsets[-1] + 1
+    return max(total - (max_y - 4) - (1 + self._line_offsets[index]), 0)
+
+  def _lines(self, head:list[str], start:int, end:int) -> list[str]:
+    """Copy a range of display lines out of the line cache
+
+    Args:
+        head (list[str]): The lines in front of the first message
+        start (int): The index of the first line
+        end (int): The index after the last line
+
+    Returns:
+        list[str]: The lines from start to end
+    """
+    values:list[str] = []
+    i = start
+    while i < end:
+      if i < len(head):
+        values.append(head[i])
+        i += 1
+        continue
+      j = i - len(head)
+      if j >= self._line_offsets[-1]:
+        values.append(' ')
+        i += 1
+        continue
+      m = bisect.bisect_right(self._line_offsets, j) - 1
+      k = j - self._line_offsets[m]
+      chunk = self._message_lines(m, k, k + end - i)
+      values.extend(chunk)
+      i += len(chunk)
+    return values
+
+  def _update_line_cache(self, max_x:int) -> None:
+    """Wrap new or changed messages and update the line offsets
+
+    Args:
+        max_x (int): The width of the chat view
+    """
+    messages = self.messages
+    cache = self._line_cache
+    if len(cache) > len(messages):
+      del cache[len(messages):]
+    first_changed = len(cache)
+    for i, message in enumerate(messages):
+      entry = self._cache_entry(messages, i, max_x, cache[i] if i < len(cache) else None)
+      if entry is None:
+        continue
+      if i < len(cache):
+        cache[i] = entry
+      else:
+        cache.append(entry)
+      first_changed = min(first_changed, i)
+    offsets = self._line_offsets
+    del offsets[first_changed + 1:]
+    for i in range(first_changed, len(cache)):
+      wrapped = cache[i][1]
+      offsets.append(offsets[i] + (0 if wrapped is None else len(wrapped) + 1))
+
+  def _cache_entry(self, messages:list[dict[str,str]], index:int, max_x:int, old:tuple) -> tuple:
+    """Wrap a message if it changed since it was cached
+
+    The answers of a fan out are shown in columns by the entry of the first
+    answer, the other answers have no lines of their own.
+
+    Args:
+        messages (list[dict[str,str]]): The messages
+        index (int): The message index
+        max_x (int): The width of the chat view
+        old (tuple): The cached key and wrapped lines or None
+
+    Returns:
+        tuple: The new key and wrapped lines, None if the cache entry is still valid
+    """
+    message = messages[index]
+    group = message.get(FAN_OUT_KEY)
+    if group is not None and index > 0 and messages[index - 1].get(FAN_OUT_KEY) == group:
+      key = ("member", msg.content_key(message), max_x)
+      return None if old is not None and old[0] == key else (key, None)
+    if group is not None:
+      answers = [message]
+      for answer in messages[index + 1:]:
+        if answer.get(FAN_OUT_KEY) != group:
+          break
+        answers.append(answer)
+      key = ("fanout", tuple((a.get("model"), a["role"], msg.content_key(a), str(a.get("metrics")), a.get(TRUNCATED_KEY)) for a in answers), max_x)
+      if old is not None and old[0] == key:
+        return None
+      headers, texts = self._columns(answers)
+      if old is not None and old[0][0] == "fanout" and old[0][2] == max_x and len(old[0][1]) == len(answers):
+        old[1].update(headers, texts)
+        return key, old[1]
+      _, indent = self._prefix("system")
+      return key, wrap.Columns(headers, texts, max_x - len(indent) - 12)
+    # the content of a message that is not in memory is only read to wrap it
+    key = (message["role"], msg.content_key(message), max_x, message.get(TRUNCATED_KEY))
+    if old is not None:
+      if old[0] == key:
+        return None
+      if old[0][0] == key[0] and old[0][2] == max_x and key[3] is None and isinstance(key[1], str) and isinstance(old[0][1], str) and key[1].startswith(old[0][1]):
+        # a growing answer, only its last lines are wrapped again
+        old[1].extend(key[1])
+        return key, old[1]
+    return key, self._wrap_message(message, max_x)
+
+  def _columns(self, answers:list[dict]) -> tuple[list[list[str]], list[str|Callable[[], str]]]:
+    """Get the headers and texts of the columns of a fan out
+
+    Args:
+        answers (list[dict]): The answers of the models
+
+    Returns:
+        tuple[list[list[str]], list[str|Callable[[], str]]]: The model name and measurements of every
+          answer and their contents, a function that reads a content that is not in memory
+    """
+    headers:list[list[str]] = []
+    texts:list[str|Callable[[], str]] = []
+    for answer in answers:
+      metrics = answer.get("metrics")
+      if answer["role"] == "error":
+        status = Lang.cur.conversation_error_prefix.strip()
+      elif answer.get(TRUNCATED_KEY) is not None:
+        status = truncated_label(answer[TRUNCATED_KEY])
+      elif metrics is None:
+        status = Lang.cur.conversation_generated_response
+      else:
+        status = Lang.cur.conversation_fan_out_metrics.format(
+          metrics["first_token"],
+          metrics["total"],
+          metrics["tokens_per_second"]
+        )
+      headers.append([str(answer.get("model")), status])
+      texts.append(_content_of(answer))
+    return headers, texts
+
+  def _prefix(self, role:str) -> tuple[str, str]:
+    """Get the text in front of the first line and the following lines of a message
+
+    Args:
+        role (str): The role of the message
+
+    Returns:
+        tuple[str, str]: The prefix and the indentation of the same width
+    """
+    prefix = self._prefixes.get(role)
+    if prefix is None:
+      text = {
+        "user": Lang.cur.conversation_user_prefix,
+        "system": Lang.cur.conversation_system_prefix,
+        "error": Lang.cur.conversation_error_prefix
+      }[role]
+      prefix = (text, " " * wrap.text_width(text))
+      self._prefixes[role] = prefix
+    return prefix
+
+  def _wrap_message(self, message:dict[str,str], max_x:int) -> wrap.WrappedText:
+    """Wrap a message to the width of the chat view
+
+    Args:
+        message (dict[str,str]): A message object with a role and content
+        max_x (int): The width of the chat view
+
+    Returns:
+        wrap.WrappedText: The wrapped content of the message
+    """
+    _, indent = self._prefix(message["role"])
+    content = _content_of(message)
+    if message.get(TRUNCATED_KEY) is not None:
+      label = "\n" + truncated_label(message[TRUNCATED_KEY])
+      if callable(content):
+        read = content
+        content = lambda: read() + label
+      else:
+        content += label
+    return wrap.WrappedText(content, max_x - len(indent) - 12)
+
+  def _message_lines(self, index:int, start:int, end:int) -> list[str]:
+    """Get a range of the display lines of a message
+
+    Args:
+        index (int): The message index
+        start (int): The index of the first line
+        end (int): The index after the last line, the last line of a message is its separator
+
+    Returns:
+        list[str]: The display lines
+    """
+    key, wrapped = self._line_cache[index]
+    if wrapped is None:
+      return []
+    prefix, indent = self._prefix("system" if key[0] == "fanout" else key[0])
+    values = [
+      (prefix if start + i == 0 else indent) + line + " "
+      for i, line in enumerate(wrapped.lines(start, end))
+    ]
+    if end > len(wrapped):
+      if key[0] == "user":
         values.append("\n―――――― ")
       else:
-        hr = "―" * (mx - 3)
-        values.append("\n" + hr + " ")
-    values.append(' ')
-    my = max_y - 4
-    if len(values) < my:
-      return values
-    else:
-      start = len(values) - my - scroll_offset
-      if start < 0:
-        start = 0
-      if start + my > len(values):
-        start = len(values) - my
-      end = start + my
-      return values[start:end]
+        values.append("\n" + "―" * (wrapped.width - 3) + " ")
+    return values
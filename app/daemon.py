@@ -0,0 +1,347 @@
+"""A local daemon that owns the client and serves the chat frontends
+
+`main.py --daemon` builds one Client, which loads the conversations once and
+keeps the connections to the API open, and listens on a Unix domain socket
+in the config folder. Chat frontends connect to it, see remote.py, so they
+start without loading anything and do not write the conversation files
+themselves.
+
+Prompts of all frontends are sent by one RequestPool. The operations that
+change conversations hold one lock, so concurrent edits are serialized
+here, and every save goes through the saver of the client. Conversations
+are named by an id that stays the same when they are renamed, because a
+conversation can be renamed before the frontends got its earlier events.
+The messages of running requests are pushed to every frontend, from the
+first message of the request on, together with a version the frontends use
+to skip events older than what they read.
+"""
+
+
+import os
+import socket
+import threading
+from typing import Any, Callable
+import client as oaic
+import conversation
+import remote
+import worker
+
+
+EVENT_INTERVAL = 0.05 # seconds between pushes of growing answers
+ACCEPT_TIMEOUT = 0.5 # seconds between checks if the daemon is closed
+
+
+class Daemon:
+  """Serves the conversations and requests of a client to the frontends
+  """
+  client:oaic.Client
+  path:str
+  requests:worker.RequestPool
+
+  def __init__(self, client:oaic.Client, path:str=None) -> None:
+    self.client = client
+    self.path = path or remote.socket_path()
+    self.requests = worker.RequestPool(client)
+    self._server:socket.socket = None
+    self._channels:list[remote.Channel] = []
+    self._channels_lock = threading.Lock()
+    self._edit_lock = threading.Lock()
+    # the first message of the running requests and the version of every conversation
+    self._starts:dict[int, int] = {}
+    self._versions:dict[int, int] = {}
+    self._sync_lock = threading.Lock()
+    self._closed = threading.Event()
+    self._ops:dict[str, Callable[..., Any]] = {
+      "hello": self._hello,
+      "read": self._read,
+      "submit": self._submit,
+      "cancel": self._cancel,
+      "rename": self._rename,
+      "delete": self._delete,
+      "search": self._search,
+    }
+
+  def listen(self) -> None:
+    """Create the socket, a socket left by a daemon that crashed is replaced
+
+    Raises:
+        RuntimeError: Another daemon is listening or the system has no Unix sockets
+    """
+    if not hasattr(socket, "AF_UNIX"):
+      raise RuntimeError("Unix domain sockets are not supported on this system")
+    if remote.available(self.path):
+      raise RuntimeError(f"A daemon is already listening on {self.path}")
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(self.path)
+    os.chmod(self.path, 0o600)
+    server.listen()
+    server.settimeout(ACCEPT_TIMEOUT)
+    self._server = server
+    threading.Thread(target=self._publish_events, name="publisher", daemon=True).start()
+
+  def serve_forever(self) -> None:
+    """Accept frontends until the daemon is closed
+    """
+    while not self._closed.is_set():
+      try:
+        sock, _ = self._server.accept()
+      except socket.timeout:
+        continue
+      except OSError:
+        break
+      channel = remote.Channel(sock)
+      with self._channels_lock:
+        self._channels.append(channel)
+      threading.Thread(target=self._serve, args=(channel,), name="frontend", daemon=True).start()
+
+  def close(self) -> None:
+    """Disconnect the frontends, cancel the running requests and save everything
+    """
+    if self._closed.is_set():
+      return
+    self._closed.set()
+    if self._server is not None:
+      self._server.close()
+      if os.path.exists(self.path):
+        os.remove(self.path)
+    with self._channels_lock:
+      channels = list(self._channels)
+    for channel in channels:
+      channel.close()
+    self.requests.shutdown(wait=True)
+    self.client.close()
+
+  def broadcast(self, message:dict) -> None:
+    """Send an event to every frontend, frontends that are gone are dropped
+
+    Args:
+        message (dict): The event
+    """
+    with self._channels_lock:
+      channels = list(self._channels)
+    for channel in channels:
+      try:
+        channel.send(message)
+      except OSError:
+        self._drop(channel)
+
+  def _drop(self, channel:remote.Channel) -> None:
+    """Forget a frontend and close its connection
+
+    Args:
+        channel (remote.Channel): The connection
+    """
+    with self._channels_lock:
+      if channel in self._channels:
+        self._channels.remove(channel)
+    channel.close()
+
+  def _serve(self, channel:remote.Channel) -> None:
+    """Run the operations of a frontend until it disconnects
+
+    Args:
+        channel (remote.Channel): The connection
+    """
+    try:
+      for request in channel.receive():
+        op = self._ops.get(request.get("op"))
+        try:
+          if op is None:
+            raise ValueError(f"Unknown operation {request.get('op')}")
+          reply = {"id": request["id"], "result": op(**request.get("args", {}))}
+        except Exception as e:
+          reply = {"id": request["id"], "error": str(e)}
+        channel.send(reply)
+    except (OSError, ValueError):
+      pass
+    self._drop(channel)
+
+  def _publish_events(self) -> None:
+    """Push the events of the request pool to the frontends
+    """
+    while not self._closed.wait(EVENT_INTERVAL):
+      for event in self.requests.drain():
+        if event.kind == worker.RequestEvent.RENAMED:
+          self.broadcast({
+            "event": remote.EVENT_RENAMED,
+            "id": id(event.conversation),
+            "old": event.conv_key,
+            "new": event.new_key,
+          })
+        else:
+          self.broadcast(self._messages_event(event))
+
+  def _messages_event(self, event:worker.RequestEvent) -> dict:
+    """Get the messages of the requests of a conversation that are running or just finished
+
+    Args:
+        event (worker.RequestEvent): A delta or done event
+
+    Returns:
+        dict: The event for the frontends
+    """
+    conv = event.conversation
+    done = event.kind == worker.RequestEvent.DONE
+    messages = conv.messages
+    with self._sync_lock:
+      start = min(self._starts.get(id(conv), len(messages)), len(messages))
+      version = self._versions.get(id(conv), 0) + 1
+      self._versions[id(conv)] = version
+      in_flight = self.requests.is_in_flight(conv.name)
+      if done and not in_flight:
+        self._starts.pop(id(conv), None)
+    message = {
+      "event": remote.EVENT_MESSAGES,
+      "id": id(conv),
+      "conv": conv.name,
+      "start": start,
+      "messages": [dict(message) for message in messages[start:]],
+      "version": version,
+      "in_flight": in_flight,
+      "done": done,
+    }
+    last = self.client.telemetry.last
+    if done and last is not None:
+      message["metrics"] = last.to_dict()
+      message["percentiles"] = list(self.client.telemetry.percentiles(last.model))
+    return message
+
+  def _conversation(self, conv_id:int) -> conversation.Conversation:
+    """Find a conversation by its id
+
+    Args:
+        conv_id (int): The id the frontends know the conversation by
+
+    Returns:
+        conversation.Conversation: The conversation, None if it was deleted
+    """
+    for conv in list(self.client.conversations.values()):
+      if id(conv) == conv_id:
+        return conv
+    return None
+
+  def _hello(self) -> dict:
+    """Describe the client to a frontend that just connected
+
+    Returns:
+        dict: The names and ids of the conversations, the most recently used
+          first, the compared models and the ids of the conversations waiting
+          for an answer
+    """
+    conversations = self.client.conversations
+    names = [name for name in self.client.recency.names() if name in conversations]
+    return {
+      "conversations": [[name, id(conversations[name])] for name in names],
+      "models": self.client.models,
+      "in_flight": [id(conversations[name]) for name in names if self.requests.is_in_flight(name)],
+    }
+
+  def _read(self, conv_id:int) -> dict:
+    """Read the messages of a conversation
+
+    Args:
+        conv_id (int): The id of the conversation
+
+    Returns:
+        dict: The messages, the metadata and the version of the last event sent
+          for the conversation, None if there is no such conversation
+    """
+    conv = self._conversation(conv_id)
+    if conv is None:
+      return None
+    with self._sync_lock:
+      version = self._versions.get(conv_id, 0)
+      messages = [dict(message) for message in conv.messages]
+    return {"messages": messages, "meta": dict(conv.meta), "version": version}
+
+  def _submit(self, conv_id:int, prompt:str, models:list[str]=None) -> dict:
+    """Queue a prompt and tell the frontends about the conversation
+
+    Args:
+        conv_id (int): The id of the conversation, None or a deleted one for a new conversation
+        prompt (str): The message to send
+        models (list[str], optional): The models to compare. Defaults to None.
+
+    Returns:
+        dict: The key and the id of the conversation
+    """
+    with self._edit_lock:
+      conv = None if conv_id is None else self._conversation(conv_id)
+      with self._sync_lock:
+        start = 0 if conv is None else len(conv.messages)
+        conv_key = self.requests.submit(None if conv is None else conv.name, prompt, models)
+        conv = self.client.conversations[conv_key]
+        self._starts.setdefault(id(conv), start)
+    self.broadcast({"event": remote.EVENT_TOUCHED, "id": id(conv), "conv": conv_key})
+    return {"conv": conv_key, "id": id(conv)}
+
+  def _cancel(self, conv_id:int) -> bool:
+    """Stop the running request of a conversation
+
+    Args:
+        conv_id (int): The id of the conversation
+
+    Returns:
+        bool: True if a running request was cancelled
+    """
+    conv = self._conversation(conv_id)
+    return conv is not None and self.requests.cancel(conv.name)
+
+  def _rename(self, conv_id:int, new_key:str) -> str:
+    """Rename a conversation, the other frontends follow the renamed event
+
+    Args:
+        conv_id (int): The id of the conversation
+        new_key (str): The new name
+
+    Raises:
+        KeyError: There is no such conversation
+
+    Returns:
+        str: The conversation key after renaming
+    """
+    with self._edit_lock:
+      conv = self._conversation(conv_id)
+      if conv is None:
+        raise KeyError(f"No conversation with the id {conv_id}")
+      old_key = conv.name
+      new_key = self.client.rename(old_key, new_key)
+    if new_key != old_key:
+      self.broadcast({"event": remote.EVENT_RENAMED, "id": conv_id, "old": old_key, "new": new_key})
+    return new_key
+
+  def _delete(self, conv_id:int) -> None:
+    """Delete a conversation and tell the frontends
+
+    Args:
+        conv_id (int): The id of the conversation
+    """
+    with self._edit_lock:
+      conv = self._conversation(conv_id)
+      if conv is None:
+        return
+      self.client.delete(conv.name)
+      with self._sync_lock:
+        self._starts.pop(conv_id, None)
+        self._versions.pop(conv_id, None)
+    self.broadcast({"event": remote.EVENT_DELETED, "id": conv_id})
+
+  def _search(self, query:str, limit:int=50) -> list[tuple[int, int, float]]:
+    """Search the messages of all conversations
+
+    Args:
+        query (str): Terms and quoted phrases
+        limit (int, optional): The maximum number of results. Defaults to 50.
+
+    Returns:
+        list[tuple[int, int, float]]: The conversation id, message index and score of every result
+    """
+    conversations = self.client.conversations
+    return [
+      (id(conversations[result.conv_key]), result.index, result.score)
+      for result in self.client.search(query, limit)
+      if result.conv_key in conversations
+    ]
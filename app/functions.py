@@ -3,7 +3,9 @@
 
 
 import os
-from constants import CONVERSATIONS_FOLDER_PATH, FILE_EXTENSION
+import re
+from typing import Iterable
+from constants import CONFIG_FOLDER_PATH, CONVERSATIONS_FOLDER_PATH, FILE_EXTENSION, LEGACY_FILE_EXTENSION, COLD_FILE_EXTENSION
 
 
 def get_home_folder() -> str:
@@ -25,11 +27,39 @@ def create_folder(path:str) -> None:
     os.makedirs(path)
 
 
+def get_config_path(file_name:str) -> str:
+  """Get the path of a file in the config folder
+
+  Args:
+      file_name (str): The file name
+
+  Returns:
+      str: The path to the file
+  """
+  return get_home_folder() + CONFIG_FOLDER_PATH + file_name
+
+
+def get_conversation_path(name:str, extension:str=FILE_EXTENSION) -> str:
+  """Get the path of a conversation file
+
+  Args:
+      name (str): The conversation name
+      extension (str, optional): The file extension. Defaults to FILE_EXTENSION.
+
+  Returns:
+      str: The path to the conversation file
+  """
+  return get_home_folder() + CONVERSATIONS_FOLDER_PATH + name + extension
+
+
 def list_conversation_files() -> dict[str,str]:
   """List the conversation files
 
+  Journal files are preferred over cold journal files and both over legacy
+  JSON files of the same conversation.
+
   Returns:
-      list[str]: A list of conversation file names
+      dict[str,str]: The conversation file paths by conversation name
   """
   path = get_home_folder() + CONVERSATIONS_FOLDER_PATH
   create_folder(path)
@@ -37,7 +67,58 @@ def list_conversation_files() -> dict[str,str]:
   files = os.listdir(path)
   for file in files:
     if file.endswith(FILE_EXTENSION):
-      key = file.replace(FILE_EXTENSION, "")
-      file_path = path + file
-      conversations[key] = file_path
+      key = file[:-len(FILE_EXTENSION)]
+    elif file.endswith(COLD_FILE_EXTENSION):
+      key = file[:-len(COLD_FILE_EXTENSION)]
+      if key in conversations and conversations[key].endswith(FILE_EXTENSION):
+        continue
+    elif file.endswith(LEGACY_FILE_EXTENSION):
+      key = file[:-len(LEGACY_FILE_EXTENSION)]
+      if key in conversations:
+        continue
+    else:
+      continue
+    conversations[key] = path + file
   return conversations
+
+
+def conversation_name(text:str, existing:Iterable[str], max_length:int=25) -> str:
+  """Create an unused UpperCamelCase conversation name from a text
+
+  Args:
+      text (str): The text, e.g. a prompt or a generated name
+      existing (Iterable[str]): The names that are already used
+      max_length (int, optional): The maximum length of the name. Defaults to 25.
+
+  Returns:
+      str: The conversation name
+  """
+  words = re.findall(r"[A-Za-z0-9]+", text.replace("'", ""))
+  name = "".join(word[:1].upper() + word[1:] for word in words)[:max_length]
+  if len(name) <= 0:
+    name = "Chat"
+  return unique_name(name, existing, max_length)
+
+
+def unique_name(name:str, existing:Iterable[str], max_length:int=0) -> str:
+  """Append a number to a name until it is not used yet
+
+  Args:
+      name (str): The wanted name
+      existing (Iterable[str]): The names that are already used
+      max_length (int, optional): The maximum length of the name, 0 for no limit. Defaults to 0.
+
+  Returns:
+      str: The unused name
+  """
+  existing = set(existing)
+  result = name
+  number = 2
+  while result in existing:
+    suffix = str(number)
+    if max_length > 0:
+      result = name[:max_length - len(suffix)] + suffix
+    else:
+      result = name + suffix
+    number += 1
+  return result
@@ -0,0 +1,353 @@
+"""Append-only journal files for conversations
+
+A journal is a JSON lines file. Every line is one record that changes the
+list of messages, so saving a turn only appends a few lines to the file:
+
+  {"op": "append", "message": {...}}
+  {"op": "update", "index": 3, "message": {...}}
+  {"op": "truncate", "length": 2}
+  {"op": "meta", "key": "summary", "value": ...}
+  {"op": "unset", "key": "summary"}
+
+Journals are rewritten with one append record per message (compacted) in the
+background when they contain too many records that are no longer needed.
+Appended records are synced to the disk, rewritten journals are synced
+before they replace the old file.
+
+Answers that are still streamed are saved with a PARTIAL_KEY. Every save of
+a partial answer is appended like any other record, the record it replaces
+stays intact until the journal is compacted. Journals are also compacted
+when the replaced records of partial answers take more space than the rest,
+so a long answer is in the journal about twice at most and not once for
+every save.
+
+Journals can be read lazily: the file is memory mapped and long contents
+stay in it until they are used, see the message module.
+
+Journals that are not written anymore can be compressed with LZMA into a
+cold journal (.jsonl.xz). Cold journals are read like the others, they are
+never appended to.
+"""
+
+
+import os
+import io
+import json
+import lzma
+import mmap
+import threading
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from constants import COLD_FILE_EXTENSION
+import message as msg
+
+
+PARTIAL_KEY = "partial"
+COMPACT_MIN_RECORDS = 64
+COMPACT_RATIO = 2
+COMPACT_MIN_SUPERSEDED = 4096 # bytes of replaced partial answers before they make a journal compacted
+READ_CHUNK_SIZE = 1024 * 1024
+
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compactor")
+
+
+def read(path:str, lazy:bool=False) -> tuple[list[dict[str,str]], dict, int]:
+  """Replay a journal file
+
+  A damaged last line (e.g. from a crash while appending) is ignored.
+
+  Args:
+      path (str): The path to the journal file
+      lazy (bool, optional): Read Message objects that keep long contents in the
+        memory mapped file. Defaults to False.
+
+  Returns:
+      tuple[list[dict[str,str]], dict, int]: The messages, the metadata and the number of records
+  """
+  # a mapped file can not be replaced on Windows, cold journals are compressed
+  if lazy and os.name == "posix" and not path.endswith(COLD_FILE_EXTENSION):
+    return _read_mapped(path)
+  messages:list[dict[str,str]] = []
+  meta:dict = {}
+  records = 0
+  with _open(path) as f:
+    for line in f:
+      if len(line.strip()) <= 0:
+        continue
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      records += 1
+      apply(messages, meta, record)
+  return messages, meta, records
+
+
+def _read_mapped(path:str) -> tuple[list[dict[str,str]], dict, int]:
+  """Replay a memory mapped journal file into Message objects
+
+  The map stays open as long as a message refers to it. Appending to the
+  file or replacing it does not change what is mapped.
+
+  Args:
+      path (str): The path to the journal file
+
+  Returns:
+      tuple[list[dict[str,str]], dict, int]: The messages, the metadata and the number of records
+  """
+  messages:list[dict[str,str]] = []
+  meta:dict = {}
+  records = 0
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size <= 0:
+      return messages, meta, records
+    source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  length = len(source)
+  start = 0
+  while start < length:
+    end = source.find(b"\n", start)
+    if end < 0:
+      end = length
+    try:
+      record = json.loads(source[start:end])
+    except ValueError:
+      # empty or damaged lines
+      start = end + 1
+      continue
+    records += 1
+    if "message" in record:
+      record["message"] = msg.Message.of(record["message"], msg.Span(source, start, end))
+    apply(messages, meta, record)
+    start = end + 1
+  return messages, meta, records
+
+
+def _open(path:str) -> io.TextIOBase:
+  """Open a journal file for reading, cold journals are decompressed
+
+  Args:
+      path (str): The path to the journal file
+
+  Returns:
+      io.TextIOBase: The lines of the journal
+  """
+  if path.endswith(COLD_FILE_EXTENSION):
+    return lzma.open(path, "rt", encoding='utf-8')
+  return open(path, "r", encoding='utf-8')
+
+
+def size(path:str) -> int:
+  """Get the size of a journal, the uncompressed size of a cold journal
+
+  Args:
+      path (str): The path to the journal file
+
+  Returns:
+      int: The size in bytes
+  """
+  if not path.endswith(COLD_FILE_EXTENSION):
+    return os.path.getsize(path)
+  total = 0
+  with lzma.open(path, "rb") as f:
+    while True:
+      chunk = f.read(READ_CHUNK_SIZE)
+      if len(chunk) <= 0:
+        return total
+      total += len(chunk)
+
+
+def apply(messages:list[dict[str,str]], meta:dict, record:dict) -> None:
+  """Apply a record to messages and metadata
+
+  Args:
+      messages (list[dict[str,str]]): The messages to change
+      meta (dict): The metadata to change
+      record (dict): The record
+  """
+  op = record.get("op")
+  if op == "append":
+    messages.append(record["message"])
+  elif op == "update":
+    messages[record["index"]] = record["message"]
+  elif op == "truncate":
+    del messages[record["length"]:]
+  elif op == "meta":
+    meta[record["key"]] = record["value"]
+  elif op == "unset":
+    meta.pop(record["key"], None)
+
+
+def diff(saved:list[dict[str,str]], messages:list[dict[str,str]]) -> list[dict]:
+  """Create the records that turn the saved messages into the current ones
+
+  Args:
+      saved (list[dict[str,str]]): The messages that are already in the journal
+      messages (list[dict[str,str]]): The current messages
+
+  Returns:
+      list[dict]: The records to append
+  """
+  records:list[dict] = []
+  if len(messages) < len(saved):
+    records.append({"op": "truncate", "length": len(messages)})
+  for i in range(min(len(saved), len(messages))):
+    if saved[i] != messages[i]:
+      records.append({"op": "update", "index": i, "message": dict(messages[i])})
+  for message in messages[len(saved):]:
+    records.append({"op": "append", "message": dict(message)})
+  return records
+
+
+def diff_meta(saved:dict, meta:dict) -> list[dict]:
+  """Create the records for the metadata that changed since the last save
+
+  Args:
+      saved (dict): The metadata that is already in the journal
+      meta (dict): The current metadata
+
+  Returns:
+      list[dict]: The records to append
+  """
+  records:list[dict] = []
+  for key, value in meta.items():
+    if key not in saved or saved[key] != value:
+      records.append({"op": "meta", "key": key, "value": value})
+  for key in saved.keys():
+    if key not in meta:
+      records.append({"op": "unset", "key": key})
+  return records
+
+
+def append(path:str, records:list[dict]) -> list[int]:
+  """Append records to a journal file
+
+  Args:
+      path (str): The path to the journal file
+      records (list[dict]): The records to append
+
+  Returns:
+      list[int]: The bytes of every record in the file
+  """
+  if len(records) <= 0:
+    return []
+  # the records are ASCII, characters are bytes
+  lines = [json.dumps(record) + "\n" for record in records]
+  with open(path, "a", encoding='utf-8') as f:
+    f.write("".join(lines))
+    f.flush()
+    os.fsync(f.fileno())
+  return [len(line) for line in lines]
+
+
+def rewrite(path:str, messages:list[dict[str,str]], meta:dict) -> list[int]:
+  """Replace a journal file with one record per message and metadata key
+
+  The new journal is written next to the old one, synced and moved over
+  it, so the file is never left half written or empty.
+
+  Args:
+      path (str): The path to the journal file
+      messages (list[dict[str,str]]): The messages to write
+      meta (dict): The metadata to write
+
+  Returns:
+      list[int]: The bytes of every record written, the messages first
+  """
+  records = [{"op": "append", "message": dict(message)} for message in messages]
+  records += diff_meta({}, meta)
+  lengths:list[int] = []
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w", encoding='utf-8') as f:
+    for record in records:
+      line = json.dumps(record) + "\n"
+      f.write(line)
+      lengths.append(len(line))
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+  sync_folder(os.path.dirname(path))
+  return lengths
+
+
+def compress(path:str, cold_path:str) -> int:
+  """Compress a journal into a cold journal
+
+  The records are kept as they are, so the cold journal has the size and
+  the modification time of the journal once it is decompressed. The journal
+  itself is not removed.
+
+  Args:
+      path (str): The path to the journal file
+      cold_path (str): The path to the cold journal file
+
+  Returns:
+      int: The size of the journal
+  """
+  stat = os.stat(path)
+  with open(path, "rb") as f:
+    data = f.read()
+  tmp_path = cold_path + ".tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(lzma.compress(data))
+    f.flush()
+    os.fsync(f.fileno())
+  os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  os.replace(tmp_path, cold_path)
+  sync_folder(os.path.dirname(cold_path))
+  return len(data)
+
+
+def sync_folder(path:str) -> None:
+  """Sync a folder, so a file that was moved into it stays there after a crash
+
+  Args:
+      path (str): The path to the folder
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    # not every platform and file system can sync folders
+    pass
+  finally:
+    os.close(fd)
+
+
+def needs_compaction(records:int, live_records:int, superseded:int=0, size:int=0) -> bool:
+  """Check if a journal has too many records for its content
+
+  Args:
+      records (int): The number of records in the journal
+      live_records (int): The number of messages and metadata keys
+      superseded (int, optional): The bytes of replaced partial answers. Defaults to 0.
+      size (int, optional): The size of the journal. Defaults to 0.
+
+  Returns:
+      bool: True if the journal should be rewritten
+  """
+  if superseded >= COMPACT_MIN_SUPERSEDED and superseded > size - superseded:
+    return True
+  return records >= COMPACT_MIN_RECORDS and records > live_records * COMPACT_RATIO
+
+
+def compact_later(lock:threading.Lock, saved_state:Callable[[], tuple[str, list[dict[str,str]], dict]],
+                  done:Callable[[list[dict[str,str]], list[int]], None]) -> None:
+  """Rewrite a journal on the background compactor thread
+
+  Args:
+      lock (threading.Lock): The lock that guards writes to the journal
+      saved_state (Callable[[], tuple[str, list[dict[str,str]], dict]]): Returns the path of
+        the journal and the messages and metadata saved in it, called while the lock is held
+      done (Callable[[list[dict[str,str]], list[int]], None]): Called with the messages and the
+        bytes of the records written while the lock is held
+  """
+  def compact() -> None:
+    with lock:
+      path, messages, meta = saved_state()
+      if not os.path.exists(path):
+        return
+      done(messages, rewrite(path, messages, meta))
+  _compactor.submit(compact)
@@ -45,11 +45,19 @@ class LabelsBase:
   main_form_newchat_title = "main_fomr_newchat_title"
   main_form_renamechat_title = "main_form_renamechat_title"
   main_form_deletechat_title = "main_form_deletechat_title"
+  main_form_searchchat_title = "main_form_searchchat_title"
+  main_form_comparechat_title = "main_form_comparechat_title"
+  main_form_searchchat_result_title = "main_form_searchchat_result_title"
+  main_form_searchchat_no_results_title = "main_form_searchchat_no_results_title"
   main_form_deletechat_message = "main_form_deletechat_message"
   main_form_newchat_button = "main_form_newchat_button"
+  main_form_searchchat_button = "main_form_searchchat_button"
+  main_form_comparechat_button = "main_form_comparechat_button"
   main_form_renamechat_button = "main_form_renamechat_button"
   main_form_deletechat_button = "main_form_deletechat_button"
   main_form_quit_button = "main_form_quit_button"
+  main_form_chat_in_flight_prefix = "main_form_chat_in_flight_prefix"
+  main_form_status_line = "main_form_status_line"
   # Conversations
   conversation_new_conversation_line1 = "conversation_new_conversation_line1"
   conversation_new_conversation_line2 = "conversation_new_conversation_line2"
@@ -57,6 +65,9 @@ class LabelsBase:
   conversation_system_prefix = "conversation_system_prefix"
   conversation_error_prefix = "conversation_error_prefix"
   conversation_generated_response = "conversation_generated_response"
+  conversation_fan_out_metrics = "conversation_fan_out_metrics"
+  conversation_truncated_cancelled = "conversation_truncated_cancelled"
+  conversation_truncated_deadline = "conversation_truncated_deadline"
 
 
 class LangEN(LabelsBase):
@@ -73,18 +84,29 @@ class LangEN(LabelsBase):
     self.main_form_newchat_title =    "New Chat:        "
     self.main_form_renamechat_title = "Rename Chat:     "
     self.main_form_deletechat_title = "Delete Chat:     "
+    self.main_form_searchchat_title = "Search:          "
+    self.main_form_comparechat_title = "Compare:         "
+    self.main_form_searchchat_result_title = "Search {0}/{1}:  "
+    self.main_form_searchchat_no_results_title = "No results:      "
     self.main_form_deletechat_message = "type in DELETE to confirm"
     self.main_form_newchat_button =    "[     + New Chat      (^N) ]"
+    self.main_form_searchchat_button = "[       Search        (^F) ]"
+    self.main_form_comparechat_button = "[   Compare Models    (^E) ]"
     self.main_form_renamechat_button = "[     Rename Chat     (^R) ]"
     self.main_form_deletechat_button = "[     Delete Chat     (^D) ]"
     self.main_form_quit_button =       "[        Quit         (^Q) ]"
+    self.main_form_chat_in_flight_prefix = f"{ICON_WAIT} "
+    self.main_form_status_line = "{0}  first {1:.2f}s  total {2:.2f}s (p50 {3:.1f}s p95 {4:.1f}s)  {5:.0f} tok/s  {6}+{7} tok  queue {8:.2f}s  retries {9}"
     # Conversations
     self.conversation_new_conversation_line1 = "    NEW CONVERSATION "
     self.conversation_new_conversation_line2 = "    > waiting for prompt ... "
     self.conversation_user_prefix = f" {ICON_USER} ❭❭ "
     self.conversation_system_prefix = f"    {ICON_AI} ❬❬ "
     self.conversation_error_prefix = f"    {ICON_ERR} !!! "
-    self.conversation_generated_response = f"{ICON_WAIT} GENERATING RESPONSE ..."
+    self.conversation_generated_response = f"{ICON_WAIT} GENERATING RESPONSE ... (^X)"
+    self.conversation_fan_out_metrics = "first {0:.1f}s total {1:.1f}s {2:.0f} tok/s"
+    self.conversation_truncated_cancelled = "[stopped]"
+    self.conversation_truncated_deadline = "[deadline exceeded]"
 
 
 class LangDE(LabelsBase):
@@ -101,18 +123,29 @@ class LangDE(LabelsBase):
     self.main_form_newchat_title =    "Neuer Chat:      "
     self.main_form_renamechat_title = "Chat umbenennen: "
     self.main_form_deletechat_title = "Chat löschen:    "
+    self.main_form_searchchat_title = "Suchen:          "
+    self.main_form_comparechat_title = "Vergleichen:     "
+    self.main_form_searchchat_result_title = "Suche {0}/{1}:   "
+    self.main_form_searchchat_no_results_title = "Keine Treffer:   "
     self.main_form_deletechat_message = "tippe DELETE um zu bestätigen"
     self.main_form_newchat_button =    "[    + Neuer Chat     (^N) ]"
+    self.main_form_searchchat_button = "[       Suchen        (^F) ]"
+    self.main_form_comparechat_button = "[ Modelle vergleichen (^E) ]"
     self.main_form_renamechat_button = "[   Chat umbenennen   (^R) ]"
     self.main_form_deletechat_button = "[     Chat löschen    (^D) ]"
     self.main_form_quit_button =       "[       Beenden       (^Q) ]"
+    self.main_form_chat_in_flight_prefix = f"{ICON_WAIT} "
+    self.main_form_status_line = "{0}  erstes {1:.2f}s  gesamt {2:.2f}s (p50 {3:.1f}s p95 {4:.1f}s)  {5:.0f} tok/s  {6}+{7} tok  Warteschlange {8:.2f}s  Wiederholungen {9}"
     # Conversations
     self.conversation_new_conversation_line1 = "    NEUE KONVERSATION "
     self.conversation_new_conversation_line2 = "    > warte auf Eingabe ... "
     self.conversation_user_prefix = f" {ICON_USER} ❭❭ "
     self.conversation_system_prefix = f"    {ICON_AI} ❬❬ "
     self.conversation_error_prefix = f"    {ICON_ERR} !!! "
-    self.conversation_generated_response = f"{ICON_WAIT} ANTWORT WIRD GENERIERT ..."
+    self.conversation_generated_response = f"{ICON_WAIT} ANTWORT WIRD GENERIERT ... (^X)"
+    self.conversation_fan_out_metrics = "erstes {0:.1f}s ges. {1:.1f}s {2:.0f} tok/s"
+    self.conversation_truncated_cancelled = "[abgebrochen]"
+    self.conversation_truncated_deadline = "[Zeitlimit überschritten]"
 
 
 class LangFR(LabelsBase):
@@ -129,18 +162,29 @@ class LangFR(LabelsBase):
     self.main_form_newchat_title =    "Nouveau chat:    "
     self.main_form_renamechat_title = "Renommer chat:   "
     self.main_form_deletechat_title = "Supprimer chat:  "
+    self.main_form_searchchat_title = "Rechercher:      "
+    self.main_form_comparechat_title = "Comparer:        "
+    self.main_form_searchchat_result_title = "Résultat {0}/{1}:"
+    self.main_form_searchchat_no_results_title = "Aucun résultat:  "
     self.main_form_deletechat_message = "tapez DELETE pour confirmer"
     self.main_form_newchat_button =    "[   + Nouveau Chat    (^N) ]"
+    self.main_form_searchchat_button = "[     Rechercher      (^F) ]"
+    self.main_form_comparechat_button = "[  Comparer modèles   (^E) ]"
     self.main_form_renamechat_button = "[    Renommer Chat    (^R) ]"
     self.main_form_deletechat_button = "[   Supprimer Chat    (^D) ]"
     self.main_form_quit_button =       "[       Quitter       (^Q) ]"
+    self.main_form_chat_in_flight_prefix = f"{ICON_WAIT} "
+    self.main_form_status_line = "{0}  premier {1:.2f}s  total {2:.2f}s (p50 {3:.1f}s p95 {4:.1f}s)  {5:.0f} tok/s  {6}+{7} tok  attente {8:.2f}s  tentatives {9}"
     # Conversations
     self.conversation_new_conversation_line1 = "    NOUVELLE CONVERSATION "
     self.conversation_new_conversation_line2 = "    > en attente de l'invite ... "
     self.conversation_user_prefix = f" {ICON_USER} ❭❭ "
     self.conversation_system_prefix = f"    {ICON_AI} ❬❬ "
     self.conversation_error_prefix = f"    {ICON_ERR} !!! "
-    self.conversation_generated_response = f"{ICON_WAIT} GÉNÉRATION DE LA RÉPONSE ..."
+    self.conversation_generated_response = f"{ICON_WAIT} GÉNÉRATION DE LA RÉPONSE ... (^X)"
+    self.conversation_fan_out_metrics = "1er {0:.1f}s total {1:.1f}s {2:.0f} tok/s"
+    self.conversation_truncated_cancelled = "[arrêtée]"
+    self.conversation_truncated_deadline = "[délai dépassé]"
 
 
 class Labels:
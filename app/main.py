@@ -1,41 +1,126 @@
 #!/usr/bin/env python3
 
 """A ChatGPT Chat Application
+
+Without arguments the chat app is started. With --batch the prompts of a
+JSON lines file (or stdin) are sent without the user interface:
+
+  python app/main.py --batch prompts.jsonl --workers 16 > answers.jsonl
+
+With --daemon the conversations are kept in a background process, chat
+apps started while it runs connect to it and start at once:
+
+  python app/main.py --daemon &
 """
 
 
 import os
-import client as oaic
+import sys
+import signal
+import argparse
+from constants import MAX_REQUESTS_PER_MODEL
 import application
+import batch
+import remote
 from apikeyform import input_openai_api_key
 
 
-def main(*_:list[str]) -> None:
+def run_batch(path:str, output_path:str, workers:int) -> int:
+  """Send the prompts of a JSON lines file and write the answers as JSON lines
+
+  Args:
+      path (str): The input file, - for stdin
+      output_path (str): The output file, - for stdout
+      workers (int): The number of prompts sent at the same time
+
+  Returns:
+      int: The exit code, 1 if a prompt failed
+  """
+  if 'OPENAI_API_KEY' not in os.environ:
+    print("OPENAI_API_KEY is not set. Exiting...", file=sys.stderr)
+    return 2
+  import client as oaic
+  client = oaic.Client()
+  input_file = sys.stdin if path == "-" else open(path, "r", encoding='utf-8')
+  output_file = sys.stdout if output_path == "-" else open(output_path, "w", encoding='utf-8')
+  try:
+    errors = batch.BatchRunner(client, output_file, workers).run(input_file)
+  finally:
+    if input_file is not sys.stdin:
+      input_file.close()
+    if output_file is not sys.stdout:
+      output_file.close()
+  return 1 if errors > 0 else 0
+
+
+def run_daemon() -> int:
+  """Serve the conversations to the chat apps until the process is stopped
+
+  Returns:
+      int: The exit code
+  """
+  if 'OPENAI_API_KEY' not in os.environ:
+    print("OPENAI_API_KEY is not set. Exiting...", file=sys.stderr)
+    return 2
+  import client as oaic
+  import daemon
+  server = daemon.Daemon(oaic.Client())
+  try:
+    server.listen()
+  except (RuntimeError, OSError) as e:
+    print(e, file=sys.stderr)
+    server.close()
+    return 1
+  print(f"Listening on {server.path}", file=sys.stderr)
+  # saves are written when the daemon is terminated as well
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+  return 0
+
+
+def main(*args:str) -> int:
   """The main function
 
   Args:
       args (list[str]): The command line arguments
+
+  Returns:
+      int: The exit code
   """
-  # Check if API Key Env Var exists
-  if 'OPENAI_API_KEY' not in os.environ:
+  parser = argparse.ArgumentParser(description="Chat with the OpenAI chat models")
+  parser.add_argument("--batch", metavar="FILE", help="send the prompts of a JSON lines file without the user interface, - for stdin")
+  parser.add_argument("--output", metavar="FILE", default="-", help="where to write the answers of a batch, - for stdout")
+  parser.add_argument("--workers", type=int, default=MAX_REQUESTS_PER_MODEL, help="the number of prompts of a batch sent at the same time")
+  parser.add_argument("--daemon", action="store_true", help="keep the conversations in a background process the chat apps connect to")
+  arguments = parser.parse_args(args)
+  if arguments.batch is not None:
+    return run_batch(arguments.batch, arguments.output, arguments.workers)
+  if arguments.daemon:
+    return run_daemon()
+  # Check if API Key Env Var exists, the daemon has its own
+  if 'OPENAI_API_KEY' not in os.environ and not remote.available():
     ok_pressed, api_key = input_openai_api_key()
     if ok_pressed:
       os.environ['OPENAI_API_KEY'] = api_key
     else:
       print("No API Key provided. Exiting...")
-      return
+      return 0
   try:
-    client = oaic.Client()
-    app = application.App(client)
-    client.max_yx = app.get_chat_max_yx
-    app.run()
+    # the client is built in the background while the first frame is drawn
+    app = application.App()
+    try:
+      app.run()
+    finally:
+      app.close()
   except KeyboardInterrupt:
     pass
+  return 0
 
 
 if __name__=="__main__":
-  import sys
-  if len(sys.argv) > 1:
-    main(*(sys.argv[1:]))
-  else:
-    main(*[])
+  sys.exit(main(*sys.argv[1:]))
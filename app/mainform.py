@@ -3,9 +3,14 @@
 
 
 import curses
+from typing import Callable
 import npyscreen
 import controls
 import conversation
+import worker
+import search
+import snapshot
+import recency
 import base
 from labels import Lang
 
@@ -19,8 +24,17 @@ class MainForm(base.MainFormBase):
   editw:int
   delete_chat_mode:bool
   rename_chat_mode:bool
+  search_chat_mode:bool
+  compare_chat_mode:bool
+  search_query:str
+  search_results:list[search.SearchResult]
+  search_position:int
   created:bool
+  attached:bool
+  deferred:list[Callable[[], None]]
   new_chat_btn:npyscreen.ButtonPress
+  search_chat_btn:npyscreen.ButtonPress
+  compare_chat_btn:npyscreen.ButtonPress
   rename_chat_btn:npyscreen.ButtonPress
   delete_chat_btn:npyscreen.ButtonPress
   quit_btn:npyscreen.ButtonPress
@@ -31,9 +45,17 @@ class MainForm(base.MainFormBase):
     side_col_width = 30
     self.delete_chat_mode = False
     self.rename_chat_mode = False
+    self.search_chat_mode = False
+    self.compare_chat_mode = False
+    self.search_query = ""
+    self.search_results = []
+    self.search_position = 0
     self.created = False
+    self.attached = False
+    self.deferred = []
     app:base.AppBase = self.find_parent_app()
     y, x = tuple[int, int](self.useable_space())
+    self.chat_max_yx = (y-4, x-side_col_width-5)
     # create input
     self.input:controls.InputField = self.add(
       controls.InputField,
@@ -56,22 +78,39 @@ class MainForm(base.MainFormBase):
       controls.SelectList,
       name=Lang.cur.main_form_chat_list_title,
       custom_highlighting=True,
-      values=app.client.get_conversation(),
       rely=1,
       relx=2,
       max_width=side_col_width,
-      max_height=y-4-3,
+      max_height=y-4-5,
     )
     # create new chat button
     self.new_chat_btn = self.add(
       npyscreen.ButtonPress,
       name=Lang.cur.main_form_newchat_button,
       relx=1,
-      rely=y-3-3,
+      rely=y-3-5,
       max_width=side_col_width,
       when_pressed_function=self.new_chat,
       color="GOOD",
     )
+    # create search button
+    self.search_chat_btn = self.add(
+      npyscreen.ButtonPress,
+      name=Lang.cur.main_form_searchchat_button,
+      relx=1,
+      rely=y-3-4,
+      max_width=side_col_width,
+      when_pressed_function=self.search_chat,
+    )
+    # create compare button
+    self.compare_chat_btn = self.add(
+      npyscreen.ButtonPress,
+      name=Lang.cur.main_form_comparechat_button,
+      relx=1,
+      rely=y-3-3,
+      max_width=side_col_width,
+      when_pressed_function=self.compare_chat,
+    )
     # create rename chat button
     self.rename_chat_btn = self.add(
       npyscreen.ButtonPress,
@@ -103,23 +142,23 @@ class MainForm(base.MainFormBase):
     # add key handlers
     self.chat.scroll_up_callback.append(self.chat_scroll_up)
     self.chat.scroll_down_callback.append(self.chat_scroll_down)
-    app.client.max_yx = lambda: tuple([y-4, x-side_col_width-5])
     self.input.add_handlers({
       curses.ascii.NL: self.input_enter,
     })
-    if app.client.current_conversation is not None:
-      self.chat_list.entry_widget.value = [list(app.client.conversations.keys()).index(app.client.current_conversation)]
-      self.chat.values = app.client.conversations[app.client.current_conversation].values(0)
     self.chat_list.callbacks.append(self.chat_item_selected)
-    # check if conversation list is empty
-    if len(app.client.conversations) <= 0:
-      self.new_chat()
+    if app.client_ready():
+      self.attach()
+    else:
+      self.show_snapshot(app.snapshot)
     # add key handlers
     self.add_handlers({
       #'^T': self.chat_copy,
       "^N": self.new_chat,
+      "^F": self.search_chat,
+      "^E": self.compare_chat,
       "^R": self.rename_chat,
       "^D": self.delete_chat,
+      "^X": self.cancel_request,
       curses.ascii.ESC: self.quit_app,
       "^Q": self.quit_app,
     })
@@ -127,32 +166,103 @@ class MainForm(base.MainFormBase):
     self.editw = 0
     self.created = True
 
+  def show_snapshot(self, snap:snapshot.Snapshot) -> None:
+    """Show the chat list and conversation of the last session until the client is ready
+
+    Args:
+        snap (snapshot.Snapshot): The snapshot written when the app was closed
+    """
+    self.chat_list.source = recency.RecencyIndex(snap.chats)
+    self.chat_list.select(snap.current)
+    # the lines were wrapped for the chat view of the last session
+    if snap.width == self.chat_max_yx[1]:
+      self.chat.values = snap.values
+
+  def attach(self) -> None:
+    """Show the conversations of the client once it is ready and run the actions queued until then
+    """
+    self.attached = True
+    app:base.AppBase = self.find_parent_app()
+    app.client.max_yx = lambda: self.chat_max_yx
+    self.chat_list.source = app.client.recency
+    self.chat_list.select(app.client.current_conversation)
+    self.chat_list.entry_widget.is_in_flight = app.requests.is_in_flight
+    if app.client.current_conversation is not None:
+      values = app.client.conversations[app.client.current_conversation].values(0)
+    else:
+      # check if conversation list is empty
+      values = self.show_new_chat()
+    if self.created:
+      self.chat.redraw(values)
+    else:
+      self.chat.values = values
+    deferred, self.deferred = self.deferred, []
+    for action in deferred:
+      action()
+
   def new_chat(self, _:str=None) -> bool:
     """Create a new chat
     """
+    if not self.defer(lambda: self.chat.redraw(self.show_new_chat())):
+      self.chat.redraw(self.show_new_chat())
+    self.editw = 0
+    if self.created:
+      self.input.edit()
+
+  def show_new_chat(self) -> list[str]:
+    """Clear the input for the first prompt of a new chat
+
+    Returns:
+        list[str]: The lines of the empty conversation
+    """
     app = self.find_parent_app()
     app.client.current_conversation = None
     self.input.value = ""
     self.input.label_widget.value = Lang.cur.main_form_newchat_title
     self.input.display()
-    newcon = conversation.Conversation("new", self.find_parent_app().client)
-    self.chat.values = newcon.values(0)
-    self.chat.clear()
-    self.chat.display()
-    self.editw = 0
-    if self.created:
-      self.input.edit()
+    newcon = conversation.Conversation("new", app.client)
+    return newcon.values(0)
 
   def rename_chat(self, _:str=None) -> bool:
     """Rename the chat
     """
     self.rename_chat_mode = True
     self.input.label_widget.value = Lang.cur.main_form_renamechat_title
-    self.input.value = self.find_parent_app().client.current_conversation
+    app:base.AppBase = self.find_parent_app()
+    # the chat list shows the current chat of the snapshot until the client is ready
+    self.input.value = app.client.current_conversation if app.client_ready() else self.chat_list.entry_widget.selected_itm
     self.input.display()
     if self.created:
       self.input.edit()
 
+  def search_chat(self, _:str=None) -> bool:
+    """Search the messages of all chats
+    """
+    self.search_chat_mode = True
+    self.input.label_widget.value = Lang.cur.main_form_searchchat_title
+    self.input.value = self.search_query
+    self.input.display()
+    self.editw = 0
+    if self.created:
+      self.input.edit()
+
+  def compare_chat(self, _:str=None) -> bool:
+    """Send the next prompt to all compared models
+    """
+    self.compare_chat_mode = True
+    self.input.label_widget.value = Lang.cur.main_form_comparechat_title
+    self.input.display()
+    self.editw = 0
+    if self.created:
+      self.input.edit()
+
+  def cancel_request(self, _:str=None) -> bool:
+    """Stop the answer of the current chat, the text so far is kept
+    """
+    app:base.AppBase = self.find_parent_app()
+    if app.client_ready() and app.client.current_conversation is not None:
+      app.requests.cancel(app.client.current_conversation)
+
   def delete_chat(self, _:str=None) -> bool:
     """Delete the chat
     """
@@ -167,27 +277,29 @@ class MainForm(base.MainFormBase):
   def chat_scroll_up(self) -> None:
     """Scroll the chat view up
     """
-    self.input.scroll_offset += 1
     app:base.AppBase = self.find_parent_app()
+    # the snapshot only has the last lines of the chat
+    if not app.client_ready():
+      return
+    self.input.scroll_offset += 1
     if app.client.current_conversation is None:
       return
     conv = app.client.conversations[app.client.current_conversation]
-    self.chat.values = conv.values(self.input.scroll_offset)
     self.chat.entry_widget.value = []
-    self.chat.clear()
-    self.chat.display()
+    self.chat.redraw(conv.values(self.input.scroll_offset))
 
   def chat_scroll_down(self) -> None:
     """Scroll the chat view down
     """
-    self.input.scroll_offset -= 1
     app:base.AppBase = self.find_parent_app()
+    if not app.client_ready():
+      return
+    self.input.scroll_offset -= 1
     if app.client.current_conversation is None:
       return
     conv = app.client.conversations[app.client.current_conversation]
-    self.chat.values = conv.values(self.input.scroll_offset)
     self.chat.entry_widget.value = []
-    self.chat.display()
+    self.chat.redraw(conv.values(self.input.scroll_offset))
 
   def chat_item_selected(self, item:str) -> bool:
     """Handle the chat item selected event
@@ -198,17 +310,219 @@ class MainForm(base.MainFormBase):
     Returns:
         bool: Always True
     """
+    if self.defer(lambda: self.chat_item_selected(item)):
+      return True
     app:base.AppBase = self.find_parent_app()
+    if item not in app.client.conversations:
+      # the startup list can show a chat that was renamed or deleted since
+      self.chat_list.source = app.client.recency
+      self.update_chat_list()
+      return True
     app.client.current_conversation = item
     self.input.scroll_offset = 0
     conv = app.client.conversations[item]
-    self.chat.values = conv.values(0)
     self.chat.entry_widget.value = []
-    self.chat.clear()
-    self.chat.display()
+    self.chat.redraw(conv.values(0))
     self.chat.cursol_line = len(self.chat.values) - 1
     return True
 
+  def show_message(self, conv_key:str, index:int) -> None:
+    """Open a chat and scroll to a message
+
+    Args:
+        conv_key (str): The conversation key
+        index (int): The message index
+    """
+    app:base.AppBase = self.find_parent_app()
+    app.client.current_conversation = conv_key
+    self.update_chat_list()
+    conv = app.client.conversations[conv_key]
+    self.input.scroll_offset = conv.scroll_offset_of(index)
+    self.chat.entry_widget.value = []
+    self.chat.redraw(conv.values(self.input.scroll_offset))
+
+  def search_enter(self, query:str) -> bool:
+    """Jump to the next message matching the search query
+
+    Args:
+        query (str): The query
+
+    Returns:
+        bool: False if the search mode was left
+    """
+    app:base.AppBase = self.find_parent_app()
+    query = query.strip()
+    if len(query) <= 0:
+      self.search_query = ""
+      self.search_results = []
+      return False
+    if self.defer(lambda: self.search_chat_mode and self.search_enter(query) and self.input.display()):
+      return True
+    if query != self.search_query:
+      self.search_query = query
+      self.search_results = app.client.search(query)
+      self.search_position = 0
+    else:
+      self.search_position += 1
+    if len(self.search_results) <= 0:
+      self.input.label_widget.value = Lang.cur.main_form_searchchat_no_results_title
+      return True
+    self.search_position %= len(self.search_results)
+    result = self.search_results[self.search_position]
+    if result.conv_key in app.client.conversations:
+      self.show_message(result.conv_key, result.index)
+    self.input.label_widget.value = Lang.cur.main_form_searchchat_result_title.format(
+      self.search_position + 1,
+      len(self.search_results)
+    )
+    return True
+
+  def while_waiting(self) -> None:
+    """Apply the events of background requests to the form
+    """
+    app:base.AppBase = self.find_parent_app()
+    if not self.attached:
+      if not app.client_ready():
+        return
+      self.attach()
+    for event in app.requests.drain():
+      if event.kind == worker.RequestEvent.DELTA:
+        self.request_delta(event)
+      elif event.kind == worker.RequestEvent.RENAMED:
+        self.conversation_renamed(event)
+      else:
+        self.request_done(event)
+
+  def is_current(self, conv:conversation.Conversation, conv_key:str=None) -> bool:
+    """Check if a conversation is the one shown in the chat view
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        conv_key (str, optional): The key of the conversation when the event was posted. Defaults to None.
+
+    Returns:
+        bool: True if the conversation is open
+    """
+    app:base.AppBase = self.find_parent_app()
+    current = app.client.current_conversation
+    if current is None:
+      return False
+    found = app.client.conversations.get(current)
+    # it may be renamed in the background before the renamed event is handled
+    return found is conv or (found is None and current == conv_key)
+
+  def request_delta(self, event:worker.RequestEvent) -> None:
+    """Show the growing answer if its conversation is open
+
+    Args:
+        event (worker.RequestEvent): The delta event
+    """
+    if not self.is_current(event.conversation, event.conv_key):
+      return
+    self.chat.redraw(event.conversation.values(self.input.scroll_offset))
+
+  def request_done(self, event:worker.RequestEvent) -> None:
+    """Update the chat list, chat view and status line after a request finished
+
+    Args:
+        event (worker.RequestEvent): The done event
+    """
+    self.update_chat_list()
+    self.update_status()
+    if self.is_current(event.conversation, event.conv_key):
+      values = event.conversation.values(self.input.scroll_offset)
+      self.chat.entry_widget.value = []
+      self.chat.entry_widget.cursor_line = len(values) - 1 - 1
+      self.chat.redraw(values)
+
+  def conversation_renamed(self, event:worker.RequestEvent) -> None:
+    """Follow a conversation that was renamed in the background
+
+    Args:
+        event (worker.RequestEvent): The renamed event
+    """
+    app:base.AppBase = self.find_parent_app()
+    if app.client.current_conversation == event.conv_key:
+      app.client.current_conversation = event.new_key
+    self.update_chat_list()
+
+  def update_status(self) -> None:
+    """Show the measurements of the last request and the latencies of its model in the chat view footer
+    """
+    app:base.AppBase = self.find_parent_app()
+    metrics = app.client.telemetry.last
+    if metrics is None:
+      return
+    p50, p95 = app.client.telemetry.percentiles(metrics.model)
+    self.chat.footer = Lang.cur.main_form_status_line.format(
+      metrics.model,
+      metrics.first_token,
+      metrics.total,
+      p50,
+      p95,
+      metrics.tokens_per_second,
+      metrics.prompt_tokens,
+      metrics.completion_tokens,
+      metrics.queued or 0.0,
+      metrics.retries
+    )
+    self.chat.display()
+
+  def update_chat_list(self) -> None:
+    """Show the current conversation names and select the current conversation
+    """
+    app:base.AppBase = self.find_parent_app()
+    self.chat_list.select(app.client.current_conversation)
+
+  def defer(self, action:Callable[[], None]) -> bool:
+    """Queue an action that needs the client until the client is attached
+
+    The queued actions run in order when the client is attached, so a key
+    pressed during the startup does not wait for the client.
+
+    Args:
+        action (Callable[[], None]): The action
+
+    Returns:
+        bool: True if the action was queued, False if the client is ready and it has to run now
+    """
+    if self.attached:
+      return False
+    self.deferred.append(action)
+    return True
+
+  def rename_current(self, name:str) -> None:
+    """Rename the current chat
+
+    Args:
+        name (str): The new name
+    """
+    app:base.AppBase = self.find_parent_app()
+    if app.client.current_conversation is not None:
+      if app.client.current_conversation in app.client.conversations:
+        if app.client.current_conversation != name:
+          app.client.current_conversation = app.client.rename(app.client.current_conversation, name)
+          self.chat_list.select(app.client.current_conversation)
+
+  def delete_current(self, confirmation:str) -> None:
+    """Delete the current chat and open the most recent one
+
+    Args:
+        confirmation (str): The input, the chat is only deleted if it is "DELETE"
+    """
+    app:base.AppBase = self.find_parent_app()
+    if app.client.current_conversation is not None:
+      if app.client.current_conversation in app.client.conversations:
+        if confirmation == "DELETE":
+          app.client.delete(app.client.current_conversation)
+          app.client.current_conversation = app.client.recency.first()
+          self.chat_list.select(app.client.current_conversation)
+          if app.client.current_conversation is not None:
+            self.chat.entry_widget.value = []
+            self.chat.redraw(app.client.conversations[app.client.current_conversation].values(0))
+          else:
+            self.new_chat()
+
   def quit_app(self, _:str=None) -> bool:
     """Quit the application
 
@@ -230,9 +544,7 @@ class MainForm(base.MainFormBase):
     Returns:
         bool: Always True
     """
-    self.chat.values.append("You pressed ^K")
-    self.chat.clear()
-    self.chat.display()
+    self.chat.redraw(self.chat.values + ["You pressed ^K"])
     return True
 
   def input_enter(self, _:str=None) -> bool:
@@ -244,49 +556,31 @@ class MainForm(base.MainFormBase):
     Returns:
         bool: Always True
     """
+    value = self.input.value
+    app:base.AppBase = self.find_parent_app()
     if self.rename_chat_mode:
-      app = self.find_parent_app()
-      if app.client.current_conversation is not None:
-        if app.client.current_conversation in app.client.conversations:
-          if app.client.current_conversation != self.input.value:
-            conv = app.client.conversations[app.client.current_conversation]
-            app.client.conversations.pop(app.client.current_conversation)
-            conv.delete()
-            conv.name = self.input.value
-            app.client.conversations[conv.name] = conv
-            conv.save()
-            app.client.current_conversation = conv.name
-            self.chat_list.values = app.client.get_conversation()
-            self.chat_list.entry_widget.value = [list(app.client.conversations.keys()).index(app.client.current_conversation)]
-            self.chat_list.display()
+      if not self.defer(lambda: self.rename_current(value)):
+        self.rename_current(value)
       self.rename_chat_mode = False
 
+    elif self.search_chat_mode:
+      if self.search_enter(value):
+        self.input.display()
+        return True
+      self.search_chat_mode = False
+
     elif self.delete_chat_mode:
-      app = self.find_parent_app()
-      if app.client.current_conversation is not None:
-        if app.client.current_conversation in app.client.conversations:
-          if self.input.value == "DELETE":
-            conv = app.client.conversations[app.client.current_conversation]
-            app.client.conversations.pop(app.client.current_conversation)
-            conv.delete()
-            if len(app.client.conversations) > 0:
-              app.client.current_conversation = list(app.client.conversations.keys())[0]
-              self.chat_list.values = app.client.get_conversation()
-              self.chat_list.entry_widget.value = [list(app.client.conversations.keys()).index(app.client.current_conversation)]
-              self.chat_list.display()
-              self.chat.values = app.client.conversations[app.client.current_conversation].values(0)
-              self.chat.entry_widget.value = []
-              self.chat.display()
-            else:
-              app.client.current_conversation = None
-              self.chat_list.values = []
-              self.chat_list.entry_widget.value = []
-              self.chat_list.display()
-              self.new_chat()
+      if not self.defer(lambda: self.delete_current(value)):
+        self.delete_current(value)
       self.delete_chat_mode = False
 
-    else:
-      self.input.invoke()
+    elif self.compare_chat_mode:
+      if not self.defer(lambda: self.input.invoke(app.client.models, value)):
+        self.input.invoke(app.client.models, value)
+      self.compare_chat_mode = False
+
+    elif not self.defer(lambda: self.input.invoke(prompt=value)):
+      self.input.invoke(prompt=value)
 
     self.input.label_widget.value = Lang.cur.main_form_prompt_title
     self.input.value = ""
@@ -0,0 +1,292 @@
+"""A compact representation of the messages of a conversation
+
+Messages read from a journal are Message objects instead of dicts. They
+behave like the dict of the message, but have slots for the role, which is
+interned, and the content. The other keys (model, metrics, ...) are only
+kept in a dict if a message has any.
+
+Long contents stay in the memory mapped journal file until they are used.
+Such a message only keeps where its record is in the file and reads the
+content from there when it is used. Only the last DECODED_CONTENTS contents
+that were read are kept, so a content that is used again right away, e.g.
+while the chat view is scrolled, is not decoded again. The chat view keeps
+the wrapped lines of short contents and reads long ones again for the lines
+it shows, to_api_messages creates the dicts that are sent.
+"""
+
+
+import sys
+import json
+import mmap
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Iterator
+from constants import LAZY_CONTENT_MIN_CHARS, DECODED_CONTENTS
+
+
+ROLE = "role"
+CONTENT = "content"
+
+_decoded:OrderedDict["Span", str] = OrderedDict()
+_decoded_lock = threading.Lock()
+
+
+class Span:
+  """Where the record of a message is in a memory mapped journal file
+  """
+  __slots__ = ("source", "start", "end")
+  source:mmap.mmap
+  start:int
+  end:int
+
+  def __init__(self, source:mmap.mmap, start:int, end:int) -> None:
+    self.source = source
+    self.start = start
+    self.end = end
+
+  def __eq__(self, other:object) -> bool:
+    return isinstance(other, Span) and self.source is other.source and self.start == other.start and self.end == other.end
+
+  def __hash__(self) -> int:
+    return hash((id(self.source), self.start, self.end))
+
+  def __len__(self) -> int:
+    return self.end - self.start
+
+  def read(self) -> str:
+    """Read the content from the record, the recently read contents are kept decoded
+
+    Returns:
+        str: The content
+    """
+    with _decoded_lock:
+      content = _decoded.get(self)
+      if content is not None:
+        _decoded.move_to_end(self)
+        return content
+    content = json.loads(self.source[self.start:self.end])["message"][CONTENT]
+    with _decoded_lock:
+      _decoded[self] = content
+      while len(_decoded) > DECODED_CONTENTS:
+        _decoded.popitem(last=False)
+    return content
+
+
+class Message(MutableMapping):
+  """A message with a role and content that behaves like its dict
+  """
+  __slots__ = ("role", "_content", "_extra")
+  role:str
+
+  def __init__(self, role:str, content:str|Span, extra:dict=None) -> None:
+    self.role = sys.intern(role)
+    self._content = content
+    self._extra = extra or None
+
+  @classmethod
+  def of(cls, data:dict, span:Span=None) -> "Message":
+    """Create a message from its dict
+
+    Args:
+        data (dict): The message
+        span (Span, optional): The record of the message, used for long contents. Defaults to None.
+
+    Returns:
+        Message: The message, data itself if it is a Message
+    """
+    if isinstance(data, Message):
+      return data
+    content = data[CONTENT]
+    if span is not None and len(content) >= LAZY_CONTENT_MIN_CHARS:
+      content = span
+    extra = {key: value for key, value in data.items() if key != ROLE and key != CONTENT}
+    return cls(data[ROLE], content, extra)
+
+  @property
+  def content(self) -> str:
+    """The content, read from the journal file if it is not in memory
+    """
+    content = self._content
+    if isinstance(content, Span):
+      return content.read()
+    return content
+
+  @content.setter
+  def content(self, content:str) -> None:
+    self._content = content
+
+  @property
+  def lazy(self) -> bool:
+    """True if the content is not in memory
+    """
+    return isinstance(self._content, Span)
+
+  def content_key(self) -> str|Span:
+    """Get a value that is equal for equal contents without reading the content
+
+    Returns:
+        str|Span: The record of a content that is not in memory, else the content
+    """
+    return self._content
+
+  def __getitem__(self, key:str) -> Any:
+    if key == CONTENT:
+      return self.content
+    if key == ROLE:
+      return self.role
+    if self._extra is None:
+      raise KeyError(key)
+    return self._extra[key]
+
+  def __setitem__(self, key:str, value:Any) -> None:
+    if key == CONTENT:
+      self._content = value
+    elif key == ROLE:
+      self.role = sys.intern(value)
+    elif self._extra is None:
+      self._extra = {key: value}
+    else:
+      self._extra[key] = value
+
+  def __delitem__(self, key:str) -> None:
+    if key == CONTENT or key == ROLE or self._extra is None:
+      raise KeyError(key)
+    del self._extra[key]
+    if len(self._extra) <= 0:
+      self._extra = None
+
+  def __iter__(self) -> Iterator[str]:
+    yield ROLE
+    yield CONTENT
+    if self._extra is not None:
+      yield from list(self._extra)
+
+  def __len__(self) -> int:
+    return 2 + (0 if self._extra is None else len(self._extra))
+
+  def __contains__(self, key:object) -> bool:
+    return key == ROLE or key == CONTENT or (self._extra is not None and key in self._extra)
+
+  def __eq__(self, other:object) -> bool:
+    if isinstance(other, Message):
+      if self.role != other.role or (self._extra or {}) != (other._extra or {}):
+        return False
+      if self._content is other._content or self._content == other._content:
+        return True
+      return self.content == other.content
+    if isinstance(other, dict):
+      return self.to_dict() == other
+    return NotImplemented
+
+  __hash__ = None
+
+  def __repr__(self) -> str:
+    return f"Message({self.to_dict()!r})"
+
+  def copy(self) -> "Message":
+    """Copy the message, a content that is not in memory is not read
+
+    Returns:
+        Message: The copy
+    """
+    return Message(self.role, self._content, None if self._extra is None else dict(self._extra))
+
+  def to_dict(self) -> dict:
+    """Convert the message to a dict, e.g. to write it to a journal
+
+    Returns:
+        dict: The message
+    """
+    data = {ROLE: self.role, CONTENT: self.content}
+    if self._extra is not None:
+      data.update(self._extra)
+    return data
+
+  def resident(self) -> int:
+    """Estimate the bytes of memory the message uses
+
+    Returns:
+        int: The size of the object, its extra keys and a content in memory
+    """
+    size = sys.getsizeof(self)
+    if not self.lazy:
+      size += sys.getsizeof(self._content)
+    if self._extra is not None:
+      size += sys.getsizeof(self._extra) + sum(sys.getsizeof(value) for value in self._extra.values())
+    return size
+
+
+def copy(message:dict) -> dict:
+  """Copy a message without reading a content that is not in memory
+
+  Args:
+      message (dict): A dict or a Message
+
+  Returns:
+      dict: The copy
+  """
+  if isinstance(message, Message):
+    return message.copy()
+  return dict(message)
+
+
+def content_key(message:dict) -> str|Span:
+  """Get a value that is equal for equal contents without reading the content
+
+  Args:
+      message (dict): A dict or a Message
+
+  Returns:
+      str|Span: The record of a content that is not in memory, else the content
+  """
+  if isinstance(message, Message):
+    return message.content_key()
+  return message[CONTENT]
+
+
+def resident(message:dict) -> int:
+  """Estimate the bytes of memory a message uses
+
+  Args:
+      message (dict): A dict or a Message
+
+  Returns:
+      int: The size of the message and its values
+  """
+  if isinstance(message, Message):
+    return message.resident()
+  return sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values())
+
+
+class MemoryReport:
+  """The memory a loaded conversation uses
+  """
+  messages:int
+  lazy:int
+  resident:int
+  mapped:int
+  display:int
+
+  def __init__(self, messages:int=0, lazy:int=0, resident:int=0, mapped:int=0, display:int=0) -> None:
+    self.messages = messages
+    self.lazy = lazy
+    self.resident = resident
+    self.mapped = mapped
+    self.display = display
+
+  def to_dict(self) -> dict:
+    """Convert the report to a JSON serializable dict
+
+    Returns:
+        dict: The number of messages, the ones with their content in the file,
+          the estimated bytes of the messages and the wrapped lines in memory and
+          the bytes of the records in the file
+    """
+    return {
+      "messages": self.messages,
+      "lazy": self.lazy,
+      "resident": self.resident,
+      "mapped": self.mapped,
+      "display": self.display,
+    }
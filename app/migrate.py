@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Copies the conversations from one storage to another
+
+Moving the conversations from the files in ~/.openai-chat/conversations
+(journals and legacy JSON files) to the SQLite database:
+
+  python app/migrate.py --to sqlite
+
+Afterwards start the app with OPENAI_CHAT_STORAGE=sqlite.
+"""
+
+
+import sys
+import argparse
+import storage
+
+
+def migrate(source:storage.Storage, target:storage.Storage, overwrite:bool=False) -> tuple[int, int]:
+  """Copy all conversations of a storage into another one
+
+  Args:
+      source (storage.Storage): The storage to read
+      target (storage.Storage): The storage to write
+      overwrite (bool, optional): Replace conversations that exist in the target. Defaults to False.
+
+  Returns:
+      tuple[int, int]: The numbers of copied and skipped conversations
+  """
+  existing = target.entries()
+  copied = 0
+  skipped = 0
+  for name in source.entries().keys():
+    if name in existing and not overwrite:
+      skipped += 1
+      continue
+    stored = source.read(name)
+    if stored is None:
+      skipped += 1
+      continue
+    messages, meta, _ = stored
+    target.write(name, messages, meta)
+    copied += 1
+  return copied, skipped
+
+
+def main(*args:str) -> int:
+  """The main function
+
+  Args:
+      args (list[str]): The command line arguments
+
+  Returns:
+      int: The exit code
+  """
+  parser = argparse.ArgumentParser(description="Copy conversations between storages")
+  parser.add_argument("--to", choices=[storage.SQLITE, storage.FILES], default=storage.SQLITE, help="the target storage")
+  parser.add_argument("--overwrite", action="store_true", help="replace conversations that exist in the target")
+  arguments = parser.parse_args(args)
+  kind = storage.FILES if arguments.to == storage.SQLITE else storage.SQLITE
+  source = storage.open_storage(kind)
+  target = storage.open_storage(arguments.to)
+  try:
+    copied, skipped = migrate(source, target, arguments.overwrite)
+  finally:
+    source.close()
+    target.close()
+  print(f"Copied {copied} conversations from {kind} to {arguments.to}, skipped {skipped}.")
+  if arguments.to == storage.SQLITE:
+    print("Start the app with OPENAI_CHAT_STORAGE=sqlite to use them.")
+  return 0
+
+
+if __name__=="__main__":
+  sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,134 @@
+"""An index of the conversations ordered by their last activity
+
+The most recently used conversation comes first. The position of every name
+is kept in a dict, so looking one up does not search the list, and using a
+conversation only renumbers the names in front of it. The chat list reads
+the index one page at a time.
+"""
+
+
+import threading
+
+
+class RecencyIndex:
+  """Conversation names ordered by last activity, the most recent first
+  """
+
+  def __init__(self, names:list[str]=None) -> None:
+    self._order:list[str] = list(names or [])
+    self._positions:dict[str, int] = {name: i for i, name in enumerate(self._order)}
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self._order)
+
+  def __contains__(self, name:str) -> bool:
+    return name in self._positions
+
+  def load(self, activity:dict[str, float]) -> None:
+    """Replace the index with conversations sorted by their last activity
+
+    Args:
+        activity (dict[str, float]): The time of the last change of every conversation by name
+    """
+    order = sorted(activity.keys(), key=lambda name: (-activity[name], name))
+    with self._lock:
+      self._order = order
+      self._positions = {name: i for i, name in enumerate(order)}
+
+  def touch(self, name:str) -> None:
+    """Move a conversation to the front, adding it if it is new
+
+    Args:
+        name (str): The conversation name
+    """
+    with self._lock:
+      position = self._positions.get(name)
+      if position == 0:
+        return
+      if position is None:
+        self._order.insert(0, name)
+        position = len(self._order) - 1
+      else:
+        del self._order[position]
+        self._order.insert(0, name)
+      self._renumber(0, position + 1)
+
+  def rename(self, old_name:str, new_name:str) -> None:
+    """Rename a conversation without changing its position
+
+    Args:
+        old_name (str): The current name
+        new_name (str): The new name
+    """
+    with self._lock:
+      position = self._positions.pop(old_name, None)
+      if position is None:
+        return
+      self._order[position] = new_name
+      self._positions[new_name] = position
+
+  def remove(self, name:str) -> None:
+    """Remove a deleted conversation
+
+    Args:
+        name (str): The conversation name
+    """
+    with self._lock:
+      position = self._positions.pop(name, None)
+      if position is None:
+        return
+      del self._order[position]
+      self._renumber(position, len(self._order))
+
+  def position(self, name:str) -> int:
+    """Get the position of a conversation
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        int: The position, 0 for the most recent conversation, None if it is unknown
+    """
+    return self._positions.get(name)
+
+  def first(self) -> str:
+    """Get the most recent conversation
+
+    Returns:
+        str: The conversation name or None if there are no conversations
+    """
+    with self._lock:
+      return self._order[0] if len(self._order) > 0 else None
+
+  def page(self, start:int, count:int) -> list[str]:
+    """Get a page of conversation names
+
+    Args:
+        start (int): The position of the first name
+        count (int): The maximum number of names
+
+    Returns:
+        list[str]: The names, the most recent first
+    """
+    with self._lock:
+      return self._order[start:start + count]
+
+  def names(self) -> list[str]:
+    """Get all conversation names
+
+    Returns:
+        list[str]: The names, the most recent first
+    """
+    with self._lock:
+      return list(self._order)
+
+  def _renumber(self, start:int, end:int) -> None:
+    """Store the positions of the names that moved
+
+    Args:
+        start (int): The first position that changed
+        end (int): The position after the last one that changed
+    """
+    for i in range(start, end):
+      self._positions[self._order[i]] = i
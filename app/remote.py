@@ -0,0 +1,554 @@
+"""Chat frontends that use the client of the daemon over a Unix socket
+
+When `main.py --daemon` runs, the chat app connects to its socket instead
+of building a client of its own. RemoteClient has the parts of the client
+the user interface uses: the chat list, the conversations, search, rename
+and delete. Messages are read from the daemon when a conversation is
+opened, RemoteRequests sends the prompts and turns the messages the daemon
+pushes for running requests into the events of a RequestPool.
+
+Every line on the socket is a JSON object. A frontend sends requests
+{"id", "op", "args"} and gets {"id", "result"} or {"id", "error"} back,
+events have an "event" instead and are sent to every frontend.
+
+This module does not import the OpenAI SDK.
+"""
+
+
+import os
+import json
+import queue
+import socket
+import threading
+from typing import Any, Callable, Iterator
+from constants import DAEMON_SOCKET_NAME
+import functions
+import conversation
+import recency
+import search
+import storage
+import telemetry
+import worker
+import base
+
+
+EVENT_TOUCHED = "touched"
+EVENT_MESSAGES = "messages"
+EVENT_RENAMED = "renamed"
+EVENT_DELETED = "deleted"
+
+
+def socket_path() -> str:
+  """Get the path of the socket of the daemon
+
+  Returns:
+      str: The path in the config folder
+  """
+  return functions.get_config_path(DAEMON_SOCKET_NAME)
+
+
+class Channel:
+  """A socket connection that sends and receives JSON lines
+  """
+  sock:socket.socket
+
+  def __init__(self, sock:socket.socket) -> None:
+    self.sock = sock
+    self._reader = sock.makefile("rb")
+    self._lock = threading.Lock()
+
+  def send(self, message:dict) -> None:
+    """Send a message, safe to call from several threads
+
+    Args:
+        message (dict): A JSON serializable message
+    """
+    data = (json.dumps(message) + "\n").encode('utf-8')
+    with self._lock:
+      self.sock.sendall(data)
+
+  def receive(self) -> Iterator[dict]:
+    """Read the messages until the connection is closed
+
+    Yields:
+        dict: The messages in the order they were sent
+    """
+    for line in self._reader:
+      yield json.loads(line)
+
+  def close(self) -> None:
+    """Close the connection, a thread in receive stops
+    """
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self._reader.close()
+    self.sock.close()
+
+
+def connect(path:str=None) -> Channel:
+  """Connect to the daemon
+
+  Args:
+      path (str, optional): The socket. Defaults to None for socket_path().
+
+  Returns:
+      Channel: The connection, None if no daemon is listening
+  """
+  if not hasattr(socket, "AF_UNIX"):
+    return None
+  path = path or socket_path()
+  if not os.path.exists(path):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except OSError:
+    sock.close()
+    return None
+  return Channel(sock)
+
+
+def available(path:str=None) -> bool:
+  """Check if a daemon is listening
+
+  Args:
+      path (str, optional): The socket. Defaults to None for socket_path().
+
+  Returns:
+      bool: True if a frontend can connect
+  """
+  channel = connect(path)
+  if channel is None:
+    return False
+  channel.close()
+  return True
+
+
+class RemoteError(Exception):
+  """An operation failed in the daemon or the daemon is gone
+  """
+
+
+class _Call:
+  """A request that waits for its reply
+  """
+  def __init__(self) -> None:
+    self.done = threading.Event()
+    self.result:Any = None
+    self.error:str = None
+
+
+class RemoteStorage(storage.Storage):
+  """Reads conversations from the daemon, the daemon writes them
+  """
+  ids:dict[str, int]
+  versions:dict[int, int]
+
+  def __init__(self, call:Callable[..., Any], ids:dict[str, int]) -> None:
+    self.ids = ids
+    self.versions = {}
+    self._call = call
+
+  def read(self, name:str) -> tuple[list[dict[str,str]], dict, int]:
+    """Read a conversation and remember which event of the daemon it includes
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        tuple[list[dict[str,str]], dict, int]: The messages, the metadata and 0 for the size,
+          None if the daemon does not know the conversation
+    """
+    conv_id = self.ids.get(name)
+    stored = None if conv_id is None else self._call("read", conv_id=conv_id)
+    if stored is None:
+      return None
+    self.versions[conv_id] = stored["version"]
+    return stored["messages"], stored["meta"], 0
+
+
+class RemoteTelemetry:
+  """The measurements of the last request the daemon finished
+  """
+  last:telemetry.RequestMetrics
+
+  def __init__(self) -> None:
+    self.last = None
+    self._percentiles:dict[str, tuple[float, float]] = {}
+
+  def update(self, metrics:dict, percentiles:list[float]) -> None:
+    """Store the measurements sent with a finished request
+
+    Args:
+        metrics (dict): The measurements of the last request
+        percentiles (list[float]): The p50 and p95 of the total time of its model
+    """
+    self.last = telemetry.RequestMetrics.of(metrics)
+    self._percentiles[self.last.model] = (percentiles[0], percentiles[1])
+
+  def percentiles(self, model:str, name:str="total") -> tuple[float, float]:
+    """Get the p50 and p95 of the total time of a model
+
+    Args:
+        model (str): The model name
+        name (str, optional): Only the total time is sent. Defaults to "total".
+
+    Returns:
+        tuple[float, float]: The p50 and p95 in seconds
+    """
+    return self._percentiles.get(model, (0.0, 0.0))
+
+
+class RemoteClient(base.ClientBase):
+  """The client of a chat frontend that is connected to the daemon
+
+  The daemon identifies conversations by an id that does not change when
+  they are renamed, names only change with the renamed events. The daemon
+  saves the conversations, so there is no saver.
+  """
+  channel:Channel
+  conversations:dict[str, conversation.Conversation]
+  current_conversation:str
+  ids:dict[str, int]
+  storage:RemoteStorage
+  telemetry:RemoteTelemetry
+  requests:"RemoteRequests"
+  rename_callbacks:list[Callable[[str, str], None]]
+  saver:None
+
+  def __init__(self, channel:Channel) -> None:
+    self.channel = channel
+    self.max_yx:Callable[[], tuple[int, int]] = lambda: (20, 80)
+    self.current_conversation = None
+    self.conversations = {}
+    self.ids = {}
+    self.storage = RemoteStorage(self.call, self.ids)
+    self.telemetry = RemoteTelemetry()
+    self.rename_callbacks = []
+    self.saver = None
+    self._by_id:dict[int, conversation.Conversation] = {}
+    self._calls:dict[int, _Call] = {}
+    self._next_id = 0
+    self._calls_lock = threading.Lock()
+    self._closed = False
+    self.requests = RemoteRequests(self)
+    threading.Thread(target=self._receive, name="remote", daemon=True).start()
+    hello = self.call("hello")
+    self.models = hello["models"]
+    self.recency = recency.RecencyIndex([name for name, _ in hello["conversations"]])
+    for name, conv_id in hello["conversations"]:
+      self.add(name, conv_id)
+    self.requests.in_flight.update(hello["in_flight"])
+    self.current_conversation = self.recency.first()
+
+  def call(self, op:str, **args:Any) -> Any:
+    """Run an operation in the daemon and wait for its result
+
+    Args:
+        op (str): The operation
+        args (Any): Its arguments
+
+    Raises:
+        RemoteError: The operation failed or the daemon is gone
+
+    Returns:
+        Any: The result
+    """
+    pending = _Call()
+    with self._calls_lock:
+      if self._closed:
+        raise RemoteError("The connection to the daemon is closed")
+      self._next_id += 1
+      call_id = self._next_id
+      self._calls[call_id] = pending
+    try:
+      self.channel.send({"id": call_id, "op": op, "args": args})
+    except OSError as e:
+      with self._calls_lock:
+        self._calls.pop(call_id, None)
+      raise RemoteError(str(e)) from e
+    pending.done.wait()
+    if pending.error is not None:
+      raise RemoteError(pending.error)
+    return pending.result
+
+  def _receive(self) -> None:
+    """Hand replies to the waiting calls and queue the events for the UI thread
+    """
+    try:
+      for message in self.channel.receive():
+        if "event" in message:
+          self.requests.raw_events.put(message)
+          continue
+        with self._calls_lock:
+          pending = self._calls.pop(message["id"], None)
+        if pending is None:
+          continue
+        pending.result = message.get("result")
+        pending.error = message.get("error")
+        pending.done.set()
+    except (OSError, ValueError):
+      pass
+    with self._calls_lock:
+      self._closed = True
+      calls = list(self._calls.values())
+      self._calls.clear()
+    for pending in calls:
+      pending.error = "The daemon closed the connection"
+      pending.done.set()
+
+  def close(self) -> None:
+    """Disconnect from the daemon, its requests keep running
+    """
+    self.channel.close()
+
+  def add(self, name:str, conv_id:int) -> conversation.Conversation:
+    """Get a conversation of the daemon, it is created if it is new
+
+    Args:
+        name (str): The conversation key, only used for a new conversation
+        conv_id (int): The id of the conversation in the daemon
+
+    Returns:
+        conversation.Conversation: The conversation, read from the daemon when it is used
+    """
+    conv = self._by_id.get(conv_id)
+    if conv is None:
+      conv = conversation.Conversation(name, self)
+      conv.load(lazy=True)
+      self.conversations[name] = conv
+      self.ids[name] = conv_id
+      self._by_id[conv_id] = conv
+    return conv
+
+  def get_conversation(self) -> list[str]:
+    """Get a list of conversation names, the most recently used first
+    """
+    return self.recency.names()
+
+  def touch(self, conv:conversation.Conversation) -> None:
+    """Conversations are kept until they are closed, the daemon keeps the memory budget
+
+    Args:
+        conv (conversation.Conversation): The conversation that was used
+    """
+
+  def search(self, query:str, limit:int=50) -> list[search.SearchResult]:
+    """Search the messages of all conversations in the daemon
+
+    Args:
+        query (str): Terms and quoted phrases
+        limit (int, optional): The maximum number of results. Defaults to 50.
+
+    Returns:
+        list[search.SearchResult]: The matching messages, the best first
+    """
+    results:list[search.SearchResult] = []
+    for conv_id, index, score in self.call("search", query=query, limit=limit):
+      conv = self._by_id.get(conv_id)
+      if conv is not None:
+        results.append(search.SearchResult(conv.name, index, score))
+    return results
+
+  def rename(self, old_key:str, new_key:str) -> str:
+    """Rename a conversation
+
+    Args:
+        old_key (str): The current conversation key
+        new_key (str): The new name, made unique if it is already used
+
+    Returns:
+        str: The conversation key after renaming
+    """
+    if old_key == new_key or old_key not in self.conversations:
+      return old_key
+    conv_id = self.ids[old_key]
+    self.renamed(conv_id, self.call("rename", conv_id=conv_id, new_key=new_key))
+    return self._by_id[conv_id].name
+
+  def renamed(self, conv_id:int, new_key:str) -> conversation.Conversation:
+    """Follow a conversation that was renamed in the daemon
+
+    Args:
+        conv_id (int): The id of the conversation
+        new_key (str): The new conversation key
+
+    Returns:
+        conversation.Conversation: The conversation, None if it already has the name
+    """
+    conv = self._by_id.get(conv_id)
+    if conv is None or conv.name == new_key:
+      return None
+    old_key = conv.name
+    self.conversations.pop(old_key, None)
+    self.ids.pop(old_key, None)
+    conv.name = new_key
+    self.conversations[new_key] = conv
+    self.ids[new_key] = conv_id
+    self.recency.rename(old_key, new_key)
+    for callback in self.rename_callbacks:
+      callback(old_key, new_key)
+    return conv
+
+  def delete(self, conv_key:str) -> None:
+    """Delete a conversation
+
+    Args:
+        conv_key (str): The conversation key
+    """
+    conv_id = self.ids.get(conv_key)
+    if conv_id is None:
+      return
+    self.call("delete", conv_id=conv_id)
+    self.deleted(conv_id)
+
+  def deleted(self, conv_id:int) -> conversation.Conversation:
+    """Forget a conversation that was deleted in the daemon
+
+    Args:
+        conv_id (int): The id of the conversation
+
+    Returns:
+        conversation.Conversation: The conversation, None if it was already forgotten
+    """
+    conv = self._by_id.pop(conv_id, None)
+    if conv is None:
+      return None
+    self.conversations.pop(conv.name, None)
+    self.ids.pop(conv.name, None)
+    self.recency.remove(conv.name)
+    self.storage.versions.pop(conv_id, None)
+    return conv
+
+
+class RemoteRequests:
+  """Sends prompts to the daemon and hands its events to the UI like a RequestPool
+
+  Requests keep running in the daemon when the frontend is closed.
+  """
+  client:RemoteClient
+  raw_events:queue.Queue
+  in_flight:set[int]
+
+  def __init__(self, client:RemoteClient) -> None:
+    self.client = client
+    self.raw_events = queue.Queue()
+    self.in_flight = set()
+
+  def submit(self, conv_key:str, prompt:str, models:list[str]=None) -> str:
+    """Queue a prompt for a conversation in the daemon
+
+    Args:
+        conv_key (str): The conversation key or None for a new conversation
+        prompt (str): The message to send
+        models (list[str], optional): Send the prompt to all of these models. Defaults to None.
+
+    Returns:
+        str: The conversation key, the provisional name for a new conversation
+    """
+    conv_id = None if conv_key is None else self.client.ids.get(conv_key)
+    submitted = self.client.call("submit", conv_id=conv_id, prompt=prompt, models=models)
+    conv = self.client.add(submitted["conv"], submitted["id"])
+    self.client.recency.touch(conv.name)
+    self.in_flight.add(submitted["id"])
+    return conv.name
+
+  def is_in_flight(self, conv_key:str) -> bool:
+    """Check if a request for a conversation is running or queued in the daemon
+
+    Args:
+        conv_key (str): The conversation key
+
+    Returns:
+        bool: True if the conversation is waiting for an answer
+    """
+    return self.client.ids.get(conv_key) in self.in_flight
+
+  def cancel(self, conv_key:str) -> bool:
+    """Stop the running request of a conversation, its answer so far is kept
+
+    Args:
+        conv_key (str): The conversation key
+
+    Returns:
+        bool: True if a running request was cancelled
+    """
+    conv_id = self.client.ids.get(conv_key)
+    return conv_id is not None and self.client.call("cancel", conv_id=conv_id)
+
+  def drain(self) -> list[worker.RequestEvent]:
+    """Apply the events the daemon sent since the last call
+
+    Call it from the UI thread, the conversations are changed here.
+
+    Returns:
+        list[worker.RequestEvent]: The events for the UI in the order they were sent
+    """
+    events:list[worker.RequestEvent] = []
+    while True:
+      try:
+        message:dict = self.raw_events.get_nowait()
+      except queue.Empty:
+        break
+      event = self._apply(message)
+      if event is not None:
+        events.append(event)
+    return events
+
+  def shutdown(self, wait:bool=False) -> None:
+    """Disconnect from the daemon
+
+    Args:
+        wait (bool, optional): Not used, the daemon saves the answers. Defaults to False.
+    """
+    self.client.close()
+
+  def _apply(self, message:dict) -> worker.RequestEvent:
+    """Change the local state for an event of the daemon
+
+    Args:
+        message (dict): The event
+
+    Returns:
+        worker.RequestEvent: The event for the UI, None if nothing is shown
+    """
+    client = self.client
+    kind = message["event"]
+    conv_id = message["id"]
+    if kind == EVENT_TOUCHED:
+      conv = client.add(message["conv"], conv_id)
+      client.recency.touch(conv.name)
+      return None
+    if kind == EVENT_RENAMED:
+      conv = client.renamed(conv_id, message["new"])
+      if conv is None:
+        return None
+      return worker.RequestEvent(worker.RequestEvent.RENAMED, message["old"], conv, conv.name)
+    if kind == EVENT_DELETED:
+      self.in_flight.discard(conv_id)
+      conv = client.deleted(conv_id)
+      if conv is None:
+        return None
+      # the chat list is updated like after a request
+      return worker.RequestEvent(worker.RequestEvent.DONE, conv.name, conv, conv.name)
+    conv = client.add(message["conv"], conv_id)
+    if message["in_flight"]:
+      self.in_flight.add(conv_id)
+    else:
+      self.in_flight.discard(conv_id)
+    if message.get("metrics") is not None:
+      client.telemetry.update(message["metrics"], message["percentiles"])
+    if message["version"] > client.storage.versions.get(conv_id, 0):
+      client.storage.versions[conv_id] = message["version"]
+      # a conversation that was not read yet gets all messages when it is
+      if conv.loaded:
+        messages = conv.messages
+        if message["start"] <= len(messages):
+          messages[message["start"]:] = message["messages"]
+        else:
+          conv.load(lazy=True)
+    if message["done"]:
+      return worker.RequestEvent(worker.RequestEvent.DONE, conv.name, conv, conv.name)
+    return worker.RequestEvent(worker.RequestEvent.DELTA, conv.name, conv)
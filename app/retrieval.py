@@ -0,0 +1,206 @@
+"""Finds the earlier messages that are relevant for a prompt
+
+Messages are embedded offline with a hashed n-gram vectorizer: the words,
+word pairs and character trigrams of a text are hashed into a fixed number
+of dimensions, weighted with the logarithm of their count and normalized to
+unit length. The vectors of a conversation are the rows of one float array
+that is updated when messages are added or changed. The similarity of a
+prompt and a message is the dot product of their vectors.
+
+The vectors of a conversation that is not in memory can be written to a
+file, tagged with the stored size of the conversation they were built from.
+"""
+
+
+import os
+import json
+import math
+import re
+import zlib
+import threading
+from array import array
+from collections import Counter
+from constants import RETRIEVAL_DIMENSIONS
+import functions
+import message as msg
+
+
+WORD_PATTERN = re.compile(r"\w+")
+TRIGRAM_WEIGHT = 0.5
+
+
+def features(text:str) -> dict[str, float]:
+  """Get the weighted n-grams of a text
+
+  Args:
+      text (str): The text
+
+  Returns:
+      dict[str, float]: The weight of every word, word pair and character trigram
+  """
+  words = WORD_PATTERN.findall(text.lower())
+  counts:dict[str, float] = Counter(words)
+  counts.update(map(" ".join, zip(words, words[1:])))
+  # the trigrams of a word are the same every time it appears
+  for word, count in Counter(words).items():
+    padded = "#" + word + "#"
+    for j in range(len(padded) - 2):
+      trigram = "#3" + padded[j:j + 3]
+      counts[trigram] = counts.get(trigram, 0) + TRIGRAM_WEIGHT * count
+  return {feature: 1 + math.log(count) if count >= 1 else count for feature, count in counts.items()}
+
+
+def embed(text:str, dimensions:int=RETRIEVAL_DIMENSIONS) -> dict[int, float]:
+  """Hash the n-grams of a text into a sparse unit vector
+
+  The sign of a feature is taken from its hash as well, so collisions
+  cancel out instead of adding up.
+
+  Args:
+      text (str): The text
+      dimensions (int, optional): The number of dimensions. Defaults to RETRIEVAL_DIMENSIONS.
+
+  Returns:
+      dict[int, float]: The non zero values by dimension, empty for texts without words
+  """
+  vector:dict[int, float] = {}
+  for feature, weight in features(text).items():
+    digest = zlib.crc32(feature.encode('utf-8'))
+    dimension = (digest >> 1) % dimensions
+    vector[dimension] = vector.get(dimension, 0.0) + (weight if digest & 1 else -weight)
+  norm = math.sqrt(sum(value * value for value in vector.values()))
+  if norm <= 0:
+    return {}
+  return {dimension: value / norm for dimension, value in vector.items() if value != 0}
+
+
+class VectorIndex:
+  """The vectors of the messages of a conversation
+
+  Row i of the matrix is the vector of message i. Only rows of messages
+  that are new or changed since the last update are computed again.
+  """
+  dimensions:int
+  built:bool
+
+  def __init__(self, dimensions:int=RETRIEVAL_DIMENSIONS) -> None:
+    self.dimensions = dimensions
+    # an index of a conversation without messages is built as well
+    self.built = False
+    self._matrix = array("f")
+    self._keys:list[int] = []
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self._keys)
+
+  def memory(self) -> int:
+    """Get the bytes of the vectors
+
+    Returns:
+        int: The size of the matrix
+    """
+    return len(self._matrix) * self._matrix.itemsize
+
+  def save(self, path:str, size:int) -> None:
+    """Write the vectors to a file
+
+    Args:
+        path (str): The path to the file
+        size (int): The stored size of the conversation the vectors were built from
+    """
+    with self._lock:
+      header = json.dumps({"size": size, "rows": len(self._keys), "dimensions": self.dimensions}) + "\n"
+      data = self._matrix.tobytes()
+    functions.create_folder(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+      f.write(header.encode('utf-8'))
+      f.write(data)
+    os.replace(tmp_path, path)
+
+  @classmethod
+  def load(cls, path:str, size:int) -> "VectorIndex":
+    """Read the vectors written by save
+
+    The rows can not be updated, they are computed again if the index is updated.
+
+    Args:
+        path (str): The path to the file
+        size (int): The current stored size of the conversation
+
+    Returns:
+        VectorIndex: The index, None if the file is missing, damaged or built from another size
+    """
+    try:
+      with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        data = f.read()
+    except (OSError, ValueError):
+      return None
+    if not isinstance(header, dict) or header.get("size") != size:
+      return None
+    index = cls(header["dimensions"])
+    if len(data) != header["rows"] * index.dimensions * index._matrix.itemsize:
+      return None
+    index._matrix.frombytes(data)
+    index._keys = [None] * header["rows"]
+    index.built = True
+    return index
+
+  def update(self, messages:list[dict[str,str]]) -> int:
+    """Bring the vectors up to date with the messages of the conversation
+
+    Args:
+        messages (list[dict[str,str]]): The messages
+
+    Returns:
+        int: The number of vectors that were computed
+    """
+    computed = 0
+    with self._lock:
+      if len(self._keys) > len(messages):
+        del self._keys[len(messages):]
+        del self._matrix[len(messages) * self.dimensions:]
+      for i, message in enumerate(messages):
+        # hashes of strings are cached, unchanged messages are cheap to check
+        key = hash((message["role"], msg.content_key(message)))
+        if i < len(self._keys) and self._keys[i] == key:
+          continue
+        row = array("f", bytes(4 * self.dimensions))
+        if message["role"] != "error":
+          for dimension, value in embed(message["content"], self.dimensions).items():
+            row[dimension] = value
+        if i < len(self._keys):
+          self._keys[i] = key
+          self._matrix[i * self.dimensions:(i + 1) * self.dimensions] = row
+        else:
+          self._keys.append(key)
+          self._matrix.extend(row)
+        computed += 1
+      self.built = True
+    return computed
+
+  def search(self, query:dict[int, float], k:int, end:int=None, min_score:float=0.0) -> list[tuple[int, float]]:
+    """Find the messages that are most similar to a query
+
+    Args:
+        query (dict[int, float]): The vector of the query from embed
+        k (int): The maximum number of messages
+        end (int, optional): Only search the messages before this index. Defaults to all.
+        min_score (float, optional): Skip messages that are not more similar. Defaults to 0.0.
+
+    Returns:
+        list[tuple[int, float]]: The message indexes and similarities, the most similar first
+    """
+    with self._lock:
+      rows = len(self._keys) if end is None else min(end, len(self._keys))
+      if rows <= 0 or len(query) <= 0 or k <= 0:
+        return []
+      scores = [0.0] * rows
+      size = rows * self.dimensions
+      for dimension, weight in query.items():
+        column = self._matrix[dimension:size:self.dimensions]
+        scores = [score + weight * value for score, value in zip(scores, column)]
+    ranked = sorted(((score, i) for i, score in enumerate(scores) if score > min_score), reverse=True)
+    return [(i, score) for score, i in ranked[:k]]
@@ -0,0 +1,87 @@
+"""Saves conversations on a background thread
+
+A save writes everything that changed since the last one, so the saves of a
+conversation that are requested while it waits for the saver are done as
+one. Neither the UI nor the request threads wait for the disk. After the
+saver is closed, conversations are saved right away by the thread that asks.
+"""
+
+
+import threading
+import conversation
+
+
+class Saver:
+  """A thread that saves the conversations it is given
+  """
+  error:Exception
+
+  def __init__(self) -> None:
+    self.error = None
+    self._pending:dict[int, conversation.Conversation] = {}
+    self._saving = False
+    self._closed = False
+    self._condition = threading.Condition()
+    self._thread = threading.Thread(target=self._run, name="saver", daemon=True)
+    self._thread.start()
+
+  def save_later(self, conv:conversation.Conversation) -> None:
+    """Queue a conversation to be saved
+
+    Args:
+        conv (conversation.Conversation): The conversation
+    """
+    if conv.deleted:
+      return
+    with self._condition:
+      if not self._closed:
+        self._pending[id(conv)] = conv
+        self._condition.notify_all()
+        return
+    conv.save()
+
+  def discard(self, conv:conversation.Conversation) -> None:
+    """Forget the queued save of a conversation, e.g. because it was deleted
+
+    Args:
+        conv (conversation.Conversation): The conversation
+    """
+    with self._condition:
+      self._pending.pop(id(conv), None)
+
+  def flush(self) -> None:
+    """Wait until all queued conversations are saved
+    """
+    with self._condition:
+      while len(self._pending) > 0 or self._saving:
+        self._condition.wait()
+
+  def close(self) -> None:
+    """Save the queued conversations and stop the thread
+    """
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+    self._thread.join()
+
+  def _run(self) -> None:
+    """Save the queued conversations until the saver is closed
+    """
+    while True:
+      with self._condition:
+        while len(self._pending) <= 0 and not self._closed:
+          self._condition.wait()
+        if len(self._pending) <= 0:
+          return
+        conversations = list(self._pending.values())
+        self._pending.clear()
+        self._saving = True
+      for conv in conversations:
+        try:
+          conv.save()
+        except Exception as e:
+          # the changes stay unsaved, the next save of the conversation writes them
+          self.error = e
+      with self._condition:
+        self._saving = False
+        self._condition.notify_all()
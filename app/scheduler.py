@@ -0,0 +1,334 @@
+"""Schedules API requests within the rate limits of each model
+
+The x-ratelimit-* headers of every response update a request bucket and a
+token bucket per model. Requests wait until both buckets allow them and
+until a concurrency slot of their model is free. Rate limit errors, server
+errors and connection problems are retried with jittered exponential backoff,
+or after the retry-after time of the server up to the maximum backoff.
+A request with a cancel token stops waiting, retrying and reading its
+response as soon as the token is cancelled, and fails right away if its
+next retry would come after its deadline.
+"""
+
+
+import re
+import math
+import time
+import random
+import threading
+from typing import Any, Callable, Iterator
+import openai
+from constants import MAX_REQUESTS_PER_MODEL, MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from cancel import CancelToken, Cancelled
+import telemetry
+
+
+RETRY_ERRORS = (
+  openai.RateLimitError,
+  openai.InternalServerError,
+  openai.APIConnectionError,
+)
+# what a request can fail with after its retries
+REQUEST_ERRORS = (
+  openai.OpenAIError,
+  Cancelled,
+  OSError,
+)
+
+
+def parse_duration(text:str) -> float:
+  """Parse a duration like 6m0s, 1.5s or 20ms from a rate limit header
+
+  Args:
+      text (str): The duration
+
+  Returns:
+      float: The duration in seconds
+  """
+  units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+  seconds = 0.0
+  for value, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", text):
+    seconds += float(value) * units[unit]
+  return seconds
+
+
+class TokenBucket:
+  """A bucket that refills until the reset time the API reported
+  """
+  capacity:float
+  tokens:float
+  rate:float
+
+  def __init__(self) -> None:
+    self.capacity = 0
+    self.tokens = 0
+    self.rate = 0
+    self.updated = time.monotonic()
+
+  def known(self) -> bool:
+    """Check if the API reported a limit for this bucket
+
+    Returns:
+        bool: True if the bucket has a capacity
+    """
+    return self.capacity > 0
+
+  def update(self, limit:float, remaining:float, reset:float) -> None:
+    """Set the bucket to the state reported by the API
+
+    Args:
+        limit (float): The capacity of the bucket
+        remaining (float): The tokens that are left
+        reset (float): The seconds until the bucket is full again
+    """
+    self.capacity = limit
+    self.tokens = remaining
+    if reset > 0:
+      self.rate = (limit - remaining) / reset
+    elif remaining >= limit:
+      self.rate = 0
+    self.updated = time.monotonic()
+
+  def refill(self) -> None:
+    """Add the tokens that were refilled since the last update
+    """
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def wait_time(self, amount:float) -> float:
+    """Get the seconds until the bucket holds enough tokens
+
+    Args:
+        amount (float): The tokens a request needs
+
+    Returns:
+        float: The seconds to wait, 0 if the request can start now
+    """
+    if not self.known():
+      return 0
+    self.refill()
+    amount = min(amount, self.capacity)
+    if self.tokens >= amount:
+      return 0
+    if self.rate <= 0:
+      return 1
+    return (amount - self.tokens) / self.rate
+
+  def take(self, amount:float) -> None:
+    """Remove tokens for a request that starts now
+
+    Args:
+        amount (float): The tokens the request needs
+    """
+    if self.known():
+      self.tokens -= amount
+
+
+class ModelLimits:
+  """The rate limit state and the concurrency slots of a model
+  """
+  requests:TokenBucket
+  tokens:TokenBucket
+
+  def __init__(self, max_concurrency:int) -> None:
+    self.requests = TokenBucket()
+    self.tokens = TokenBucket()
+    self.slots = threading.Semaphore(max_concurrency)
+
+
+class RequestScheduler:
+  """Queues, throttles and retries the API requests of all models
+  """
+  max_concurrency:int
+  max_retries:int
+  base_delay:float
+  max_delay:float
+
+  def __init__(self, max_concurrency:int=MAX_REQUESTS_PER_MODEL, max_retries:int=MAX_RETRIES,
+               base_delay:float=RETRY_BASE_DELAY, max_delay:float=RETRY_MAX_DELAY) -> None:
+    self.max_concurrency = max_concurrency
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self._models:dict[str, ModelLimits] = {}
+    self._lock = threading.Lock()
+
+  def limits(self, model:str) -> ModelLimits:
+    """Get the rate limit state of a model
+
+    Args:
+        model (str): The model name
+
+    Returns:
+        ModelLimits: The state, created on first use
+    """
+    with self._lock:
+      if model not in self._models:
+        self._models[model] = ModelLimits(self.max_concurrency)
+      return self._models[model]
+
+  def run(self, model:str, tokens:int, create:Callable[[], Any], consume:Callable[[Any], Iterator[str]],
+          metrics:telemetry.RequestMetrics=None, cancel:CancelToken=None) -> Iterator[str]:
+    """Run a request once the model has capacity for it
+
+    A concurrency slot of the model is held until the response is consumed.
+    Only the creation of the response is retried, so no delta is repeated.
+    Cancelling the request closes its response.
+
+    Args:
+        model (str): The model name
+        tokens (int): The estimated tokens of the request
+        create (Callable[[], Any]): Sends the request and returns the raw response
+        consume (Callable[[Any], Iterator[str]]): Turns the parsed response into content deltas
+        metrics (telemetry.RequestMetrics, optional): Gets the queue time and the retries. Defaults to None.
+        cancel (CancelToken, optional): Stops the request. Defaults to None.
+
+    Yields:
+        str: The content deltas
+
+    Raises:
+        Cancelled: The request was cancelled
+    """
+    limits = self.limits(model)
+    queued_since = time.monotonic()
+    with limits.slots:
+      response = self._create(limits, tokens, create, queued_since, metrics, cancel)
+      if cancel is None:
+        yield from consume(response)
+        return
+      close = getattr(response, "close", None)
+      if close is not None:
+        cancel.on_cancel(close)
+      try:
+        for delta in consume(response):
+          cancel.check()
+          yield delta
+      except Cancelled:
+        raise
+      except Exception:
+        # reading a response that was closed fails
+        cancel.check()
+        raise
+
+  def _create(self, limits:ModelLimits, tokens:int, create:Callable[[], Any], queued_since:float,
+              metrics:telemetry.RequestMetrics=None, cancel:CancelToken=None) -> Any:
+    """Wait for capacity, send the request and retry transient errors
+
+    Args:
+        limits (ModelLimits): The state of the model
+        tokens (int): The estimated tokens of the request
+        create (Callable[[], Any]): Sends the request and returns the raw response
+        queued_since (float): The monotonic time the request was queued
+        metrics (telemetry.RequestMetrics, optional): Gets the queue time and the retries. Defaults to None.
+        cancel (CancelToken, optional): Stops waiting and retrying. Defaults to None.
+
+    Returns:
+        Any: The parsed response
+    """
+    attempt = 0
+    while True:
+      self._wait(limits, tokens, cancel)
+      if metrics is not None:
+        if attempt == 0:
+          metrics.queued = time.monotonic() - queued_since
+        metrics.retries = attempt
+      try:
+        if cancel is not None:
+          cancel.check()
+        raw = create()
+        self._update(limits, raw.headers)
+        return raw.parse()
+      except RETRY_ERRORS as e:
+        # a timeout at the deadline is no transient error
+        if cancel is not None:
+          cancel.check()
+        retry_after = 0.0
+        response = getattr(e, "response", None)
+        if response is not None:
+          self._update(limits, response.headers)
+          retry_after = self._retry_after(response.headers)
+        attempt += 1
+        if attempt > self.max_retries:
+          raise
+        delay = min(max(retry_after, self._backoff(attempt)), self.max_delay)
+        # a retry after the deadline can not answer in time
+        if cancel is not None and cancel.remaining() is not None and delay >= cancel.remaining():
+          raise
+        self._sleep(delay, cancel)
+
+  def _sleep(self, seconds:float, cancel:CancelToken=None) -> None:
+    """Sleep unless the request is cancelled before
+
+    Args:
+        seconds (float): The seconds
+        cancel (CancelToken, optional): Wakes up the request when it is cancelled. Defaults to None.
+    """
+    if cancel is None:
+      time.sleep(seconds)
+    else:
+      cancel.sleep(seconds)
+
+  def _wait(self, limits:ModelLimits, tokens:int, cancel:CancelToken=None) -> None:
+    """Sleep until both buckets of a model allow the request and take from them
+
+    Args:
+        limits (ModelLimits): The state of the model
+        tokens (int): The estimated tokens of the request
+        cancel (CancelToken, optional): Stops waiting when it is cancelled. Defaults to None.
+    """
+    while True:
+      with self._lock:
+        wait = max(limits.requests.wait_time(1), limits.tokens.wait_time(tokens))
+        if wait <= 0:
+          limits.requests.take(1)
+          limits.tokens.take(tokens)
+          return
+      self._sleep(min(wait, self.max_delay), cancel)
+
+  def _update(self, limits:ModelLimits, headers:Any) -> None:
+    """Update the buckets of a model from the rate limit headers
+
+    Args:
+        limits (ModelLimits): The state of the model
+        headers (Any): The response headers
+    """
+    with self._lock:
+      for name, bucket in [("requests", limits.requests), ("tokens", limits.tokens)]:
+        limit = headers.get("x-ratelimit-limit-" + name)
+        remaining = headers.get("x-ratelimit-remaining-" + name)
+        reset = headers.get("x-ratelimit-reset-" + name)
+        if limit is None or remaining is None:
+          continue
+        try:
+          bucket.update(float(limit), float(remaining), parse_duration(reset or ""))
+        except ValueError:
+          continue
+
+  def _retry_after(self, headers:Any) -> float:
+    """Read the retry-after header of an error response
+
+    Args:
+        headers (Any): The response headers
+
+    Returns:
+        float: The seconds to wait, 0 if the header is missing or malformed
+    """
+    try:
+      seconds = float(headers.get("retry-after", 0))
+    except ValueError:
+      return 0.0
+    if not math.isfinite(seconds) or seconds < 0:
+      return 0.0
+    return seconds
+
+  def _backoff(self, attempt:int) -> float:
+    """Get a jittered exponential backoff delay
+
+    Args:
+        attempt (int): The number of the retry, starting with 1
+
+    Returns:
+        float: The seconds to wait
+    """
+    return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
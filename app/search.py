@@ -0,0 +1,448 @@
+"""A persistent full-text index over the messages of all conversations
+
+Every message is a document. The index keeps the positions of every term,
+so results can be ranked with BM25 and quoted phrases can be matched.
+It is stored as one segment file per conversation in the search folder,
+a save only rewrites the segment of the saved conversation.
+"""
+
+
+import os
+import re
+import json
+import math
+import zlib
+import threading
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from constants import SEARCH_FOLDER_NAME
+import functions
+import journal
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r"\w+")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text:str) -> list[str]:
+  """Split a text into lower case terms
+
+  Args:
+      text (str): The text
+
+  Returns:
+      list[str]: The terms in the order they appear
+  """
+  return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query:str) -> tuple[list[str], list[list[str]]]:
+  """Split a query into single terms and quoted phrases
+
+  Args:
+      query (str): The query, e.g. 'python "list comprehension"'
+
+  Returns:
+      tuple[list[str], list[list[str]]]: The terms and the phrases
+  """
+  terms:list[str] = []
+  phrases:list[list[str]] = []
+  for phrase, word in QUERY_PATTERN.findall(query):
+    tokens = tokenize(phrase or word)
+    if len(phrase) > 0 and len(tokens) > 1:
+      phrases.append(tokens)
+    else:
+      terms.extend(tokens)
+  return terms, phrases
+
+
+def content_hash(content:str) -> int:
+  """A stable hash of a message content
+
+  Args:
+      content (str): The content
+
+  Returns:
+      int: The hash
+  """
+  return zlib.crc32(content.encode('utf-8'))
+
+
+class SearchResult:
+  """A message that matches a query
+  """
+  conv_key:str
+  index:int
+  score:float
+
+  def __init__(self, conv_key:str, index:int, score:float) -> None:
+    self.conv_key = conv_key
+    self.index = index
+    self.score = score
+
+
+class SearchIndex:
+  """An incremental inverted index with BM25 ranking and phrase queries
+  """
+  folder:str
+
+  def __init__(self, folder:str="") -> None:
+    if len(folder) <= 0:
+      folder = functions.get_config_path(SEARCH_FOLDER_NAME)
+    self.folder = folder
+    # term -> conversation -> message index -> positions
+    self._postings:dict[str, dict[str, dict[int, list[int]]]] = {}
+    # conversation -> [(content hash, length)] of every indexed message
+    self._documents:dict[str, list[tuple[int, int]]] = {}
+    # conversation -> terms that occur in it
+    self._terms:dict[str, set[str]] = {}
+    self._sizes:dict[str, int] = {}
+    self._total_length = 0
+    self._document_count = 0
+    self._loaded = False
+    self._lock = threading.RLock()
+    self._dirty:set[str] = set()
+    self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+
+  def segment_path(self, conv_key:str) -> str:
+    """Get the file path of the segment of a conversation
+
+    Args:
+        conv_key (str): The conversation key
+
+    Returns:
+        str: The path to the segment
+    """
+    return os.path.join(self.folder, conv_key + ".json")
+
+  def load(self, sizes:dict[str, int], read:Callable[[str], list[dict[str,str]]]) -> None:
+    """Read the segments and index the conversations that changed since
+
+    Args:
+        sizes (dict[str, int]): The stored size of every conversation
+        read (Callable[[str], list[dict[str,str]]]): Reads the messages of a conversation
+    """
+    with self._lock:
+      self._postings = {}
+      self._documents = {}
+      self._terms = {}
+      self._sizes = {}
+      self._total_length = 0
+      self._document_count = 0
+      for conv_key, size in sizes.items():
+        if not self._read_segment(conv_key, size):
+          self._index_messages(conv_key, read, size)
+      if os.path.exists(self.folder):
+        for file in os.scandir(self.folder):
+          if file.name.endswith(".json") and file.name[:-len(".json")] not in sizes:
+            self._remove_file(file.path)
+      self._loaded = True
+
+  @property
+  def loaded(self) -> bool:
+    """True if the segments were read
+    """
+    return self._loaded
+
+  def update(self, conv_key:str, messages:list[dict[str,str]], size:int, changed:list[int]=None) -> None:
+    """Index the messages of a conversation after it was saved
+
+    Only messages whose content changed are tokenized again. Without the
+    indexes of the changed messages, every content is compared by its hash,
+    else only the changed messages and the ones that were not indexed yet
+    are looked at. Answers that are still streamed are indexed once they are
+    complete, the segment is stored with an unknown size until then.
+
+    Args:
+        conv_key (str): The conversation key
+        messages (list[dict[str,str]]): The saved messages
+        size (int): The stored size of the conversation
+        changed (list[int], optional): The indexes of the messages that were
+          updated by the save. Defaults to None to compare all of them.
+    """
+    with self._lock:
+      if not self._loaded:
+        return
+      documents = self._documents.setdefault(conv_key, [])
+      dirty = len(documents) > len(messages)
+      for index in range(len(messages), len(documents)):
+        self._remove_document(conv_key, index)
+      del documents[len(messages):]
+      if changed is None:
+        indexes = range(len(messages))
+      else:
+        indexes = sorted(set(index for index in changed if index < len(documents)))
+        indexes += range(len(documents), len(messages))
+      complete = True
+      for index in indexes:
+        message = messages[index]
+        if message.get(journal.PARTIAL_KEY, False):
+          complete = False
+          if index < len(documents):
+            continue
+          # later messages would be indexed at the wrong place
+          break
+        digest = content_hash(message["content"])
+        if index < len(documents) and documents[index][0] == digest:
+          continue
+        if index < len(documents):
+          self._remove_document(conv_key, index)
+        self._add_document(conv_key, index, message["content"], digest)
+        dirty = True
+      size = size if complete else -1
+      dirty = dirty or self._sizes.get(conv_key) != size
+      self._sizes[conv_key] = size
+    if dirty:
+      self._write_later(conv_key)
+
+  def remove(self, conv_key:str) -> None:
+    """Remove a deleted conversation from the index
+
+    Args:
+        conv_key (str): The conversation key
+    """
+    with self._lock:
+      if conv_key in self._documents:
+        documents = self._documents.pop(conv_key)
+        self._total_length -= sum(length for _, length in documents)
+        self._document_count -= len(documents)
+        for term in self._terms.pop(conv_key, set()):
+          self._postings[term].pop(conv_key)
+          if len(self._postings[term]) <= 0:
+            self._postings.pop(term)
+        self._sizes.pop(conv_key, None)
+    self._write_later(conv_key)
+
+  def rename(self, old_key:str, new_key:str) -> None:
+    """Move the messages of a renamed conversation to its new key
+
+    Args:
+        old_key (str): The previous conversation key
+        new_key (str): The new conversation key
+    """
+    with self._lock:
+      if old_key not in self._documents:
+        return
+      self._documents[new_key] = self._documents.pop(old_key)
+      self._terms[new_key] = self._terms.pop(old_key, set())
+      self._sizes[new_key] = self._sizes.pop(old_key, 0)
+      for term in self._terms[new_key]:
+        self._postings[term][new_key] = self._postings[term].pop(old_key)
+    self._write_later(old_key)
+    self._write_later(new_key)
+
+  def search(self, query:str, limit:int=50) -> list[SearchResult]:
+    """Find the messages that match a query, the best first
+
+    A message matches if it contains any of the terms and all of the phrases.
+
+    Args:
+        query (str): Terms and quoted phrases
+        limit (int, optional): The maximum number of results. Defaults to 50.
+
+    Returns:
+        list[SearchResult]: The results ranked by BM25
+    """
+    terms, phrases = parse_query(query)
+    with self._lock:
+      scores:dict[tuple[str, int], float] = {}
+      for term in set(terms + [term for phrase in phrases for term in phrase]):
+        self._score_term(term, scores)
+      for phrase in phrases:
+        scores = {
+          document: score for document, score in scores.items()
+          if self._contains_phrase(document[0], document[1], phrase)
+        }
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [SearchResult(conv_key, index, score) for (conv_key, index), score in ranked[:limit]]
+
+  def flush(self) -> None:
+    """Wait until all changed segments are written
+    """
+    self._writer.submit(lambda: None).result()
+
+  def _score_term(self, term:str, scores:dict[tuple[str, int], float]) -> None:
+    """Add the BM25 score of a term to the scores of the documents containing it
+
+    Args:
+        term (str): The term
+        scores (dict[tuple[str, int], float]): The scores by conversation and message index
+    """
+    postings = self._postings.get(term)
+    if postings is None:
+      return
+    frequency = sum(len(documents) for documents in postings.values())
+    idf = math.log(1 + (self._document_count - frequency + 0.5) / (frequency + 0.5))
+    average = self._total_length / max(self._document_count, 1)
+    for conv_key, documents in postings.items():
+      lengths = self._documents[conv_key]
+      for index, positions in documents.items():
+        tf = len(positions)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[index][1] / max(average, 1))
+        score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+        scores[(conv_key, index)] = scores.get((conv_key, index), 0) + score
+
+  def _contains_phrase(self, conv_key:str, index:int, phrase:list[str]) -> bool:
+    """Check if the terms of a phrase follow each other in a message
+
+    Args:
+        conv_key (str): The conversation key
+        index (int): The message index
+        phrase (list[str]): The terms of the phrase
+
+    Returns:
+        bool: True if the message contains the phrase
+    """
+    positions:set[int] = None
+    for offset, term in enumerate(phrase):
+      found = self._postings.get(term, {}).get(conv_key, {}).get(index)
+      if found is None:
+        return False
+      shifted = {position - offset for position in found}
+      positions = shifted if positions is None else positions & shifted
+      if len(positions) <= 0:
+        return False
+    return True
+
+  def _add_document(self, conv_key:str, index:int, content:str, digest:int) -> None:
+    """Add a message to the postings
+
+    Args:
+        conv_key (str): The conversation key
+        index (int): The message index
+        content (str): The message content
+        digest (int): The content hash
+    """
+    tokens = tokenize(content)
+    for position, term in enumerate(tokens):
+      self._postings.setdefault(term, {}).setdefault(conv_key, {}).setdefault(index, []).append(position)
+    self._terms.setdefault(conv_key, set()).update(tokens)
+    documents = self._documents.setdefault(conv_key, [])
+    if index < len(documents):
+      documents[index] = (digest, len(tokens))
+    else:
+      documents.append((digest, len(tokens)))
+    self._total_length += len(tokens)
+    self._document_count += 1
+
+  def _remove_document(self, conv_key:str, index:int) -> None:
+    """Remove a message from the postings
+
+    Args:
+        conv_key (str): The conversation key
+        index (int): The message index
+    """
+    _, length = self._documents[conv_key][index]
+    self._total_length -= length
+    self._document_count -= 1
+    if length <= 0:
+      return
+    terms = self._terms.get(conv_key, set())
+    for term in list(terms):
+      documents = self._postings[term][conv_key]
+      if documents.pop(index, None) is None or len(documents) > 0:
+        continue
+      terms.discard(term)
+      self._postings[term].pop(conv_key)
+      if len(self._postings[term]) <= 0:
+        self._postings.pop(term)
+
+  def _index_messages(self, conv_key:str, read:Callable[[str], list[dict[str,str]]], size:int) -> None:
+    """Index a conversation read from the storage
+
+    Args:
+        conv_key (str): The conversation key
+        read (Callable[[str], list[dict[str,str]]]): Reads the messages of a conversation
+        size (int): The stored size of the conversation
+    """
+    try:
+      messages = read(conv_key)
+    except (OSError, ValueError):
+      return
+    self._documents[conv_key] = []
+    for index, message in enumerate(messages):
+      self._add_document(conv_key, index, message["content"], content_hash(message["content"]))
+    self._sizes[conv_key] = size
+    self._write_later(conv_key)
+
+  def _read_segment(self, conv_key:str, size:int) -> bool:
+    """Add the postings of a segment file to the index
+
+    Args:
+        conv_key (str): The conversation key
+        size (int): The current stored size of the conversation
+
+    Returns:
+        bool: False if the segment is missing or older than the stored conversation
+    """
+    try:
+      with open(self.segment_path(conv_key), "r", encoding='utf-8') as f:
+        segment = json.load(f)
+    except (OSError, ValueError):
+      return False
+    if segment.get("size") != size:
+      return False
+    documents = [tuple(document) for document in segment["documents"]]
+    self._documents[conv_key] = documents
+    self._sizes[conv_key] = size
+    for term, postings in segment["postings"].items():
+      self._postings.setdefault(term, {})[conv_key] = {int(index): positions for index, positions in postings.items()}
+    self._terms[conv_key] = set(segment["postings"].keys())
+    self._total_length += sum(length for _, length in documents)
+    self._document_count += len(documents)
+    return True
+
+  def _write_later(self, conv_key:str) -> None:
+    """Write the segment of a conversation on the background thread
+
+    Args:
+        conv_key (str): The conversation key
+    """
+    with self._lock:
+      if conv_key in self._dirty:
+        return
+      self._dirty.add(conv_key)
+    self._writer.submit(self._write_segment, conv_key)
+
+  def _write_segment(self, conv_key:str) -> None:
+    """Write or remove the segment file of a conversation
+
+    Args:
+        conv_key (str): The conversation key
+    """
+    with self._lock:
+      self._dirty.discard(conv_key)
+      if conv_key not in self._documents:
+        segment = None
+      else:
+        segment = {
+          "size": self._sizes.get(conv_key, 0),
+          "documents": self._documents[conv_key],
+          "postings": {term: self._postings[term][conv_key] for term in self._terms.get(conv_key, set())},
+        }
+        segment = json.dumps(segment)
+    path = self.segment_path(conv_key)
+    if segment is None:
+      self._remove_file(path)
+      return
+    try:
+      functions.create_folder(self.folder)
+      tmp_path = path + ".tmp"
+      with open(tmp_path, "w", encoding='utf-8') as f:
+        f.write(segment)
+      os.replace(tmp_path, path)
+    except OSError:
+      pass
+
+  def _remove_file(self, path:str) -> None:
+    """Remove a segment file
+
+    Args:
+        path (str): The path to the segment
+    """
+    try:
+      os.remove(path)
+    except OSError:
+      pass
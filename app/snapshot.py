@@ -0,0 +1,80 @@
+"""A snapshot of the chat list and the open conversation
+
+The snapshot is written when the app is closed and read when it is started,
+so the first frame can be drawn before the client and the conversations are
+loaded in the background.
+"""
+
+
+import os
+import json
+from constants import SNAPSHOT_FILE_NAME
+import functions
+
+
+class Snapshot:
+  """What the main form showed when the app was closed
+  """
+  chats:list[str]
+  current:str
+  width:int
+  values:list[str]
+
+  def __init__(self, chats:list[str]=None, current:str=None, width:int=0, values:list[str]=None) -> None:
+    self.chats = chats or []
+    self.current = current
+    self.width = width
+    self.values = values or []
+
+  def to_dict(self) -> dict:
+    """Convert the snapshot to a JSON serializable dict
+
+    Returns:
+        dict: The snapshot
+    """
+    return {
+      "chats": self.chats,
+      "current": self.current,
+      "width": self.width,
+      "values": self.values,
+    }
+
+
+def load(path:str="") -> Snapshot:
+  """Read the snapshot file
+
+  Args:
+      path (str, optional): The path to the snapshot file. Defaults to the config folder.
+
+  Returns:
+      Snapshot: The snapshot, an empty one if there is no valid snapshot file
+  """
+  if len(path) <= 0:
+    path = functions.get_config_path(SNAPSHOT_FILE_NAME)
+  try:
+    with open(path, "r", encoding='utf-8') as f:
+      data = json.load(f)
+    return Snapshot(
+      [str(name) for name in data["chats"]],
+      data["current"],
+      int(data["width"]),
+      [str(line) for line in data["values"]]
+    )
+  except (OSError, ValueError, TypeError, KeyError):
+    return Snapshot()
+
+
+def save(snapshot:Snapshot, path:str="") -> None:
+  """Write the snapshot file
+
+  Args:
+      snapshot (Snapshot): The snapshot
+      path (str, optional): The path to the snapshot file. Defaults to the config folder.
+  """
+  if len(path) <= 0:
+    path = functions.get_config_path(SNAPSHOT_FILE_NAME)
+  functions.create_folder(os.path.dirname(path))
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w", encoding='utf-8') as f:
+    json.dump(snapshot.to_dict(), f, ensure_ascii=False)
+  os.replace(tmp_path, path)
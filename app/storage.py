@@ -0,0 +1,587 @@
+"""Stores for the messages and metadata of conversations
+
+Conversations are written through the Storage interface. The file store keeps
+one journal per conversation in the conversations folder, the SQLite store
+keeps conversations and messages as rows of one database in WAL mode.
+The store is chosen with the OPENAI_CHAT_STORAGE environment variable.
+
+The file store moves conversations that were not written for a while into
+a compressed cold tier and back when they are written again.
+"""
+
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from constants import STORAGE_ENV, DATABASE_FILE_NAME, FILE_EXTENSION, LEGACY_FILE_EXTENSION, COLD_FILE_EXTENSION, COLD_STORAGE_AGE
+import functions
+import catalog
+import journal
+
+
+FILES = "files"
+SQLITE = "sqlite"
+
+
+class Storage:
+  """The interface of the conversation stores
+
+  Writes use the records of the journal module, so a save only sends the
+  messages that changed since the last one.
+  """
+
+  def entries(self) -> dict[str, catalog.CatalogEntry]:
+    """List the stored conversations
+
+    Returns:
+        dict[str, catalog.CatalogEntry]: The metadata of every conversation by name
+    """
+    raise NotImplementedError()
+
+  def read(self, name:str) -> tuple[list[dict[str,str]], dict, int]:
+    """Read a conversation
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        tuple[list[dict[str,str]], dict, int]: The messages, the metadata and the stored size,
+          None if the conversation is not stored
+    """
+    raise NotImplementedError()
+
+  def write(self, name:str, messages:list[dict[str,str]], meta:dict) -> int:
+    """Replace a conversation
+
+    Args:
+        name (str): The conversation name
+        messages (list[dict[str,str]]): The messages
+        meta (dict): The metadata
+
+    Returns:
+        int: The stored size
+    """
+    raise NotImplementedError()
+
+  def append(self, name:str, records:list[dict]) -> int:
+    """Apply journal records to a stored conversation
+
+    Args:
+        name (str): The conversation name
+        records (list[dict]): The records from journal.diff and journal.diff_meta
+
+    Returns:
+        int: The stored size
+    """
+    raise NotImplementedError()
+
+  def rename(self, old_name:str, new_name:str) -> None:
+    """Rename a stored conversation
+
+    Args:
+        old_name (str): The current name
+        new_name (str): The new name
+    """
+    raise NotImplementedError()
+
+  def delete(self, name:str) -> None:
+    """Delete a stored conversation
+
+    Args:
+        name (str): The conversation name
+    """
+    raise NotImplementedError()
+
+  def archive(self, age:float=COLD_STORAGE_AGE) -> int:
+    """Move conversations that were not written for a while to cheaper storage
+
+    Args:
+        age (float, optional): The seconds since the last write. Defaults to COLD_STORAGE_AGE.
+
+    Returns:
+        int: The number of moved conversations
+    """
+    return 0
+
+  def close(self) -> None:
+    """Release the resources of the store
+    """
+
+
+class _Journal:
+  """What the file store knows about a journal file
+  """
+
+  def __init__(self, records:int, messages:int, meta:dict) -> None:
+    self.records = records
+    self.messages = messages
+    self.meta_keys = set(meta.keys())
+    # the bytes of the last record of every partial answer and the bytes of the records they replaced
+    self.partial:dict[int, int] = {}
+    self.superseded = 0
+
+  def rewritten(self, messages:list[dict[str,str]], lengths:list[int]) -> None:
+    """Count the records of a journal that was rewritten
+
+    Args:
+        messages (list[dict[str,str]]): The messages that were written
+        lengths (list[int]): The bytes of every record, the messages first
+    """
+    self.records = len(lengths)
+    self.partial = {i: lengths[i] for i, message in enumerate(messages) if message.get(journal.PARTIAL_KEY, False)}
+    self.superseded = 0
+
+  def apply(self, record:dict, length:int) -> None:
+    """Count a record that was appended
+
+    Args:
+        record (dict): The record
+        length (int): The bytes of the record in the file
+    """
+    self.records += 1
+    index = None
+    if record["op"] == "append":
+      index = self.messages
+      self.messages += 1
+    elif record["op"] == "update":
+      index = record["index"]
+    elif record["op"] == "truncate":
+      self.messages = record["length"]
+      self.partial = {i: size for i, size in self.partial.items() if i < self.messages}
+    elif record["op"] == "meta":
+      self.meta_keys.add(record["key"])
+    elif record["op"] == "unset":
+      self.meta_keys.discard(record["key"])
+    if index is not None:
+      # a partial answer is written again by every save until it is complete
+      self.superseded += self.partial.pop(index, 0)
+      if record["message"].get(journal.PARTIAL_KEY, False):
+        self.partial[index] = length
+
+
+class FileStorage(Storage):
+  """Stores every conversation in a journal file named after it
+
+  Conversations from legacy JSON files and cold journals are read as well
+  and moved to a journal when they are written. Journals that were not
+  written for a while are compressed into cold journals by archive. The
+  catalog indexes the files.
+  """
+  catalog:catalog.Catalog
+
+  def __init__(self) -> None:
+    self.catalog = catalog.Catalog()
+    self._loaded = False
+    self._closed = False
+    self._journals:dict[str, _Journal] = {}
+    self._lock = threading.RLock()
+
+  def path(self, name:str) -> str:
+    """Get the file of a conversation, the cold or legacy file if there is no journal
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        str: The path to the file
+    """
+    path = functions.get_conversation_path(name)
+    if os.path.exists(path):
+      return path
+    for extension in [COLD_FILE_EXTENSION, LEGACY_FILE_EXTENSION]:
+      other_path = functions.get_conversation_path(name, extension)
+      if os.path.exists(other_path):
+        return other_path
+    return path
+
+  def entries(self) -> dict[str, catalog.CatalogEntry]:
+    with self._lock:
+      if not self._loaded:
+        self.catalog.load()
+        self._loaded = True
+    with self.catalog.lock:
+      return dict(self.catalog.entries)
+
+  def read(self, name:str) -> tuple[list[dict[str,str]], dict, int]:
+    with self._lock:
+      path = self.path(name)
+      try:
+        if path.endswith(LEGACY_FILE_EXTENSION):
+          with open(path, "r", encoding='utf-8') as f:
+            messages, meta, records = json.load(f), {}, 0
+        else:
+          messages, meta, records = journal.read(path, lazy=True)
+        size = self._size(name, path)
+      except FileNotFoundError:
+        return None
+      self._journals[name] = _Journal(records, len(messages), meta)
+      return messages, meta, size
+
+  def write(self, name:str, messages:list[dict[str,str]], meta:dict) -> int:
+    with self._lock:
+      path = functions.get_conversation_path(name)
+      functions.create_folder(os.path.dirname(path))
+      lengths = journal.rewrite(path, messages, meta)
+      self._journals[name] = _Journal(len(lengths), len(messages), meta)
+      self._journals[name].rewritten(messages, lengths)
+      for extension in [COLD_FILE_EXTENSION, LEGACY_FILE_EXTENSION]:
+        other_path = functions.get_conversation_path(name, extension)
+        if os.path.exists(other_path):
+          os.remove(other_path)
+      return self._written(name, path)
+
+  def append(self, name:str, records:list[dict]) -> int:
+    with self._lock:
+      path = functions.get_conversation_path(name)
+      state = self._journals.get(name)
+      if state is None or not os.path.exists(path):
+        stored = self.read(name)
+        messages, meta = ([], {}) if stored is None else stored[:2]
+        for record in records:
+          journal.apply(messages, meta, record)
+        return self.write(name, messages, meta)
+      for record, length in zip(records, journal.append(path, records)):
+        state.apply(record, length)
+      size = self._written(name, path)
+      if journal.needs_compaction(state.records, state.messages + len(state.meta_keys), state.superseded, size):
+        journal.compact_later(self._lock, lambda: self._compact_state(name), lambda messages, lengths: self._compacted(name, messages, lengths))
+      return size
+
+  def rename(self, old_name:str, new_name:str) -> None:
+    with self._lock:
+      old_path = self.path(old_name)
+      if not os.path.exists(old_path):
+        return
+      extension = next(
+        extension for extension in [COLD_FILE_EXTENSION, FILE_EXTENSION, LEGACY_FILE_EXTENSION]
+        if old_path.endswith(extension)
+      )
+      new_path = functions.get_conversation_path(new_name, extension)
+      size = self._size(old_name, old_path)
+      os.replace(old_path, new_path)
+      if old_name in self._journals:
+        self._journals[new_name] = self._journals.pop(old_name)
+      with self.catalog.lock:
+        entry = self.catalog.entries.get(old_name)
+        message_count = 0 if entry is None else entry.message_count
+      self.catalog.remove(old_name)
+      self.catalog.update(new_name, new_path, message_count, size)
+
+  def delete(self, name:str) -> None:
+    with self._lock:
+      for extension in [FILE_EXTENSION, COLD_FILE_EXTENSION, LEGACY_FILE_EXTENSION]:
+        path = functions.get_conversation_path(name, extension)
+        if os.path.exists(path):
+          os.remove(path)
+      self._journals.pop(name, None)
+      self.catalog.remove(name)
+
+  def archive(self, age:float=COLD_STORAGE_AGE) -> int:
+    """Compress the journals that were not written for a while into cold journals
+
+    The catalog is written once at the end. Closing the store stops the
+    archiving after the current journal.
+
+    Args:
+        age (float, optional): The seconds since the last write. Defaults to COLD_STORAGE_AGE.
+
+    Returns:
+        int: The number of compressed journals
+    """
+    limit = time.time() - age
+    archived = 0
+    try:
+      for name, entry in self.entries().items():
+        if not entry.path.endswith(FILE_EXTENSION) or entry.mtime > limit:
+          continue
+        with self._lock:
+          if self._closed:
+            break
+          if self._archive(name, limit):
+            archived += 1
+    finally:
+      if archived > 0:
+        self.catalog.save()
+    return archived
+
+  def close(self) -> None:
+    with self._lock:
+      self._closed = True
+    self.catalog.close()
+
+  def _archive(self, name:str, limit:float) -> bool:
+    """Compress a journal into a cold journal, called while the lock is held
+
+    Args:
+        name (str): The conversation name
+        limit (float): The latest modification time of a journal that is compressed
+
+    Returns:
+        bool: True if the journal was compressed
+    """
+    path = functions.get_conversation_path(name)
+    try:
+      if os.path.getmtime(path) > limit:
+        return False
+      cold_path = functions.get_conversation_path(name, COLD_FILE_EXTENSION)
+      size = journal.compress(path, cold_path)
+      os.remove(path)
+    except OSError:
+      return False
+    self._journals.pop(name, None)
+    with self.catalog.lock:
+      entry = self.catalog.entries.get(name)
+      message_count = 0 if entry is None else entry.message_count
+    self.catalog.update(name, cold_path, message_count, size, save=False)
+    return True
+
+  def _size(self, name:str, path:str) -> int:
+    """Get the size of a conversation file, the catalog knows the size of cold journals
+
+    Args:
+        name (str): The conversation name
+        path (str): The path to the file
+
+    Returns:
+        int: The size in bytes
+    """
+    if path.endswith(COLD_FILE_EXTENSION):
+      with self.catalog.lock:
+        entry = self.catalog.entries.get(name)
+      if entry is not None and entry.path == path:
+        return entry.size
+    return journal.size(path)
+
+  def _written(self, name:str, path:str) -> int:
+    """Update the catalog after a journal was written
+
+    Args:
+        name (str): The conversation name
+        path (str): The path to the journal
+
+    Returns:
+        int: The size of the journal
+    """
+    self.catalog.update(name, path, self._journals[name].messages)
+    return os.path.getsize(path)
+
+  def _compact_state(self, name:str) -> tuple[str, list[dict[str,str]], dict]:
+    """Read a journal for compaction
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        tuple[str, list[dict[str,str]], dict]: The path, the messages and the metadata
+    """
+    path = functions.get_conversation_path(name)
+    if not os.path.exists(path):
+      return path, [], {}
+    messages, meta, _ = journal.read(path)
+    return path, messages, meta
+
+  def _compacted(self, name:str, messages:list[dict[str,str]], lengths:list[int]) -> None:
+    """Store the record count after a journal was compacted
+
+    Args:
+        name (str): The conversation name
+        messages (list[dict[str,str]]): The messages in the journal
+        lengths (list[int]): The bytes of every record in the journal
+    """
+    if name in self._journals:
+      self._journals[name].rewritten(messages, lengths)
+
+
+class SQLiteStorage(Storage):
+  """Stores conversations and messages as rows of a SQLite database
+
+  Renaming is a single UPDATE, an appended message a single INSERT and the
+  chat list one query on the conversations table.
+  """
+  path:str
+
+  def __init__(self, path:str="") -> None:
+    if len(path) <= 0:
+      path = functions.get_config_path(DATABASE_FILE_NAME)
+    functions.create_folder(os.path.dirname(path))
+    self.path = path
+    self._lock = threading.RLock()
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.executescript("""
+      PRAGMA journal_mode=WAL;
+      PRAGMA synchronous=NORMAL;
+      PRAGMA foreign_keys=ON;
+      CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        meta TEXT NOT NULL DEFAULT '{}',
+        size INTEGER NOT NULL DEFAULT 0,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        updated REAL NOT NULL DEFAULT 0
+      );
+      CREATE TABLE IF NOT EXISTS messages (
+        conversation_id INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        extra TEXT,
+        PRIMARY KEY (conversation_id, position)
+      ) WITHOUT ROWID;
+    """)
+
+  def entries(self) -> dict[str, catalog.CatalogEntry]:
+    with self._lock:
+      rows = self._connection.execute(
+        "SELECT name, updated, size, message_count FROM conversations ORDER BY name"
+      ).fetchall()
+    return {
+      name: catalog.CatalogEntry(name, self.path, updated, size, message_count)
+      for name, updated, size, message_count in rows
+    }
+
+  def read(self, name:str) -> tuple[list[dict[str,str]], dict, int]:
+    with self._lock:
+      row = self._connection.execute(
+        "SELECT id, meta, size FROM conversations WHERE name = ?", (name,)
+      ).fetchone()
+      if row is None:
+        return None
+      conversation_id, meta, size = row
+      rows = self._connection.execute(
+        "SELECT role, content, extra FROM messages WHERE conversation_id = ? ORDER BY position",
+        (conversation_id,)
+      ).fetchall()
+    return [self._message(role, content, extra) for role, content, extra in rows], json.loads(meta), size
+
+  def write(self, name:str, messages:list[dict[str,str]], meta:dict) -> int:
+    with self._lock, self._connection:
+      conversation_id = self._conversation_id(name)
+      self._connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+      self._connection.executemany(
+        "INSERT INTO messages (conversation_id, position, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+        [(conversation_id, position) + self._columns(message) for position, message in enumerate(messages)]
+      )
+      size = sum(len(message["content"]) for message in messages)
+      self._connection.execute(
+        "UPDATE conversations SET meta = ?, size = ?, message_count = ?, updated = ? WHERE id = ?",
+        (json.dumps(meta), size, len(messages), time.time(), conversation_id)
+      )
+    return size
+
+  def append(self, name:str, records:list[dict]) -> int:
+    with self._lock, self._connection:
+      conversation_id = self._conversation_id(name)
+      meta, size, count = self._connection.execute(
+        "SELECT meta, size, message_count FROM conversations WHERE id = ?", (conversation_id,)
+      ).fetchone()
+      meta = json.loads(meta)
+      for record in records:
+        if record["op"] == "append":
+          self._connection.execute(
+            "INSERT INTO messages (conversation_id, position, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+            (conversation_id, count) + self._columns(record["message"])
+          )
+          size += len(record["message"]["content"])
+          count += 1
+        elif record["op"] == "update":
+          old = self._connection.execute(
+            "SELECT LENGTH(content) FROM messages WHERE conversation_id = ? AND position = ?",
+            (conversation_id, record["index"])
+          ).fetchone()
+          self._connection.execute(
+            "UPDATE messages SET role = ?, content = ?, extra = ? WHERE conversation_id = ? AND position = ?",
+            self._columns(record["message"]) + (conversation_id, record["index"])
+          )
+          size += len(record["message"]["content"]) - (0 if old is None else old[0])
+        elif record["op"] == "truncate":
+          removed = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(content)), 0) FROM messages WHERE conversation_id = ? AND position >= ?",
+            (conversation_id, record["length"])
+          ).fetchone()[0]
+          self._connection.execute(
+            "DELETE FROM messages WHERE conversation_id = ? AND position >= ?",
+            (conversation_id, record["length"])
+          )
+          size -= removed
+          count = min(count, record["length"])
+        elif record["op"] == "meta":
+          meta[record["key"]] = record["value"]
+        elif record["op"] == "unset":
+          meta.pop(record["key"], None)
+      self._connection.execute(
+        "UPDATE conversations SET meta = ?, size = ?, message_count = ?, updated = ? WHERE id = ?",
+        (json.dumps(meta), size, count, time.time(), conversation_id)
+      )
+    return size
+
+  def rename(self, old_name:str, new_name:str) -> None:
+    with self._lock, self._connection:
+      self._connection.execute("UPDATE conversations SET name = ? WHERE name = ?", (new_name, old_name))
+
+  def delete(self, name:str) -> None:
+    with self._lock, self._connection:
+      self._connection.execute("DELETE FROM conversations WHERE name = ?", (name,))
+
+  def close(self) -> None:
+    with self._lock:
+      self._connection.close()
+
+  def _conversation_id(self, name:str) -> int:
+    """Get the row id of a conversation, the row is created if it does not exist
+
+    Args:
+        name (str): The conversation name
+
+    Returns:
+        int: The row id
+    """
+    self._connection.execute(
+      "INSERT OR IGNORE INTO conversations (name, updated) VALUES (?, ?)", (name, time.time())
+    )
+    return self._connection.execute("SELECT id FROM conversations WHERE name = ?", (name,)).fetchone()[0]
+
+  def _columns(self, message:dict[str,str]) -> tuple[str, str, str]:
+    """Split a message into its columns
+
+    Args:
+        message (dict[str,str]): The message
+
+    Returns:
+        tuple[str, str, str]: The role, the content and the other keys as JSON or None
+    """
+    extra = {key: value for key, value in message.items() if key not in ("role", "content")}
+    return message["role"], message["content"], json.dumps(extra) if len(extra) > 0 else None
+
+  def _message(self, role:str, content:str, extra:str) -> dict[str,str]:
+    """Build a message from its columns
+
+    Args:
+        role (str): The role
+        content (str): The content
+        extra (str): The other keys as JSON or None
+
+    Returns:
+        dict[str,str]: The message
+    """
+    message = {"role": role, "content": content}
+    if extra is not None:
+      message.update(json.loads(extra))
+    return message
+
+
+def open_storage(kind:str=None) -> Storage:
+  """Open the conversation store
+
+  Args:
+      kind (str, optional): files or sqlite. Defaults to the OPENAI_CHAT_STORAGE environment variable.
+
+  Returns:
+      Storage: The store
+  """
+  if kind is None:
+    kind = os.environ.get(STORAGE_ENV, FILES)
+  if kind == SQLITE:
+    return SQLiteStorage()
+  return FileStorage()
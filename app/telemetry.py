@@ -0,0 +1,367 @@
+"""Latency and token measurements of the chat requests
+
+Every answer gets the measurements of its request: the time it waited for
+the rate limits of its model, the time to the first token, the total time,
+the prompt and completion tokens reported by the API (estimated for cached
+answers), the tokens per second and the number of retries. They are stored
+with the answer and appended to ~/.openai-chat/metrics.jsonl:
+
+  {"time": 1718000000.0, "model": "gpt-4-turbo-preview", "queued": 0.0, "first_token": 0.41, ...}
+
+~/.openai-chat/metrics.prom holds the counters and the p50 and p95 latencies
+of every model since the app was started in the Prometheus text format, e.g.
+for the node exporter's textfile collector, and the estimated memory of all
+loaded conversations together. It is written METRICS_PROMETHEUS_INTERVAL
+seconds after a request finished and when the log is closed, the memory is
+only estimated then.
+"""
+
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from typing import Callable
+from constants import METRICS_FILE_NAME, METRICS_PROMETHEUS_FILE_NAME, METRICS_PROMETHEUS_INTERVAL, METRICS_SAMPLES
+import functions
+
+
+QUANTILES = (0.5, 0.95)
+TASK_CHAT = "chat"
+TASK_NAMING = "naming"
+TASK_SUMMARY = "summary"
+
+
+class RequestMetrics:
+  """The measurements of one request, times in seconds since the prompt was sent
+  """
+  model:str
+  task:str
+  time:float
+  queued:float
+  first_token:float
+  total:float
+  prompt_tokens:int
+  completion_tokens:int
+  retries:int
+  cached:bool
+  error:bool
+
+  def __init__(self, model:str, task:str=TASK_CHAT) -> None:
+    self.model = model
+    self.task = task
+    self.time = time.time()
+    self.queued = None
+    self.first_token = None
+    self.total = None
+    self.prompt_tokens = None
+    self.completion_tokens = None
+    self.retries = 0
+    self.cached = False
+    self.error = False
+    self._start = time.monotonic()
+
+  @classmethod
+  def of(cls, data:dict) -> "RequestMetrics":
+    """Restore measurements from their dict, e.g. the ones sent by the daemon
+
+    Args:
+        data (dict): The measurements from to_dict
+
+    Returns:
+        RequestMetrics: The measurements
+    """
+    metrics = cls(data["model"], data.get("task", TASK_CHAT))
+    for name in ("time", "queued", "first_token", "total", "prompt_tokens", "completion_tokens", "retries", "cached", "error"):
+      if name in data:
+        setattr(metrics, name, data[name])
+    return metrics
+
+  def elapsed(self) -> float:
+    """Get the seconds since the prompt was sent
+
+    Returns:
+        float: The seconds
+    """
+    return time.monotonic() - self._start
+
+  def first_delta(self) -> None:
+    """Record the time to the first token, later calls are ignored
+    """
+    if self.first_token is None:
+      self.first_token = self.elapsed()
+
+  def finish(self, prompt_tokens:int, completion_tokens:int, error:bool=False) -> None:
+    """Record the total time when the answer is complete
+
+    Token counts the API reported are kept, the estimates are only used for
+    answers that did not come from the API.
+
+    Args:
+        prompt_tokens (int): The estimated tokens of the prompt
+        completion_tokens (int): The estimated tokens of the answer
+        error (bool, optional): True if the request failed. Defaults to False.
+    """
+    self.total = self.elapsed()
+    if self.first_token is None:
+      self.first_token = self.total
+    # the scheduler sets the queue time for every request sent to the API
+    self.cached = self.queued is None and not error
+    if self.prompt_tokens is None:
+      self.prompt_tokens = prompt_tokens
+    if self.completion_tokens is None:
+      self.completion_tokens = completion_tokens
+    self.error = error
+
+  @property
+  def tokens_per_second(self) -> float:
+    """The completion tokens per second of the whole request
+    """
+    if not self.total or self.total <= 0:
+      return 0.0
+    return (self.completion_tokens or 0) / self.total
+
+  def to_dict(self) -> dict:
+    """Convert the measurements to a JSON serializable dict
+
+    Returns:
+        dict: The measurements
+    """
+    return {
+      "time": self.time,
+      "model": self.model,
+      "task": self.task,
+      "queued": self.queued or 0.0,
+      "first_token": self.first_token,
+      "total": self.total,
+      "prompt_tokens": self.prompt_tokens,
+      "completion_tokens": self.completion_tokens,
+      "tokens_per_second": self.tokens_per_second,
+      "retries": self.retries,
+      "cached": self.cached,
+      "error": self.error,
+    }
+
+
+def quantile(values:list[float], q:float) -> float:
+  """Get a quantile with linear interpolation between the closest values
+
+  Args:
+      values (list[float]): The values, in any order
+      q (float): The quantile between 0 and 1
+
+  Returns:
+      float: The quantile, 0 without values
+  """
+  if len(values) <= 0:
+    return 0.0
+  ordered = sorted(values)
+  position = (len(ordered) - 1) * q
+  lower = int(position)
+  upper = min(lower + 1, len(ordered) - 1)
+  return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class ModelStats:
+  """The counters and the latest latencies of a model
+  """
+  requests:int
+  errors:int
+  retries:int
+  prompt_tokens:int
+  completion_tokens:int
+  latencies:dict[str, deque]
+  sums:dict[str, float]
+
+  def __init__(self, samples:int) -> None:
+    self.requests = 0
+    self.errors = 0
+    self.retries = 0
+    self.prompt_tokens = 0
+    self.completion_tokens = 0
+    self.latencies = {name: deque(maxlen=samples) for name in ("queued", "first_token", "total")}
+    self.sums = {name: 0.0 for name in self.latencies.keys()}
+
+  def add(self, metrics:RequestMetrics) -> None:
+    """Count a finished request
+
+    Args:
+        metrics (RequestMetrics): The measurements of the request
+    """
+    self.requests += 1
+    self.retries += metrics.retries
+    if metrics.error:
+      self.errors += 1
+      return
+    self.prompt_tokens += metrics.prompt_tokens or 0
+    self.completion_tokens += metrics.completion_tokens or 0
+    for name, value in [("queued", metrics.queued or 0.0), ("first_token", metrics.first_token), ("total", metrics.total)]:
+      self.latencies[name].append(value)
+      self.sums[name] += value
+
+
+class MetricsLog:
+  """Collects the measurements of all requests and writes them to the metrics files
+  """
+  path:str
+  prometheus_path:str
+  samples:int
+  models:dict[str, ModelStats]
+  last:RequestMetrics
+  memory:Callable[[], dict]
+
+  def __init__(self, path:str="", prometheus_path:str="", samples:int=METRICS_SAMPLES) -> None:
+    if len(path) <= 0:
+      path = functions.get_config_path(METRICS_FILE_NAME)
+    if len(prometheus_path) <= 0:
+      prometheus_path = functions.get_config_path(METRICS_PROMETHEUS_FILE_NAME)
+    self.path = path
+    self.prometheus_path = prometheus_path
+    self.samples = samples
+    self.models = {}
+    self.last = None
+    self.memory = None
+    self._lock = threading.Lock()
+    self._timer:threading.Timer = None
+
+  def record(self, metrics:RequestMetrics) -> None:
+    """Add the measurements of a finished request, append them to the log and write the Prometheus file later
+
+    Writing the files must not break a request, errors are ignored. Only chat
+    requests are shown as the last request, not the background ones.
+
+    Args:
+        metrics (RequestMetrics): The measurements
+    """
+    with self._lock:
+      if metrics.model not in self.models:
+        self.models[metrics.model] = ModelStats(self.samples)
+      self.models[metrics.model].add(metrics)
+      if metrics.task == TASK_CHAT:
+        self.last = metrics
+      try:
+        functions.create_folder(os.path.dirname(self.path))
+        with open(self.path, "a", encoding='utf-8') as f:
+          f.write(json.dumps(metrics.to_dict()) + "\n")
+      except OSError:
+        pass
+      if self._timer is None:
+        self._timer = threading.Timer(METRICS_PROMETHEUS_INTERVAL, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def flush(self) -> None:
+    """Write the Prometheus file if a request finished since it was written
+    """
+    with self._lock:
+      if self._timer is None:
+        return
+      self._timer.cancel()
+      self._timer = None
+    try:
+      functions.create_folder(os.path.dirname(self.prometheus_path))
+      self._write_prometheus()
+    except OSError:
+      pass
+
+  def close(self) -> None:
+    """Write the Prometheus file of the last requests
+    """
+    self.flush()
+
+  def percentiles(self, model:str, name:str="total") -> tuple[float, float]:
+    """Get the p50 and p95 of a latency of a model
+
+    Args:
+        model (str): The model name
+        name (str, optional): queued, first_token or total. Defaults to "total".
+
+    Returns:
+        tuple[float, float]: The p50 and p95 in seconds
+    """
+    with self._lock:
+      stats = self.models.get(model)
+      values = [] if stats is None else list(stats.latencies[name])
+    return quantile(values, 0.5), quantile(values, 0.95)
+
+  def prometheus(self) -> str:
+    """Format the counters, latencies and memory in the Prometheus text exposition format
+
+    Returns:
+        str: The metrics
+    """
+    with self._lock:
+      lines = self._model_lines()
+    if self.memory is not None:
+      reports = self.memory().values()
+      name = "openai_chat_loaded_conversations"
+      lines.append(f"# HELP {name} Conversations with their messages in memory")
+      lines.append(f"# TYPE {name} gauge")
+      lines.append(f"{name} {len(reports)}")
+      name = "openai_chat_conversation_memory_bytes"
+      lines.append(f"# HELP {name} Estimated memory of the loaded conversations, mapped is in the journal files")
+      lines.append(f"# TYPE {name} gauge")
+      totals = [report.to_dict() for report in reports]
+      for kind in ["resident", "display", "mapped"]:
+        lines.append(f'{name}{{kind="{kind}"}} {sum(data[kind] for data in totals)}')
+    return "\n".join(lines) + "\n"
+
+  def _model_lines(self) -> list[str]:
+    """Format the counters and latencies of every model, called while the lock is held
+
+    Returns:
+        list[str]: The lines
+    """
+    lines:list[str] = []
+    summaries = [
+      ("queued", "openai_chat_queue_seconds", "Time requests waited for the rate limits"),
+      ("first_token", "openai_chat_first_token_seconds", "Time to the first token"),
+      ("total", "openai_chat_request_seconds", "Total time of the requests"),
+    ]
+    for key, name, help_text in summaries:
+      lines.append(f"# HELP {name} {help_text}")
+      lines.append(f"# TYPE {name} summary")
+      for model, stats in sorted(self.models.items()):
+        label = _label(model)
+        values = list(stats.latencies[key])
+        for q in QUANTILES:
+          lines.append(f'{name}{{model="{label}",quantile="{q}"}} {quantile(values, q):.6f}')
+        lines.append(f'{name}_sum{{model="{label}"}} {stats.sums[key]:.6f}')
+        lines.append(f'{name}_count{{model="{label}"}} {stats.requests - stats.errors}')
+    counters = [
+      ("openai_chat_requests_total", "Finished requests", lambda stats: [("", stats.requests)]),
+      ("openai_chat_errors_total", "Failed requests", lambda stats: [("", stats.errors)]),
+      ("openai_chat_retries_total", "Retried requests", lambda stats: [("", stats.retries)]),
+      ("openai_chat_tokens_total", "Prompt and completion tokens", lambda stats: [
+        (',kind="prompt"', stats.prompt_tokens),
+        (',kind="completion"', stats.completion_tokens),
+      ]),
+    ]
+    for name, help_text, values in counters:
+      lines.append(f"# HELP {name} {help_text}")
+      lines.append(f"# TYPE {name} counter")
+      for model, stats in sorted(self.models.items()):
+        for labels, value in values(stats):
+          lines.append(f'{name}{{model="{_label(model)}"{labels}}} {value}')
+    return lines
+
+  def _write_prometheus(self) -> None:
+    """Replace the Prometheus file, a scraper never sees it half written
+    """
+    tmp_path = self.prometheus_path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+      f.write(self.prometheus())
+    os.replace(tmp_path, self.prometheus_path)
+
+
+def _label(value:str) -> str:
+  """Escape a Prometheus label value
+
+  Args:
+      value (str): The value
+
+  Returns:
+      str: The escaped value
+  """
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,189 @@
+"""Runs chat requests on background threads and hands the results back to the UI
+"""
+
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from constants import MAX_PARALLEL_REQUESTS
+from cancel import CancelToken
+import conversation
+import base
+
+
+class RequestEvent:
+  """An event posted by a background request for the UI thread
+  """
+  DELTA = "delta"
+  DONE = "done"
+  RENAMED = "renamed"
+
+  kind:str
+  conv_key:str
+  new_key:str
+  conversation:conversation.Conversation
+
+  def __init__(self, kind:str, conv_key:str, conv:conversation.Conversation, new_key:str=None) -> None:
+    self.kind = kind
+    self.conv_key = conv_key
+    self.conversation = conv
+    self.new_key = new_key
+
+
+class RequestPool:
+  """A pool of worker threads sending prompts to the chat model
+
+  Prompts for the same conversation are sent one after another,
+  prompts for different conversations are sent in parallel. The running
+  request of a conversation can be cancelled.
+  """
+  client:base.ClientBase
+  events:queue.Queue
+  pending:dict[int, list[tuple[str, list[str]]]]
+  running:dict[int, CancelToken]
+
+  def __init__(self, client:base.ClientBase, max_workers:int=MAX_PARALLEL_REQUESTS) -> None:
+    self.client = client
+    self.events = queue.Queue()
+    self.pending = {}
+    self.running = {}
+    self.lock = threading.Lock()
+    self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="request")
+    self.client.rename_callbacks.append(self._renamed)
+
+  def submit(self, conv_key:str, prompt:str, models:list[str]=None) -> str:
+    """Queue a prompt for a conversation
+
+    Args:
+        conv_key (str): The conversation key or None for a new conversation
+        prompt (str): The message to send
+        models (list[str], optional): Send the prompt to all of these models
+          to compare their answers. Defaults to None for the chat model.
+
+    Returns:
+        str: The conversation key, the provisional name for a new conversation
+    """
+    if conv_key is None:
+      conv_key = self.client.new_conversation(prompt)
+    conv = self.client.conversations[conv_key]
+    self.client.recency.touch(conv_key)
+    with self.lock:
+      if id(conv) in self.pending:
+        self.pending[id(conv)].append((prompt, models))
+        return conv_key
+      self.pending[id(conv)] = []
+    self.executor.submit(self._run, conv, prompt, models)
+    return conv_key
+
+  def is_in_flight(self, conv_key:str) -> bool:
+    """Check if a request for a conversation is running or queued
+
+    Args:
+        conv_key (str): The conversation key
+
+    Returns:
+        bool: True if the conversation is waiting for an answer
+    """
+    conv = self.client.conversations.get(conv_key)
+    return conv is not None and id(conv) in self.pending
+
+  def cancel(self, conv_key:str) -> bool:
+    """Stop the running request of a conversation, its answer so far is kept
+
+    Queued prompts of the conversation are still sent.
+
+    Args:
+        conv_key (str): The conversation key
+
+    Returns:
+        bool: True if a running request was cancelled
+    """
+    conv = self.client.conversations.get(conv_key)
+    if conv is None:
+      return False
+    with self.lock:
+      token = self.running.get(id(conv))
+    return token is not None and token.cancel()
+
+  def drain(self) -> list[RequestEvent]:
+    """Take all events posted since the last call
+
+    Consecutive delta events of a conversation are merged into the latest one.
+
+    Returns:
+        list[RequestEvent]: The events in the order they were posted
+    """
+    events:list[RequestEvent] = []
+    deltas:dict[int, int] = {}
+    while True:
+      try:
+        event:RequestEvent = self.events.get_nowait()
+      except queue.Empty:
+        break
+      conv_id = id(event.conversation)
+      if event.kind == RequestEvent.DELTA and conv_id in deltas:
+        events[deltas[conv_id]] = event
+        continue
+      if event.kind == RequestEvent.DELTA:
+        deltas[conv_id] = len(events)
+      else:
+        deltas.pop(conv_id, None)
+      events.append(event)
+    return events
+
+  def shutdown(self, wait:bool=False) -> None:
+    """Stop the workers and cancel the running requests
+
+    Args:
+        wait (bool, optional): Wait until the cancelled requests saved their answers. Defaults to False.
+    """
+    self.executor.shutdown(wait=False, cancel_futures=True)
+    with self.lock:
+      tokens = list(self.running.values())
+    for token in tokens:
+      token.cancel()
+    if wait:
+      self.executor.shutdown(wait=True)
+
+  def _renamed(self, old_key:str, new_key:str) -> None:
+    """Tell the UI that a conversation was renamed
+
+    Args:
+        old_key (str): The previous conversation key
+        new_key (str): The new conversation key
+    """
+    conv = self.client.conversations.get(new_key)
+    self.events.put(RequestEvent(RequestEvent.RENAMED, old_key, conv, new_key))
+
+  def _run(self, conv:conversation.Conversation, prompt:str, models:list[str]=None) -> None:
+    """Send a prompt and post the events for it
+
+    Args:
+        conv (conversation.Conversation): The conversation
+        prompt (str): The message to send
+        models (list[str], optional): The models to compare. Defaults to None.
+    """
+    conv_key = conv.name
+    on_delta = lambda _: self.events.put(RequestEvent(RequestEvent.DELTA, conv_key, conv))
+    token = CancelToken()
+    with self.lock:
+      self.running[id(conv)] = token
+    try:
+      if models is None:
+        self.client.send(conv_key, prompt, on_delta, token)
+      else:
+        self.client.fan_out(conv_key, prompt, models, on_delta, token)
+    finally:
+      next_request:tuple[str, list[str]] = None
+      with self.lock:
+        self.running.pop(id(conv), None)
+        if conv.deleted:
+          # the queued prompts would bring the conversation back
+          self.pending.pop(id(conv), None)
+        elif len(self.pending.get(id(conv), [])) > 0:
+          next_request = self.pending[id(conv)].pop(0)
+        else:
+          self.pending.pop(id(conv), None)
+      self.events.put(RequestEvent(RequestEvent.DONE, conv_key, conv, conv.name))
+      if next_request is not None:
+        self.executor.submit(self._run, conv, *next_request)
@@ -0,0 +1,450 @@
+"""Word wrapping of message texts for the chat view
+
+Lines are generated from the text on demand in one pass over it. Widths are
+measured in terminal cells with a table that is filled page by page, so
+wide glyphs (CJK, emoji) and combining marks keep the lines aligned. Words
+that do not fit into a line on their own are split, lines inside code fences
+are split at the width instead of between words. Columns puts several
+wrapped texts next to each other.
+
+Long texts do not keep their lines. Every CHECKPOINT_LINES lines the offset
+in the text is remembered, a viewport is generated from the checkpoint in
+front of it. A text that is read by a function, e.g. from a journal file,
+is not kept either and read again when a viewport is generated.
+"""
+
+
+import re
+import sys
+import unicodedata
+from typing import Callable, Iterator
+
+
+CHECKPOINT_LINES = 64
+FAST_LINE_LENGTH = 4096
+TAB_SIZE = 4
+MIN_WIDTH = 3 # cells of the narrowest line, a split word needs a cell for itself and one for the space
+
+_FENCE = re.compile(r"[ \t]*```")
+_pages:dict[int, bytes] = {}
+
+
+def _measure(char:str) -> int:
+  """Look up the number of terminal cells of a character in the Unicode database
+
+  Args:
+      char (str): The character
+
+  Returns:
+      int: 0 for combining and invisible characters, 2 for wide ones, else 1
+  """
+  if unicodedata.east_asian_width(char) in ("W", "F"):
+    return 2
+  if unicodedata.category(char) in ("Mn", "Me", "Cf"):
+    return 0
+  return 1
+
+
+def char_width(char:str) -> int:
+  """Get the number of terminal cells of a character
+
+  The widths are kept in a table with pages of 256 code points, a page is
+  filled when one of its characters is measured the first time.
+
+  Args:
+      char (str): The character
+
+  Returns:
+      int: 0 for combining and invisible characters, 2 for wide ones, else 1
+  """
+  code = ord(char)
+  if code < 0x300:
+    return 1
+  page = _pages.get(code >> 8)
+  if page is None:
+    start = code & ~0xFF
+    page = bytes(_measure(chr(start + i)) for i in range(256))
+    _pages[code >> 8] = page
+  return page[code & 0xFF]
+
+
+def text_width(text:str) -> int:
+  """Get the number of terminal cells of a text
+
+  Args:
+      text (str): The text without line breaks
+
+  Returns:
+      int: The width
+  """
+  if text.isascii():
+    return len(text)
+  return sum(char_width(char) for char in text)
+
+
+def _split(text:str, start:int, end:int, width:int) -> int:
+  """Find where the part of a text that fits into a width ends
+
+  Only the characters that can fit are looked at.
+
+  Args:
+      text (str): The text
+      start (int): The offset of the part
+      end (int): The offset after the part
+      width (int): The available cells
+
+  Returns:
+      int: The offset after the last character that fits, at least one character after start
+  """
+  width = max(width, 1)
+  chunk = text[start:min(end, start + width)]
+  if chunk.isascii():
+    return start + len(chunk)
+  used = 0
+  i = start
+  while i < end:
+    used += char_width(text[i])
+    if used > width and i > start:
+      break
+    i += 1
+  return i
+
+
+def wrap(text:str, width:int, offset:int=0, code:bool=False) -> Iterator[tuple[str, int, bool]]:
+  """Generate the wrapped lines of a text
+
+  Every line of the text gives at least one line, words are followed by a
+  space like they are in the chat view. Lines are at least MIN_WIDTH cells
+  wide, narrower views get lines that are too wide instead of none.
+
+  Args:
+      text (str): The text, tabs already expanded
+      width (int): The number of cells of a line
+      offset (int, optional): The offset of the first line. Defaults to 0.
+      code (bool, optional): True if the offset is inside a code fence. Defaults to False.
+
+  Yields:
+      tuple[str, int, bool]: The line, the offset of the next line and
+        whether the next line is inside a code fence
+  """
+  width = max(width, MIN_WIDTH)
+  length = len(text)
+  fences = text.find("```", offset) >= 0
+  while True:
+    eol = text.find("\n", offset)
+    if eol < 0:
+      eol = length
+    if offset == 0 or text[offset - 1] == "\n":
+      if fences and _FENCE.match(text, offset, eol):
+        code = not code
+        offset = yield from _hard_wrap(text, offset, eol, width, code)
+      elif code:
+        offset = yield from _hard_wrap(text, offset, eol, width, code)
+      else:
+        offset = yield from _word_wrap(text, offset, eol, width, code)
+    elif code:
+      offset = yield from _hard_wrap(text, offset, eol, width, code)
+    else:
+      offset = yield from _word_wrap(text, offset, eol, width, code)
+    if offset > length:
+      return
+
+
+def _hard_wrap(text:str, offset:int, eol:int, width:int, code:bool) -> Iterator[tuple[str, int, bool]]:
+  """Split a line at the width, keeping all of its spaces
+
+  Args:
+      text (str): The text
+      offset (int): The offset of the first character
+      eol (int): The offset of the line break or the end of the text
+      width (int): The number of cells of a line
+      code (bool): Whether the line is inside a code fence
+
+  Yields:
+      tuple[str, int, bool]: The line, the offset of the next line and the code fence state
+
+  Returns:
+      int: The offset after the line break
+  """
+  while True:
+    end = _split(text, offset, eol, width - 1)
+    if end >= eol:
+      yield text[offset:eol] + " ", eol + 1, code
+      return eol + 1
+    yield text[offset:end] + " ", end, code
+    offset = end
+
+
+def _word_wrap(text:str, offset:int, eol:int, width:int, code:bool) -> Iterator[tuple[str, int, bool]]:
+  """Wrap a line between words, splitting words that are wider than a line
+
+  Args:
+      text (str): The text
+      offset (int): The offset of the first word
+      eol (int): The offset of the line break or the end of the text
+      width (int): The number of cells of a line
+      code (bool): Whether the line is inside a code fence
+
+  Yields:
+      tuple[str, int, bool]: The line, the offset of the next line and the code fence state
+
+  Returns:
+      int: The offset after the line break
+  """
+  if eol - offset < FAST_LINE_LENGTH:
+    line = text[offset:eol]
+    if line.isascii():
+      return (yield from _word_wrap_ascii(line, offset, eol, width, code))
+  parts:list[str] = []
+  used = 0
+  while True:
+    space = text.find(" ", offset, eol)
+    end = eol if space < 0 else space
+    if end - offset < width:
+      word = text[offset:end]
+      word_width = text_width(word)
+    else:
+      word_width = width
+    if used + word_width + 1 < width:
+      parts.append(word + " ")
+      used += word_width + 1
+    elif len(parts) > 0:
+      yield "".join(parts), offset, code
+      parts = []
+      used = 0
+      continue
+    else:
+      split = _split(text, offset, end, width - 2)
+      while split < end:
+        yield text[offset:split] + " ", split, code
+        offset = split
+        split = _split(text, offset, end, width - 2)
+      word = text[offset:end]
+      parts.append(word + " ")
+      used = text_width(word) + 1
+    if space < 0:
+      yield "".join(parts), eol + 1, code
+      return eol + 1
+    offset = space + 1
+
+
+def _word_wrap_ascii(line:str, offset:int, eol:int, width:int, code:bool) -> Iterator[tuple[str, int, bool]]:
+  """Wrap a short ASCII line, where every character is one cell wide
+
+  Args:
+      line (str): The line
+      offset (int): The offset of the line in the text
+      eol (int): The offset of the line break or the end of the text
+      width (int): The number of cells of a line
+      code (bool): Whether the line is inside a code fence
+
+  Yields:
+      tuple[str, int, bool]: The line, the offset of the next line and the code fence state
+
+  Returns:
+      int: The offset after the line break
+  """
+  parts:list[str] = []
+  used = 0
+  for word in line.split(" "):
+    length = len(word)
+    if used + length + 1 >= width:
+      if len(parts) > 0:
+        yield " ".join(parts) + " ", offset, code
+        parts = []
+        used = 0
+      while length + 1 >= width:
+        yield word[:width - 2] + " ", offset + width - 2, code
+        word = word[width - 2:]
+        offset += width - 2
+        length -= width - 2
+    parts.append(word)
+    used += length + 1
+    offset += length + 1
+  yield " ".join(parts) + " ", eol + 1, code
+  return eol + 1
+
+
+class WrappedText:
+  """The wrapped lines of a text
+
+  Short texts keep their lines, long texts only keep a checkpoint every
+  CHECKPOINT_LINES lines and generate the lines that are asked for.
+  """
+  width:int
+  count:int
+
+  def __init__(self, text:str|Callable[[], str], width:int) -> None:
+    self.width = width
+    self.count = 0
+    self._text = ""
+    self._read:Callable[[], str] = None
+    self._checkpoints:list[tuple[int, bool]] = [(0, False)]
+    self._lines:list[str] = []
+    if callable(text):
+      self.extend(text())
+      self._read = text
+      self._text = None
+    else:
+      self.extend(text)
+
+  def __len__(self) -> int:
+    return self.count
+
+  @property
+  def text(self) -> str:
+    """The text, read again if it is not kept
+    """
+    if self._text is None:
+      text = self._read()
+      return text.expandtabs(TAB_SIZE) if "\t" in text else text
+    return self._text
+
+  def extend(self, text:str) -> None:
+    """Wrap a text that continues the current one, e.g. a growing answer
+
+    Only the lines after the last checkpoint are wrapped again.
+
+    Args:
+        text (str): The new text, starting with the current text
+    """
+    if "\t" in text:
+      text = text.expandtabs(TAB_SIZE)
+    self._text = text
+    self._read = None
+    checkpoint = len(self._checkpoints) - 1
+    offset, code = self._checkpoints[checkpoint]
+    self.count = checkpoint * CHECKPOINT_LINES
+    lines:list[str] = []
+    for line, offset, code in wrap(text, self.width, offset, code):
+      self.count += 1
+      # the end of the text is no checkpoint, the last line may still grow
+      if self.count % CHECKPOINT_LINES == 0 and offset <= len(text):
+        self._checkpoints.append((offset, code))
+      if self.count <= CHECKPOINT_LINES:
+        lines.append(line)
+    self._lines = lines if self.count <= CHECKPOINT_LINES else []
+
+  def memory(self) -> int:
+    """Estimate the bytes of memory the text and its kept lines use
+
+    Returns:
+        int: The size of the kept text, the lines and the checkpoints
+    """
+    size = sys.getsizeof(self._lines) + sys.getsizeof(self._checkpoints)
+    if self._text is not None:
+      size += sys.getsizeof(self._text)
+    return size + sum(sys.getsizeof(line) for line in self._lines)
+
+  def lines(self, start:int, end:int) -> list[str]:
+    """Get a range of lines
+
+    Args:
+        start (int): The index of the first line
+        end (int): The index after the last line
+
+    Returns:
+        list[str]: The lines from start to end
+    """
+    end = min(end, self.count)
+    if start >= end:
+      return []
+    if self.count <= CHECKPOINT_LINES:
+      return self._lines[start:end]
+    checkpoint = start // CHECKPOINT_LINES
+    offset, code = self._checkpoints[checkpoint]
+    index = checkpoint * CHECKPOINT_LINES
+    lines:list[str] = []
+    # a text that is not kept is read once for the viewport
+    for line, _, _ in wrap(self.text, self.width, offset, code):
+      if index >= start:
+        lines.append(line)
+        if index + 1 >= end:
+          break
+      index += 1
+    return lines
+
+
+def pad(text:str, width:int) -> str:
+  """Fill a line with spaces until it has a width
+
+  Args:
+      text (str): The line
+      width (int): The number of cells
+
+  Returns:
+      str: The line, cut at the width if it is wider
+  """
+  used = text_width(text)
+  if used > width:
+    end = _split(text, 0, len(text), width)
+    text = text[:end]
+    used = text_width(text)
+  return text + " " * (width - used)
+
+
+class Columns:
+  """Texts wrapped into columns next to each other
+
+  Every column starts with a few header lines, e.g. a title, that are cut
+  instead of wrapped.
+  """
+  width:int
+  column_width:int
+  separator:str
+  headers:list[list[str]]
+  columns:list[WrappedText]
+
+  def __init__(self, headers:list[list[str]], texts:list[str|Callable[[], str]], width:int, separator:str=" │ ") -> None:
+    self.width = width
+    self.separator = separator
+    self.column_width = max((width - len(separator) * (len(texts) - 1)) // max(len(texts), 1), 1)
+    self.headers = []
+    self.columns = [WrappedText(text, self.column_width) for text in texts]
+    self.update(headers, texts)
+
+  def __len__(self) -> int:
+    return max(len(header) for header in self.headers) + max(len(column) for column in self.columns)
+
+  def update(self, headers:list[list[str]], texts:list[str|Callable[[], str]]) -> None:
+    """Show new headers and texts, texts that grew are only wrapped from their last checkpoint
+
+    Args:
+        headers (list[list[str]]): The header lines of every column
+        texts (list[str|Callable[[], str]]): The text of every column or a function that reads it
+    """
+    self.headers = headers
+    for i, text in enumerate(texts):
+      column = self.columns[i]
+      if callable(text):
+        self.columns[i] = WrappedText(text, self.column_width)
+        continue
+      if text == column.text:
+        continue
+      if text.startswith(column.text):
+        column.extend(text)
+      else:
+        self.columns[i] = WrappedText(text, self.column_width)
+
+  def lines(self, start:int, end:int) -> list[str]:
+    """Get a range of lines
+
+    Args:
+        start (int): The index of the first line
+        end (int): The index after the last line
+
+    Returns:
+        list[str]: The lines from start to end
+    """
+    end = min(end, len(self))
+    if start >= end:
+      return []
+    rows = max(len(header) for header in self.headers)
+    cells:list[list[str]] = []
+    for header, column in zip(self.headers, self.columns):
+      header = header + [""] * (rows - len(header))
+      cells.append(header[start:end] + column.lines(max(start - rows, 0), end - rows))
+    return [
+      self.separator.join(pad(column[i] if i < len(column) else "", self.column_width) for column in cells)
+      for i in range(end - start)
+    ]
@@ -0,0 +1,376 @@
+"""End to end benchmarks against the local stub server
+
+Measures Client.send round trips, Conversation.values rendering, saving and
+loading of conversations and the cold startup of app/main.py. The results are
+written to a JSON file, a previous result file can be passed as a baseline to
+fail on regressions:
+
+  python tests/benchmarks.py --output bench_results.json
+  python tests/benchmarks.py --baseline bench_results.json --tolerance 0.25
+"""
+
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from typing import Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app")
+if APP not in sys.path:
+  sys.path.insert(0, APP)
+if ROOT not in sys.path:
+  sys.path.insert(0, ROOT)
+
+from tests.stub_server import StubServer
+
+
+WORDS = (
+  "the quick brown fox jumps over a lazy dog while seven wizards quietly " +
+  "pack boxes of liquor jugs and a sphinx of black quartz judges my vow"
+).split()
+
+STARTUP_SCRIPT = (
+  "import main, application\n" +
+  "client = main.oaic.Client()\n" +
+  "application.App(client)\n"
+)
+
+
+def summarize(samples:list[float]) -> dict[str,float]:
+  """Summarize timing samples
+
+  Args:
+      samples (list[float]): The measured seconds
+
+  Returns:
+      dict[str,float]: The minimum, median, mean and 95th percentile
+  """
+  ordered = sorted(samples)
+  return {
+    "min": ordered[0],
+    "median": statistics.median(ordered),
+    "mean": statistics.fmean(ordered),
+    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+  }
+
+
+def measure(function:Callable[[], None], repeat:int) -> list[float]:
+  """Time a function several times
+
+  Args:
+      function (Callable[[], None]): The function to time
+      repeat (int): The number of runs
+
+  Returns:
+      list[float]: The seconds of every run
+  """
+  samples:list[float] = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    samples.append(time.perf_counter() - start)
+  return samples
+
+
+def random_text(rng:random.Random, words:int) -> str:
+  """Create a text with paragraphs
+
+  Args:
+      rng (random.Random): The random generator
+      words (int): The number of words
+
+  Returns:
+      str: The text
+  """
+  text = ""
+  for i in range(words):
+    text += rng.choice(WORDS)
+    text += "\n" if i % 40 == 39 else " "
+  return text.strip()
+
+
+def make_messages(count:int, seed:int=0) -> list[dict[str,str]]:
+  """Create a conversation history of user questions and long answers
+
+  Args:
+      count (int): The number of messages
+      seed (int, optional): The random seed. Defaults to 0.
+
+  Returns:
+      list[dict[str,str]]: The messages
+  """
+  rng = random.Random(seed)
+  return [
+    {"role": "user", "content": random_text(rng, rng.randint(5, 40))} if i % 2 == 0 else
+    {"role": "system", "content": random_text(rng, rng.randint(40, 400))}
+    for i in range(count)
+  ]
+
+
+class IsolatedHome:
+  """Points HOME to a temporary folder while the benchmark runs
+  """
+
+  def __enter__(self) -> str:
+    self._tmp = tempfile.TemporaryDirectory(prefix="ai-chat-bench-")
+    self._home = os.environ.get("HOME")
+    self._key = os.environ.get("OPENAI_API_KEY")
+    os.environ["HOME"] = self._tmp.name
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    return self._tmp.name
+
+  def __exit__(self, *_) -> None:
+    if self._home is None:
+      os.environ.pop("HOME", None)
+    else:
+      os.environ["HOME"] = self._home
+    if self._key is None:
+      os.environ.pop("OPENAI_API_KEY", None)
+    self._tmp.cleanup()
+
+
+def bench_send(rounds:int=20, latency:float=0.0, token_rate:float=0.0, words:int=200) -> list[dict]:
+  """Measure Client.send round trips against the stub server
+
+  Args:
+      rounds (int, optional): The number of prompts. Defaults to 20.
+      latency (float, optional): The server latency in seconds. Defaults to 0.0.
+      token_rate (float, optional): The streamed tokens per second. Defaults to 0.0.
+      words (int, optional): The words of every answer. Defaults to 200.
+
+  Returns:
+      list[dict]: The results
+  """
+  import client as oaic
+  answer = random_text(random.Random(1), words)
+  with IsolatedHome(), StubServer(latency=latency, token_rate=token_rate, reply=lambda _: answer) as server:
+    client = oaic.Client(api_key="stub", base_url=server.base_url)
+    client.cache.mode = "off"
+    first_delta:list[float] = []
+    total:list[float] = []
+    for i in range(rounds):
+      start = time.perf_counter()
+      first:list[float] = []
+      def on_delta(_) -> None:
+        if len(first) <= 0:
+          first.append(time.perf_counter() - start)
+      client.send("Bench", f"Question number {i}", on_delta)
+      total.append(time.perf_counter() - start)
+      first_delta.append(first[0] if len(first) > 0 else total[-1])
+    params = {"rounds": rounds, "latency": latency, "token_rate": token_rate, "words": words}
+    return [
+      {"name": "send.round_trip", "params": params, "seconds": summarize(total)},
+      {"name": "send.first_delta", "params": params, "seconds": summarize(first_delta)},
+    ]
+
+
+def bench_values(sizes:list[int]=(10, 100, 1000), widths:list[int]=(40, 80, 160), repeat:int=20) -> list[dict]:
+  """Measure Conversation.values at various history sizes and widths
+
+  The cold run renders a fresh conversation, the warm runs scroll through it.
+
+  Args:
+      sizes (list[int], optional): The numbers of messages. Defaults to (10, 100, 1000).
+      widths (list[int], optional): The view widths. Defaults to (40, 80, 160).
+      repeat (int, optional): The number of warm runs. Defaults to 20.
+
+  Returns:
+      list[dict]: The results
+  """
+  import client as oaic
+  import conversation
+  results:list[dict] = []
+  with IsolatedHome():
+    client = oaic.Client(api_key="stub", base_url="http://127.0.0.1:9/v1")
+    for size in sizes:
+      messages = make_messages(size)
+      for width in widths:
+        client.max_yx = lambda width=width: (40, width)
+        params = {"messages": size, "width": width}
+        def cold() -> None:
+          conv = conversation.Conversation("Bench", client)
+          conv.messages = [dict(message) for message in messages]
+          conv.values(0)
+        results.append({"name": "values.cold", "params": params, "seconds": summarize(measure(cold, 3))})
+        conv = conversation.Conversation("Bench", client)
+        conv.messages = [dict(message) for message in messages]
+        conv.values(0)
+        runs = iter(range(repeat))
+        def warm() -> None:
+          # jump around instead of scrolling line by line
+          conv.values(next(runs) * 7919 % (size * 10 + 1))
+        results.append({"name": "values.warm", "params": params, "seconds": summarize(measure(warm, repeat))})
+  return results
+
+
+def bench_save_load(sizes:list[int]=(100, 1000), repeat:int=5) -> list[dict]:
+  """Measure saving and loading of conversations
+
+  Args:
+      sizes (list[int], optional): The numbers of messages. Defaults to (100, 1000).
+      repeat (int, optional): The number of runs. Defaults to 5.
+
+  Returns:
+      list[dict]: The results
+  """
+  import client as oaic
+  import conversation
+  results:list[dict] = []
+  with IsolatedHome():
+    client = oaic.Client(api_key="stub", base_url="http://127.0.0.1:9/v1")
+    for size in sizes:
+      messages = make_messages(size)
+      params = {"messages": size}
+      names = iter(range(repeat))
+      def save_full() -> None:
+        conv = conversation.Conversation(f"Full{next(names)}", client)
+        conv.messages = [dict(message) for message in messages]
+        conv.save()
+      results.append({"name": "save.full", "params": params, "seconds": summarize(measure(save_full, repeat))})
+      conv = conversation.Conversation(f"Append{size}", client)
+      conv.messages = [dict(message) for message in messages]
+      conv.save()
+      def save_append() -> None:
+        conv.messages.append({"role": "user", "content": "one more question"})
+        conv.save()
+      results.append({"name": "save.append", "params": params, "seconds": summarize(measure(save_append, repeat))})
+      def load() -> None:
+        loaded = conversation.Conversation(conv.name, client)
+        loaded.load()
+      results.append({"name": "load", "params": params, "seconds": summarize(measure(load, repeat))})
+  return results
+
+
+def bench_startup(conversations:int=200, repeat:int=5) -> list[dict]:
+  """Measure the cold startup of app/main.py in a fresh interpreter
+
+  The interpreter imports main, creates the client with its catalog and the
+  application, everything except drawing the screen.
+
+  Args:
+      conversations (int, optional): The number of saved conversations. Defaults to 200.
+      repeat (int, optional): The number of runs. Defaults to 5.
+
+  Returns:
+      list[dict]: The results
+  """
+  import client as oaic
+  import conversation
+  with IsolatedHome() as home:
+    client = oaic.Client(api_key="stub", base_url="http://127.0.0.1:9/v1")
+    for i in range(conversations):
+      conv = conversation.Conversation(f"Chat{i}", client)
+      conv.messages = make_messages(20, seed=i)
+      conv.save()
+    env = dict(os.environ, HOME=home, OPENAI_API_KEY="stub", PYTHONDONTWRITEBYTECODE="1")
+    def start() -> None:
+      subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=APP, env=env, check=True)
+    start()
+    params = {"conversations": conversations}
+    return [{"name": "startup.cold", "params": params, "seconds": summarize(measure(start, repeat))}]
+
+
+BENCHMARKS:dict[str, Callable[[], list[dict]]] = {
+  "send": bench_send,
+  "values": bench_values,
+  "save_load": bench_save_load,
+  "startup": bench_startup,
+}
+
+
+def result_key(result:dict) -> str:
+  """Identify a result across runs
+
+  Args:
+      result (dict): The result
+
+  Returns:
+      str: The name and parameters of the result
+  """
+  return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results:list[dict], baseline:list[dict], tolerance:float) -> list[str]:
+  """Find the results that are slower than the baseline
+
+  Args:
+      results (list[dict]): The current results
+      baseline (list[dict]): The previous results
+      tolerance (float): The allowed slowdown of the median, 0.25 for 25%
+
+  Returns:
+      list[str]: A description of every regression
+  """
+  previous = {result_key(result): result for result in baseline}
+  regressions:list[str] = []
+  for result in results:
+    old = previous.get(result_key(result))
+    if old is None:
+      continue
+    before = old["seconds"]["median"]
+    after = result["seconds"]["median"]
+    if before > 0 and after > before * (1 + tolerance):
+      regressions.append(f"{result_key(result)}: {before * 1000:.3f}ms -> {after * 1000:.3f}ms")
+  return regressions
+
+
+def run(names:list[str]) -> dict:
+  """Run benchmarks
+
+  Args:
+      names (list[str]): The benchmarks to run
+
+  Returns:
+      dict: The report with the environment and all results
+  """
+  results:list[dict] = []
+  for name in names:
+    results.extend(BENCHMARKS[name]())
+  return {
+    "created": time.time(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "results": results,
+  }
+
+
+def main() -> int:
+  """Run the benchmarks from the command line
+
+  Returns:
+      int: The exit code, 1 if there are regressions
+  """
+  parser = argparse.ArgumentParser(description="Benchmarks for ai-chat")
+  parser.add_argument("benchmarks", nargs="*", help="any of " + ", ".join(BENCHMARKS.keys()) + ", all by default")
+  parser.add_argument("--output", default="bench_results.json", help="the JSON file to write")
+  parser.add_argument("--baseline", help="a previous result file to compare with")
+  parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown of the median")
+  args = parser.parse_args()
+  for name in args.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error("unknown benchmark " + name)
+  report = run(args.benchmarks or list(BENCHMARKS.keys()))
+  with open(args.output, "w", encoding='utf-8') as f:
+    json.dump(report, f, indent=2)
+  for result in report["results"]:
+    print(f"{result_key(result):<70} {result['seconds']['median'] * 1000:10.3f}ms")
+  if args.baseline is None:
+    return 0
+  with open(args.baseline, "r", encoding='utf-8') as f:
+    baseline = json.load(f)["results"]
+  regressions = compare(report["results"], baseline, args.tolerance)
+  for regression in regressions:
+    print("REGRESSION " + regression)
+  return 1 if len(regressions) > 0 else 0
+
+
+if __name__=="__main__":
+  sys.exit(main())
@@ -0,0 +1,340 @@
+"""A local OpenAI compatible server for tests and benchmarks
+
+The server answers POST /v1/chat/completions with or without streaming.
+Latency, token rate, rate limit headers and injected errors can be configured,
+so a Client can be pointed at it with base_url=server.base_url.
+
+Run it on its own with:
+  python tests/stub_server.py --port 8765 --latency 0.2 --token-rate 50
+"""
+
+
+import json
+import time
+import random
+import argparse
+import threading
+from typing import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def echo_reply(messages:list[dict[str,str]]) -> str:
+  """The default reply: repeats the last user message
+
+  Args:
+      messages (list[dict[str,str]]): The request messages
+
+  Returns:
+      str: The reply content
+  """
+  for message in reversed(messages):
+    if message.get("role") == "user":
+      return "You said: " + message.get("content", "")
+  return "Hello!"
+
+
+def split_tokens(text:str) -> list[str]:
+  """Split a reply into the chunks that are streamed
+
+  Every word keeps its leading whitespace, so joining the chunks gives the text again.
+
+  Args:
+      text (str): The reply
+
+  Returns:
+      list[str]: The chunks
+  """
+  tokens:list[str] = []
+  current = ""
+  for char in text:
+    if char.isspace() and len(current.strip()) > 0:
+      tokens.append(current)
+      current = ""
+    current += char
+  if len(current) > 0:
+    tokens.append(current)
+  return tokens
+
+
+class InjectedError:
+  """An error the server answers with instead of a completion
+  """
+  status:int
+  retry_after:float
+
+  def __init__(self, status:int, retry_after:float=None) -> None:
+    self.status = status
+    self.retry_after = retry_after
+
+
+class StubServer(ThreadingHTTPServer):
+  """A threaded OpenAI compatible chat completions server
+  """
+  daemon_threads = True
+  latency:float
+  token_rate:float
+  error_rate:float
+  error_status:int
+  reply:Callable[[list[dict[str,str]]], str]
+  rate_limits:dict[str,str]
+  requests:list[dict]
+
+  def __init__(self, host:str="127.0.0.1", port:int=0, latency:float=0, token_rate:float=0,
+               error_rate:float=0, error_status:int=500, reply:Callable[[list[dict[str,str]]], str]=echo_reply) -> None:
+    """Create the server, port 0 picks a free port
+
+    Args:
+        host (str, optional): The host to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on. Defaults to 0.
+        latency (float, optional): Seconds before the first byte of a response. Defaults to 0.
+        token_rate (float, optional): Streamed tokens per second, 0 for no delay. Defaults to 0.
+        error_rate (float, optional): The probability of answering with error_status. Defaults to 0.
+        error_status (int, optional): The status of random errors. Defaults to 500.
+        reply (Callable, optional): Creates the reply from the request messages. Defaults to echo_reply.
+    """
+    super().__init__((host, port), StubHandler)
+    self.latency = latency
+    self.token_rate = token_rate
+    self.error_rate = error_rate
+    self.error_status = error_status
+    self.reply = reply
+    self.rate_limits = {}
+    self.requests = []
+    self._errors:list[InjectedError] = []
+    self._lock = threading.Lock()
+    self._thread:threading.Thread = None
+
+  @property
+  def base_url(self) -> str:
+    """The base url to pass to the client
+
+    Returns:
+        str: The url including the /v1 prefix
+    """
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+  def start(self) -> "StubServer":
+    """Serve requests on a background thread
+
+    Returns:
+        StubServer: The server itself
+    """
+    self._thread = threading.Thread(target=self.serve_forever, name="stub-server", daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self) -> None:
+    """Stop serving and close the socket
+    """
+    self.shutdown()
+    self.server_close()
+    if self._thread is not None:
+      self._thread.join()
+
+  def __enter__(self) -> "StubServer":
+    return self.start()
+
+  def __exit__(self, *_) -> None:
+    self.stop()
+
+  def inject_errors(self, status:int, count:int=1, retry_after:float=None) -> None:
+    """Answer the next requests with an error
+
+    Args:
+        status (int): The HTTP status, e.g. 429 or 500
+        count (int, optional): The number of requests that fail. Defaults to 1.
+        retry_after (float, optional): The value of the retry-after header. Defaults to None.
+    """
+    with self._lock:
+      self._errors.extend(InjectedError(status, retry_after) for _ in range(count))
+
+  def next_error(self) -> InjectedError:
+    """Take the error for the current request
+
+    Returns:
+        InjectedError: The error or None if the request should succeed
+    """
+    with self._lock:
+      if len(self._errors) > 0:
+        return self._errors.pop(0)
+    if self.error_rate > 0 and random.random() < self.error_rate:
+      return InjectedError(self.error_status)
+    return None
+
+  def record(self, body:dict) -> None:
+    """Remember a request body
+
+    Args:
+        body (dict): The parsed request
+    """
+    with self._lock:
+      self.requests.append(body)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+  """Handles the requests of the stub server
+  """
+  server:StubServer
+
+  def log_message(self, *_) -> None:
+    pass
+
+  def do_POST(self) -> None:
+    """Answer a chat completion request
+    """
+    length = int(self.headers.get("content-length", 0))
+    try:
+      body = json.loads(self.rfile.read(length) or b"{}")
+    except ValueError:
+      self._send_json(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+      return
+    if not self.path.rstrip("/").endswith("/chat/completions"):
+      self._send_json(404, {"error": {"message": "Unknown path " + self.path, "type": "invalid_request_error"}})
+      return
+    self.server.record(body)
+    if self.server.latency > 0:
+      time.sleep(self.server.latency)
+    error = self.server.next_error()
+    if error is not None:
+      headers = {}
+      if error.retry_after is not None:
+        headers["retry-after"] = str(error.retry_after)
+      self._send_json(error.status, {"error": {
+        "message": f"Injected error {error.status}",
+        "type": "rate_limit_error" if error.status == 429 else "server_error",
+      }}, headers)
+      return
+    model = body.get("model", "stub")
+    content = self.server.reply(body.get("messages", []))
+    if body.get("stream", False):
+      self._stream(model, content, body.get("stream_options", {}).get("include_usage", False))
+    else:
+      self._send_json(200, {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+          "index": 0,
+          "message": {"role": "assistant", "content": content},
+          "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(split_tokens(content)), "total_tokens": 0},
+      })
+
+  def _stream(self, model:str, content:str, include_usage:bool=False) -> None:
+    """Send a reply as server sent events
+
+    Args:
+        model (str): The model name
+        content (str): The reply
+        include_usage (bool, optional): Send the token counts in a last chunk. Defaults to False.
+    """
+    self.send_response(200)
+    self.send_header("content-type", "text/event-stream")
+    self._send_rate_limits()
+    self.end_headers()
+    delay = 1 / self.server.token_rate if self.server.token_rate > 0 else 0
+    created = int(time.time())
+    try:
+      for index, token in enumerate(split_tokens(content)):
+        delta = {"content": token}
+        if index == 0:
+          delta["role"] = "assistant"
+        self._send_event(model, created, delta, None)
+        if delay > 0:
+          time.sleep(delay)
+    except (BrokenPipeError, ConnectionResetError):
+      # the client closed the stream, e.g. because the request was cancelled
+      self.close_connection = True
+      return
+    self._send_event(model, created, {}, "stop")
+    if include_usage:
+      tokens = len(split_tokens(content))
+      self._send_chunk({
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [],
+        "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+      })
+    self.wfile.write(b"data: [DONE]\n\n")
+    self.wfile.flush()
+
+  def _send_event(self, model:str, created:int, delta:dict, finish_reason:str) -> None:
+    """Send one chunk of a streamed reply
+
+    Args:
+        model (str): The model name
+        created (int): The creation time of the completion
+        delta (dict): The delta of the chunk
+        finish_reason (str): None until the last chunk
+    """
+    chunk = {
+      "id": "chatcmpl-stub",
+      "object": "chat.completion.chunk",
+      "created": created,
+      "model": model,
+      "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    self._send_chunk(chunk)
+
+  def _send_chunk(self, chunk:dict) -> None:
+    """Send a server sent event with a JSON chunk
+
+    Args:
+        chunk (dict): The chunk
+    """
+    self.wfile.write(b"data: " + json.dumps(chunk).encode('utf-8') + b"\n\n")
+    self.wfile.flush()
+
+  def _send_json(self, status:int, data:dict, headers:dict[str,str]=None) -> None:
+    """Send a JSON response
+
+    Args:
+        status (int): The HTTP status
+        data (dict): The response body
+        headers (dict[str,str], optional): Additional headers. Defaults to None.
+    """
+    payload = json.dumps(data).encode('utf-8')
+    self.send_response(status)
+    self.send_header("content-type", "application/json")
+    self.send_header("content-length", str(len(payload)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self._send_rate_limits()
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def _send_rate_limits(self) -> None:
+    """Send the configured x-ratelimit-* headers
+    """
+    for name, value in self.server.rate_limits.items():
+      self.send_header(name, value)
+
+
+def main() -> None:
+  """Run the stub server in the foreground
+  """
+  parser = argparse.ArgumentParser(description="A local OpenAI compatible stub server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--latency", type=float, default=0, help="seconds before the first byte")
+  parser.add_argument("--token-rate", type=float, default=0, help="streamed tokens per second")
+  parser.add_argument("--error-rate", type=float, default=0, help="probability of an error response")
+  parser.add_argument("--error-status", type=int, default=500)
+  args = parser.parse_args()
+  server = StubServer(args.host, args.port, args.latency, args.token_rate, args.error_rate, args.error_status)
+  print("Listening on " + server.base_url)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__=="__main__":
+  main()
@@ -1,4 +1,884 @@
 """tests
 """
 
-# comming soon
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app")
+if APP not in sys.path:
+  sys.path.insert(0, APP)
+
+from tests.stub_server import StubServer, split_tokens
+from tests import benchmarks
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+  monkeypatch.setenv("HOME", str(tmp_path))
+  monkeypatch.setenv("OPENAI_API_KEY", "stub")
+  monkeypatch.delenv("OPENAI_CHAT_CACHE", raising=False)
+  monkeypatch.delenv("OPENAI_CHAT_STORAGE", raising=False)
+  return tmp_path
+
+
+@pytest.fixture
+def server():
+  with StubServer(reply=lambda _: "Hello there, how are you?") as server:
+    yield server
+
+
+@pytest.fixture
+def client(home, server):
+  import client as oaic
+  client = oaic.Client(api_key="stub", base_url=server.base_url)
+  client.scheduler.base_delay = 0.001
+  return client
+
+
+def test_split_tokens_keeps_text():
+  text = "Hello  there,\nhow are you?"
+  assert "".join(split_tokens(text)) == text
+
+
+def test_send_streams_answer(client, server):
+  deltas:list[str] = []
+  key = client.send("Test", "Hi", lambda conv: deltas.append(conv.messages[-1]["content"]))
+  messages = client.conversations[key].messages
+  assert messages[-2] == {"role": "user", "content": "Hi"}
+  assert {key: messages[-1][key] for key in ("role", "content")} == {"role": "system", "content": "Hello there, how are you?"}
+  assert len(deltas) > 1
+  assert server.requests[0]["stream"] is True
+
+
+def test_send_without_streaming(client, server):
+  client.stream = False
+  key = client.send("Test", "Hi")
+  assert client.conversations[key].messages[-1]["content"] == "Hello there, how are you?"
+  assert "stream" not in server.requests[0]
+
+
+def test_send_retries_injected_errors(client, server):
+  server.inject_errors(429, 2, retry_after=0)
+  key = client.send("Test", "Hi")
+  assert client.conversations[key].messages[-1]["content"] == "Hello there, how are you?"
+  assert len(server.requests) == 3
+
+
+def test_retry_after_is_capped_and_respects_the_deadline(client, server):
+  import time
+  import openai
+  from cancel import CancelToken
+  client.scheduler.max_delay = 0.01
+  server.inject_errors(429, 2, retry_after=1000)
+  start = time.monotonic()
+  assert client.complete("model-a", [{"role": "user", "content": "Hi"}]) == "Hello there, how are you?"
+  assert time.monotonic() - start < 5
+  client.scheduler.max_delay = 60
+  server.inject_errors(429, retry_after=1000)
+  start = time.monotonic()
+  with pytest.raises(openai.RateLimitError):
+    client.complete("model-a", [{"role": "user", "content": "Hi"}], cancel=CancelToken(5))
+  assert time.monotonic() - start < 5
+
+
+def test_send_reports_error_after_retries(client, server):
+  client.scheduler.max_retries = 0
+  server.inject_errors(500)
+  key = client.send("Test", "Hi")
+  assert client.conversations[key].messages[-1]["role"] == "error"
+
+
+def test_benchmarks_write_comparable_results():
+  results = benchmarks.bench_values(sizes=[10], widths=[40], repeat=2)
+  results += benchmarks.bench_save_load(sizes=[10], repeat=1)
+  assert {result["name"] for result in results} == {"values.cold", "values.warm", "save.full", "save.append", "load"}
+  assert benchmarks.compare(results, results, 0) == []
+  slower = [dict(result, seconds={"median": result["seconds"]["median"] * 2 + 1}) for result in results]
+  assert len(benchmarks.compare(slower, results, 0.25)) == len(results)
+
+
+def test_response_cache_modes(tmp_path, monkeypatch):
+  import cache
+  calls:list[str] = []
+  def request():
+    calls.append("upstream")
+    yield "Hel"
+    yield "lo"
+  messages = [{"role": "user", "content": "Hi"}]
+  off = cache.ResponseCache(str(tmp_path), mode=cache.MODE_OFF)
+  assert "".join(off.stream("m", messages, {}, request)) == "Hello" and len(calls) == 1
+  assert not os.path.exists(off.path(off.key("m", messages, {})))
+  on = cache.ResponseCache(str(tmp_path), mode=cache.MODE_ON)
+  for _ in range(2):
+    assert "".join(on.stream("m", messages, {}, request)) == "Hello"
+  assert len(calls) == 2
+  only = cache.ResponseCache(str(tmp_path), mode=cache.MODE_ONLY)
+  assert "".join(only.stream("m", [{"role": "user", "content": " Hi\r\n"}], {}, request)) == "Hello"
+  with pytest.raises(cache.CacheMissError):
+    "".join(only.stream("m", messages, {"temperature": 1}, request))
+  assert len(calls) == 2
+  key = on.key("m", messages, {})
+  with open(on.path(key), "w", encoding='utf-8') as f:
+    f.write('{"content": "Hello"}')
+  assert on.get(key) is None
+  def fail(key:str, content:str) -> None:
+    raise OSError("disk full")
+  monkeypatch.setattr(on, "put", fail)
+  assert "".join(on.stream("m", messages, {}, request)) == "Hello" and len(calls) == 3
+
+
+def test_response_cache_shares_concurrent_identical_requests(tmp_path):
+  import threading
+  import cache
+  calls:list[str] = []
+  started, release = threading.Event(), threading.Event()
+  def request():
+    calls.append("upstream")
+    yield "Hel"
+    started.set()
+    release.wait(5)
+    yield "lo"
+  messages = [{"role": "user", "content": "Hi"}]
+  shared = cache.ResponseCache(str(tmp_path), mode=cache.MODE_ON)
+  answers:list[str] = []
+  leader = threading.Thread(target=lambda: answers.append("".join(shared.stream("m", messages, {}, request))))
+  leader.start()
+  assert started.wait(5)
+  follower = shared.stream("m", messages, {}, request)
+  assert next(follower) == "Hel"
+  release.set()
+  assert "".join(follower) == "lo"
+  leader.join(5)
+  assert answers == ["Hello"] and calls == ["upstream"]
+  assert shared.get(shared.key("m", messages, {})) == "Hello"
+
+
+def test_followers_of_a_shared_request_stop_on_their_own_token(tmp_path):
+  import time
+  import threading
+  import cache
+  from cancel import CancelToken, Cancelled, CANCELLED, DEADLINE
+  release = threading.Event()
+  def stalled():
+    yield "Hel"
+    release.wait(10)
+    yield "lo"
+  messages = [{"role": "user", "content": "Hi"}]
+  shared = cache.ResponseCache(str(tmp_path), mode=cache.MODE_ON)
+  leader = shared.stream("m", messages, {}, stalled)
+  assert next(leader) == "Hel"
+  token = CancelToken()
+  follower = shared.stream("m", messages, {}, stalled, token)
+  assert next(follower) == "Hel"
+  threading.Timer(0.1, token.cancel).start()
+  with pytest.raises(Cancelled) as stopped:
+    next(follower)
+  assert stopped.value.reason == CANCELLED
+  started = time.monotonic()
+  follower = shared.stream("m", messages, {}, stalled, CancelToken(0.2))
+  with pytest.raises(Cancelled) as stopped:
+    "".join(follower)
+  assert stopped.value.reason == DEADLINE and time.monotonic() - started < 5
+  release.set()
+  assert "".join(leader) == "lo"
+
+
+def test_search_ranks_messages_and_matches_phrases(client):
+  import conversation
+  for name, contents in [
+    ("Python", ["how do I write a list comprehension", "use [x for x in items] as a list comprehension"]),
+    ("Cooking", ["a list of ingredients", "flour, comprehension of recipes"]),
+  ]:
+    conv = conversation.Conversation(name, client)
+    conv.messages = [{"role": "user", "content": content} for content in contents]
+    client.conversations[name] = conv
+    conv.save()
+  results = client.search("list comprehension")
+  assert {(result.conv_key, result.index) for result in results[:2]} == {("Python", 0), ("Python", 1)}
+  assert [(result.conv_key, result.index) for result in client.search('"list of ingredients"')] == [("Cooking", 0)]
+  client.conversations["Cooking"].messages[0]["content"] = "nothing here"
+  client.conversations["Cooking"].save()
+  assert client.search('"list of ingredients"') == []
+
+
+def test_search_index_is_persisted(client):
+  import conversation
+  import client as oaic
+  conv = conversation.Conversation("Persisted", client)
+  conv.messages = [{"role": "user", "content": "where is the needle"}]
+  client.conversations["Persisted"] = conv
+  conv.save()
+  client.search("needle")
+  client.search_index.flush()
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  entries = reopened.storage.entries()
+  assert reopened.search_index._read_segment("Persisted", entries["Persisted"].size)
+  assert [result.conv_key for result in reopened.search("needle")] == ["Persisted"]
+
+
+def test_saves_index_only_the_changed_messages(client, monkeypatch):
+  import conversation
+  import search
+  tokenized:list[str] = []
+  tokenize = search.tokenize
+  monkeypatch.setattr(search, "tokenize", lambda text: tokenized.append(text) or tokenize(text))
+  hashed:list[str] = []
+  content_hash = search.content_hash
+  monkeypatch.setattr(search, "content_hash", lambda content: hashed.append(content) or content_hash(content))
+  assert client.search("needle") == []
+  tokenized.clear()
+  conv = conversation.Conversation("Incremental", client)
+  conv.messages = [{"role": "user", "content": f"message number {i}"} for i in range(100)]
+  client.conversations["Incremental"] = conv
+  conv.save()
+  assert len(tokenized) == 100
+  tokenized.clear()
+  hashed.clear()
+  conv.messages.append({"role": "user", "content": "where is the needle"})
+  conv.messages[3]["content"] = "changed haystack"
+  conv.save()
+  assert sorted(tokenized) == sorted(hashed) == ["changed haystack", "where is the needle"]
+  tokenized.clear()
+  answer = {"role": "system", "content": "a streamed answer", "partial": True}
+  conv.messages.append(answer)
+  conv.save()
+  answer["content"] += " with more words"
+  conv.save()
+  assert tokenized == [] and client.search("streamed") == []
+  tokenized.clear()
+  answer.pop("partial")
+  conv.save()
+  assert tokenized == ["a streamed answer with more words"]
+  assert [(result.conv_key, result.index) for result in client.search("streamed")] == [("Incremental", 101)]
+  assert [result.index for result in client.search("haystack")] == [3]
+
+
+def test_least_recently_used_conversations_are_unloaded(client):
+  import conversation
+  import client as oaic
+  contents = {}
+  for name in ["First", "Second", "Third"]:
+    conv = conversation.Conversation(name, client)
+    conv.messages = [{"role": "user", "content": f"{name} message {i}"} for i in range(50)]
+    client.conversations[name] = conv
+    conv.save()
+    contents[name] = [message["content"] for message in conv.messages]
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  # two of the conversations fit into the budget
+  reopened.memory_budget = client.conversations["First"].size * 5 // 2
+  first, second, third = (reopened.conversations[name] for name in ["First", "Second", "Third"])
+  assert first.messages and second.messages
+  assert first.loaded and second.loaded
+  assert third.messages
+  assert not first.loaded and second.loaded and third.loaded
+  assert [message["content"] for message in first.messages] == contents["First"]
+  assert not second.loaded and third.loaded
+
+
+def test_closing_the_app_keeps_renames_and_the_search_index(client):
+  import application
+  import worker
+  import client as oaic
+  import time
+  complete = client.complete
+  # the conversation is still being named when the app is closed
+  client.complete = lambda *args, **kwargs: time.sleep(0.5) or complete(*args, **kwargs)
+  client.search("hello")
+  app = application.App(client)
+  key = app.requests.submit(None, "Hi")
+  while app.requests.events.get(timeout=10).kind != worker.RequestEvent.DONE:
+    pass
+  app.close()
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  names = reopened.get_conversation()
+  assert len(names) == 1 and names[0] != key
+  assert reopened.search_index._read_segment(names[0], reopened.storage.entries()[names[0]].size)
+  assert [result.conv_key for result in reopened.search("hello")] == names
+
+
+def test_catalog_is_written_once_when_the_storage_is_closed(home):
+  import json
+  import storage
+  store = storage.FileStorage()
+  store.entries()
+  writes:list[str] = []
+  save = store.catalog.save
+  store.catalog.save = lambda: writes.append(store.catalog.path) or save()
+  store.write("Chat", [{"role": "user", "content": "hi"}], {})
+  for i in range(5):
+    store.append("Chat", [{"op": "append", "message": {"role": "user", "content": str(i)}}])
+  assert writes == []
+  store.close()
+  assert len(writes) == 1 and not os.path.exists(store.catalog.path + ".tmp")
+  with open(store.catalog.path, "r", encoding='utf-8') as f:
+    assert json.load(f)["Chat"]["message_count"] == 6
+
+
+def test_sqlite_storage_round_trip(home):
+  import storage
+  store = storage.SQLiteStorage()
+  store.write("Chat", [{"role": "user", "content": "hi"}], {"a": 1})
+  size = store.append("Chat", [
+    {"op": "append", "message": {"role": "system", "content": "hello", "model": "m"}},
+    {"op": "update", "index": 0, "message": {"role": "user", "content": "hey"}},
+    {"op": "meta", "key": "b", "value": 2},
+  ])
+  store.rename("Chat", "Renamed")
+  messages, meta, stored_size = store.read("Renamed")
+  assert messages == [{"role": "user", "content": "hey"}, {"role": "system", "content": "hello", "model": "m"}]
+  assert meta == {"a": 1, "b": 2}
+  assert size == stored_size == len("hey") + len("hello")
+  assert store.entries()["Renamed"].message_count == 2
+  store.append("Renamed", [{"op": "truncate", "length": 1}])
+  assert store.read("Renamed")[0] == [{"role": "user", "content": "hey"}]
+  store.delete("Renamed")
+  assert store.read("Renamed") is None and store.entries() == {}
+
+
+def test_migrate_files_to_sqlite(client, monkeypatch):
+  import conversation
+  import storage
+  import migrate
+  import client as oaic
+  conv = conversation.Conversation("Old", client)
+  conv.messages = [{"role": "user", "content": "from the files"}]
+  client.conversations["Old"] = conv
+  conv.save()
+  target = storage.SQLiteStorage()
+  assert migrate.migrate(client.storage, target) == (1, 0)
+  assert migrate.migrate(client.storage, target) == (0, 1)
+  target.close()
+  monkeypatch.setenv("OPENAI_CHAT_STORAGE", storage.SQLITE)
+  migrated = oaic.Client(api_key="stub", base_url=client.base_url)
+  assert migrated.conversations["Old"].messages == conv.messages
+
+
+def test_recency_index_moves_used_conversations_to_the_front():
+  import recency
+  index = recency.RecencyIndex()
+  index.load({"a": 1.0, "b": 3.0, "c": 2.0})
+  assert index.names() == ["b", "c", "a"]
+  index.touch("a")
+  index.touch("d")
+  assert index.names() == ["d", "a", "b", "c"]
+  assert [index.position(name) for name in ["d", "a", "b", "c"]] == [0, 1, 2, 3]
+  index.rename("b", "e")
+  index.remove("a")
+  assert index.page(1, 2) == ["e", "c"]
+  assert index.position("c") == 2 and index.position("a") is None
+
+
+def test_client_orders_conversations_by_activity(client):
+  import client as oaic
+  for name in ["First", "Second"]:
+    client.send(name, "Hi")
+  assert client.get_conversation() == ["Second", "First"]
+  client.send("First", "Again")
+  client.delete("Second")
+  client.send("Third", "Hi")
+  assert client.get_conversation() == ["Third", "First"]
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  assert reopened.get_conversation()[0] == reopened.current_conversation
+  assert set(reopened.get_conversation()) == {"Third", "First"}
+
+
+def test_wrap_measures_cells_and_splits_long_words():
+  import wrap
+  lines = [line for line, _, _ in wrap.wrap("漢字漢字漢字 " + "x" * 25, 10)]
+  assert all(wrap.text_width(line) < 10 for line in lines)
+  assert "".join(line.replace(" ", "") for line in lines) == "漢字漢字漢字" + "x" * 25
+  code = [line for line, _, _ in wrap.wrap("```\n  a   b\n```", 10)]
+  assert code == ["``` ", "  a   b ", "``` "]
+
+
+def test_wrap_ends_at_narrow_widths(client):
+  import itertools
+  import conversation
+  import wrap
+  for width in range(-1, 4):
+    for text in ["hi there", "漢字 abcdefgh", "```\nabcdef\n```"]:
+      lines = [line for line, _, _ in itertools.islice(wrap.wrap(text, width), 100)]
+      assert len(lines) < 100
+      assert "".join(lines).replace(" ", "") == text.replace(" ", "").replace("\n", "")
+  assert len(wrap.Columns([["a"], ["b"]], ["hi there", "and you"], 3)) > 0
+  conv = conversation.Conversation("Narrow", client)
+  conv.messages = [{"role": "user", "content": "a message in a narrow view"}]
+  client.max_yx = lambda: (20, 14)
+  assert len(conv.values(0)) > 0
+
+
+def test_wrapped_text_generates_viewport_from_checkpoints():
+  import wrap
+  text = "\n".join(" ".join(["word"] * (i % 40)) for i in range(2000))
+  expected = [line for line, _, _ in wrap.wrap(text, 30)]
+  wrapped = wrap.WrappedText("", 30)
+  for end in range(0, len(text), 997):
+    wrapped.extend(text[:end])
+  wrapped.extend(text)
+  assert len(wrapped) == len(expected)
+  for start in [0, wrap.CHECKPOINT_LINES - 1, 1234, len(expected) - 5]:
+    assert wrapped.lines(start, start + 20) == expected[start:start + 20]
+
+
+def test_damage_tracking_scrolls_and_repaints_only_changed_rows():
+  import controls
+  class Row:
+    def __init__(self, painted:list[int], index:int) -> None:
+      self.name, self.value, self.hide = None, None, True
+      self.show_bold = self.important = self.highlight = False
+      self.color = "DEFAULT"
+      self.painted, self.index = painted, index
+    def update(self, clear:bool=True) -> None:
+      self.painted.append(self.index)
+  class Rows(controls.DamageTracked):
+    hidden = editing = always_show_cursor = False
+    start_display_at = _last_start_display_at = cursor_line = 0
+    def __init__(self, count:int) -> None:
+      self.painted, self.scrolled = [], []
+      self._my_widgets = [Row(self.painted, i) for i in range(count)]
+      self.values, self.value = [], []
+    def get_filtered_indexes(self) -> list[int]:
+      return []
+    def display_value(self, vl:str) -> str:
+      return vl
+    def _print_line(self, row:Row, index:int) -> None:
+      row.hide = index >= len(self.values)
+      row.name = None if row.hide else self.values[index]
+    def _scroll_rows(self, shift:int) -> bool:
+      self.scrolled.append(shift)
+      return True
+    def show(self, values:list[str]) -> tuple[list[int], list[int]]:
+      self.painted.clear()
+      self.scrolled.clear()
+      self.values = values
+      self.redraw()
+      return self.scrolled, sorted(self.painted)
+  rows = Rows(4)
+  before = [(name, None, name is None) for name in ["a", "b", "c", None]]
+  assert rows._find_shift(before, ["b", "c", None, None]) == 1
+  assert rows._find_shift(before, ["z", "a", "b", "c"]) == -1
+  assert rows._find_shift(before, ["a", "b", "c", "d"]) == 0
+  assert rows._find_shift(before, ["x", "y", "z", None]) == 0
+  assert rows.show(["a", "b", "c"]) == ([], [0, 1, 2])
+  assert rows.show(["a", "b", "c"]) == ([], [])
+  assert rows.show(["a", "b", "c", "d"]) == ([], [3])
+  assert rows.show(["b", "c", "d"]) == ([1], [3])
+  assert rows.show(["z", "b", "c", "d"]) == ([-1], [0])
+  assert rows.show(["z", "b", "x", "d"]) == ([], [2])
+
+
+def test_batch_runs_prompts_and_writes_json_lines(client, server):
+  import io
+  import json
+  import batch
+  client.send("Existing", "Hi")
+  lines = [
+    json.dumps({"conversation": "Existing", "prompt": "First", "id": "a"}),
+    json.dumps({"conversation": "Existing", "prompt": "Second"}),
+    json.dumps({"prompt": "Tell me a story"}),
+    "not json",
+  ]
+  output = io.StringIO()
+  errors = batch.BatchRunner(client, output, workers=4).run(lines)
+  results = [json.loads(line) for line in output.getvalue().splitlines()]
+  answers = [result for result in results if "content" in result]
+  assert errors == 1 and [result["line"] for result in results if "error" in result] == [4]
+  assert {result["line"] for result in answers} == {1, 2, 3}
+  assert [result.get("id") for result in answers if result["line"] == 1] == ["a"]
+  assert all(result["content"] == "Hello there, how are you?" for result in answers)
+  prompts = [m["content"] for m in client.conversations["Existing"].messages if m["role"] == "user"]
+  assert prompts == ["Hi", "First", "Second"]
+  renamed = [result for result in results if "renamed" in result]
+  assert len(renamed) == 1 and renamed[0]["conversation"] in client.conversations
+
+
+def test_fan_out_compares_models_side_by_side(client, server):
+  key = client.fan_out("Compare", "Hi", ["model-a", "model-b"])
+  messages = client.conversations[key].messages
+  answers = messages[-2:]
+  assert [answer["model"] for answer in answers] == ["model-a", "model-b"]
+  assert all(answer["content"] == "Hello there, how are you?" for answer in answers)
+  assert all(answer["metrics"]["total"] >= answer["metrics"]["first_token"] for answer in answers)
+  assert sorted(request["model"] for request in server.requests) == ["model-a", "model-b"]
+  client.max_yx = lambda: (20, 80)
+  values = client.conversations[key].values(0)
+  assert any("model-a" in line and "model-b" in line for line in values)
+  assert any(line.count("Hello there") == 2 for line in values)
+  client.send(key, "And now?")
+  sent = server.requests[-1]["messages"]
+  assert [message["content"] for message in sent] == ["Hi", "Hello there, how are you?", "And now?"]
+  client.models = []
+  client.fan_out(key, "Nobody to compare", [])
+  assert server.requests[-1]["model"] == client.model
+  assert client.conversations[key].messages[-1]["content"] == "Hello there, how are you?"
+
+
+def test_user_interface_imports_without_the_openai_sdk():
+  import subprocess
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import main"],
+    cwd=APP, capture_output=True, text=True, check=True
+  )
+  imported = {}
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    _, cumulative, name = line.split("|")
+    if cumulative.strip().isdigit():
+      imported[name.strip()] = int(cumulative)
+  assert "main" in imported
+  assert not any(name.split(".")[0] in ("openai", "httpx", "pydantic") for name in imported)
+  # microseconds, the OpenAI SDK alone takes several times this long
+  assert imported["main"] < 400000
+
+
+def test_snapshot_round_trip(home):
+  import snapshot
+  assert snapshot.load().chats == []
+  snapshot.save(snapshot.Snapshot(["B", "A"], "A", 84, ["line"]))
+  snap = snapshot.load()
+  assert (snap.chats, snap.current, snap.width, snap.values) == (["B", "A"], "A", 84, ["line"])
+
+
+def test_send_records_request_metrics(client, server):
+  import json
+  server.inject_errors(500)
+  key = client.send("Test", "Hi")
+  metrics = client.conversations[key].messages[-1]["metrics"]
+  assert metrics["model"] == client.model and metrics["retries"] == 1
+  assert metrics["completion_tokens"] == len(split_tokens("Hello there, how are you?"))
+  assert 0 <= metrics["queued"] and metrics["first_token"] <= metrics["total"]
+  assert server.requests[-1]["stream_options"] == {"include_usage": True}
+  with open(client.telemetry.path, "r", encoding='utf-8') as f:
+    assert [json.loads(line)["retries"] for line in f] == [1]
+  assert not os.path.exists(client.telemetry.prometheus_path)
+  client.telemetry.close()
+  with open(client.telemetry.prometheus_path, "r", encoding='utf-8') as f:
+    prometheus = f.read()
+  assert f'openai_chat_request_seconds_count{{model="{client.model}"}} 1' in prometheus
+  assert f'openai_chat_retries_total{{model="{client.model}"}} 1' in prometheus
+
+
+def test_failed_naming_is_recorded_and_keeps_the_provisional_name(client, server):
+  import json
+  key = client.new_conversation("Hi")
+  conv = client.conversations[key]
+  conv.messages += [{"role": "user", "content": "Hi"}, {"role": "system", "content": "Hello"}]
+  client.scheduler.max_retries = 0
+  server.inject_errors(500)
+  client._name(conv)
+  assert conv.name == key and client.telemetry.last is None
+  with open(client.telemetry.path, "r", encoding='utf-8') as f:
+    assert [(record["task"], record["error"]) for record in map(json.loads, f)] == [("naming", True)]
+
+
+def test_quantiles_interpolate():
+  import telemetry
+  assert telemetry.quantile([], 0.5) == 0
+  assert telemetry.quantile([3, 1, 2, 4], 0.5) == 2.5
+  assert telemetry.quantile(list(range(101)), 0.95) == 95
+
+
+def test_saver_writes_partial_answers_and_flushes_on_close(home, monkeypatch):
+  import client as oaic
+  import storage
+  monkeypatch.setattr(oaic, "PARTIAL_SAVE_INTERVAL", 0)
+  reply = "one two three four five six seven eight"
+  with StubServer(token_rate=100, reply=lambda _: reply) as server:
+    client = oaic.Client(api_key="stub", base_url=server.base_url)
+    records:list[dict] = []
+    append = client.storage.append
+    client.storage.append = lambda name, new: records.extend(new) or append(name, new)
+    key = client.send("Partial", "Hi")
+    client.close()
+  partial = [record["message"]["content"] for record in records if record.get("message", {}).get("partial")]
+  assert len(partial) > 0 and all(reply.startswith(content) for content in partial)
+  messages, _, _ = storage.FileStorage().read(key)
+  assert messages[-1]["content"] == reply and "partial" not in messages[-1]
+
+
+def test_partial_saves_are_compacted_out_of_the_journal(home, monkeypatch):
+  import client as oaic
+  import functions
+  import journal
+  import storage
+  monkeypatch.setattr(oaic, "PARTIAL_SAVE_INTERVAL", 0)
+  reply = " ".join(f"word{i}" for i in range(500))
+  with StubServer(token_rate=1000, reply=lambda _: reply) as server:
+    client = oaic.Client(api_key="stub", base_url=server.base_url)
+    saves:list[int] = []
+    append = client.storage.append
+    client.storage.append = lambda name, records: saves.append(len(records)) or append(name, records)
+    key = client.send("Long", "Hi")
+    client.close()
+  journal._compactor.submit(lambda: None).result()
+  assert len(saves) > 10
+  assert os.path.getsize(functions.get_conversation_path(key)) < 3 * len(reply)
+  messages, _, _ = storage.FileStorage().read(key)
+  assert [message["content"] for message in messages] == ["Hi", reply] and "partial" not in messages[-1]
+  # a save cut off by a crash keeps the answer of the save before
+  store = storage.FileStorage()
+  store.write("Torn", [{"role": "user", "content": "Hi"}], {})
+  store.append("Torn", [{"op": "append", "message": {"role": "system", "content": "word0", "partial": True}}])
+  size = store.append("Torn", [{"op": "update", "index": 1, "message": {"role": "system", "content": "word0 word1", "partial": True}}])
+  with open(functions.get_conversation_path("Torn"), "r+b") as f:
+    f.truncate(size - 10)
+  messages, _, _ = storage.FileStorage().read("Torn")
+  assert messages[-1]["content"] == "word0"
+
+
+def test_idle_conversations_move_to_the_cold_tier_and_back(home):
+  import storage
+  import functions
+  from constants import COLD_FILE_EXTENSION
+  store = storage.FileStorage()
+  messages = [{"role": "user", "content": "old " * 100}, {"role": "system", "content": "answer"}]
+  store.write("Old", messages, {"a": 1})
+  store.write("New", messages, {})
+  path = functions.get_conversation_path("Old")
+  os.utime(path, (1000, 1000))
+  size = os.path.getsize(path)
+  assert store.archive() == 1
+  cold_path = functions.get_conversation_path("Old", COLD_FILE_EXTENSION)
+  assert not os.path.exists(path) and os.path.getsize(cold_path) < size
+  reopened = storage.FileStorage()
+  entry = reopened.entries()["Old"]
+  assert (entry.path, entry.mtime, entry.size, entry.message_count) == (cold_path, 1000, size, 2)
+  assert reopened.read("Old") == (messages, {"a": 1}, size)
+  reopened.append("Old", [{"op": "append", "message": {"role": "user", "content": "again"}}])
+  assert os.path.exists(path) and not os.path.exists(cold_path)
+  assert reopened.read("Old")[0] == messages + [{"role": "user", "content": "again"}]
+  assert reopened.archive() == 0
+
+
+def test_loaded_messages_keep_long_contents_in_the_journal(client):
+  import conversation
+  import context
+  import message as msg
+  import client as oaic
+  long = "a long answer " * 100
+  conv = conversation.Conversation("Lazy", client)
+  conv.messages = [{"role": "user", "content": "hi"}, {"role": "system", "content": long, "model": "m"}]
+  client.conversations["Lazy"] = conv
+  conv.save()
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  loaded = reopened.conversations["Lazy"]
+  user, answer = loaded.messages
+  assert isinstance(answer, msg.Message) and answer.lazy and not user.lazy
+  assert not hasattr(answer, "__dict__") and user.role is sys.intern("user")
+  assert answer == {"role": "system", "content": long, "model": "m"} and answer["model"] == "m"
+  assert context.to_api_messages(loaded.messages) == [{"role": "user", "content": "hi"}, {"role": "system", "content": long}]
+  records:list[dict] = []
+  append = reopened.storage.append
+  reopened.storage.append = lambda name, new: records.extend(new) or append(name, new)
+  loaded.add({"role": "user", "content": "more"})
+  loaded.save()
+  assert records == [{"op": "append", "message": {"role": "user", "content": "more"}}]
+  report = reopened.memory_report()["Lazy"]
+  assert (report.messages, report.lazy) == (3, 1) and report.mapped > len(long)
+  reopened.telemetry.memory = lambda: {"Lazy": report, "Other": report}
+  prometheus = reopened.telemetry.prometheus()
+  assert f'openai_chat_conversation_memory_bytes{{kind="mapped"}} {2 * report.mapped}' in prometheus
+  assert "openai_chat_loaded_conversations 2" in prometheus and "conversation=" not in prometheus
+
+
+def test_chat_view_reads_long_contents_from_the_journal(client):
+  import conversation
+  import wrap
+  import client as oaic
+  long = "\n".join(f"line {i}" for i in range(3 * wrap.CHECKPOINT_LINES))
+  conv = conversation.Conversation("Long", client)
+  conv.messages = [{"role": "user", "content": "hi"}, {"role": "system", "content": long}]
+  client.conversations["Long"] = conv
+  conv.save()
+  reopened = oaic.Client(api_key="stub", base_url=client.base_url)
+  reopened.max_yx = lambda: (20, 80)
+  loaded = reopened.conversations["Long"]
+  bottom = "".join(loaded.values(0))
+  top = "".join(loaded.values(loaded.scroll_offset_of(1)))
+  _, wrapped = loaded._line_cache[1]
+  assert wrapped._text is None and wrapped.memory() < len(long)
+  assert f"line {3 * wrap.CHECKPOINT_LINES - 1} " in bottom and "line 0 " in top
+  answer = loaded.messages[1]
+  assert answer.lazy and answer.content is answer.content
+
+
+def test_summary_replaces_the_oldest_messages(client, monkeypatch):
+  import json
+  import conversation
+  import context
+  conv = conversation.Conversation("Long", client)
+  conv.messages = [{"role": "user" if i % 2 == 0 else "system", "content": f"message {i}"} for i in range(20)]
+  # every message is 5 tokens, 12 fit into the budget
+  builder = context.ContextBuilder(client, budget=60, estimator=lambda text: 1)
+  def fail(model:str, messages:list[dict], metrics=None) -> str:
+    raise OSError("offline")
+  monkeypatch.setattr(client, "complete", fail)
+  assert builder.build(conv) == context.to_api_messages(conv.messages[11:])
+  builder._executor.submit(lambda: None).result()
+  assert context.SUMMARY_KEY not in conv.meta
+  with open(client.telemetry.path, "r", encoding='utf-8') as f:
+    assert [(record["task"], record["error"]) for record in map(json.loads, f)] == [("summary", True)]
+  monkeypatch.setattr(client, "complete", lambda model, messages, metrics=None: "Counted to eight")
+  conv.meta[context.SUMMARY_KEY] = {"content": "Counted to eight", "upto": 9}
+  request = builder.build(conv)
+  assert request[0]["content"] == context.SUMMARY_PREFIX + "Counted to eight"
+  assert request[1:] == context.to_api_messages(conv.messages[9:])
+  builder._executor.submit(lambda: None).result()
+  assert conv.meta[context.SUMMARY_KEY]["upto"] == 11
+  assert builder.build(conv)[1:] == context.to_api_messages(conv.messages[11:])
+
+
+def test_retrieval_sends_recent_and_relevant_messages(client):
+  import conversation
+  import context
+  import retrieval
+  filler = ["the weather was nice today", "we talked about lunch plans", "tomorrow is a busy day"]
+  conv = conversation.Conversation("Research", client)
+  conv.messages = [{"role": "user", "content": "The garage door code is 4711, remember it"}]
+  conv.messages += [{"role": "user" if i % 2 == 0 else "system", "content": filler[i % 3]} for i in range(20)]
+  conv.messages.append({"role": "user", "content": "What was the code of the garage door?"})
+  client.conversations["Research"] = conv
+  other = conversation.Conversation("Other", client)
+  other.messages = [{"role": "user", "content": "My bike lock code is 1234"}]
+  client.conversations["Other"] = other
+  builder = context.ContextBuilder(client, mode=context.MODE_RETRIEVAL)
+  builder.recent, builder.top_k = 2, 1
+  request = builder.build(conv)
+  assert [message["content"] for message in request] == [conv.messages[0]["content"]] + [m["content"] for m in conv.messages[-2:]]
+  index = builder.index(conv)
+  conv.messages[-1]["content"] += " Please answer briefly."
+  assert index.update(conv.messages) == 1 and len(index) == len(conv.messages)
+  builder.mode = context.MODE_RETRIEVAL_ALL
+  request = builder.build(conv)
+  assert request[0]["content"].startswith(context.RELATED_PREFIX) and "Other (user): My bike lock code is 1234" in request[0]["content"]
+  # conversations that are not in memory are indexed in the background once, empty ones as well
+  other.save()
+  empty = conversation.Conversation("Empty", client)
+  empty.messages = [{"role": "error", "content": "failed"}]
+  empty.save()
+  for unloaded in [other, empty]:
+    unloaded.unload()
+    client.conversations[unloaded.name] = unloaded
+  reads:list[str] = []
+  read = client.storage.read
+  client.storage.read = lambda name: reads.append(name) or read(name)
+  builder.build(conv)
+  builder._builder.submit(lambda: None).result()
+  assert other not in builder._indexes
+  for _ in range(2):
+    assert "Other (user): My bike lock code is 1234" in builder.build(conv)[0]["content"]
+  assert not other.loaded and not empty.loaded
+  assert reads.count("Empty") == 1 and reads.count("Other") == 3
+  # the next session reads the vectors from their files, within the memory budget
+  client.memory_budget = 0
+  reads.clear()
+  fresh = context.ContextBuilder(client, mode=context.MODE_RETRIEVAL_ALL)
+  fresh.recent, fresh.top_k = 2, 1
+  assert "Other (user): My bike lock code is 1234" in fresh.build(conv)[0]["content"]
+  assert reads == ["Other"] and len(fresh._stored) == 1
+  vector = retrieval.embed("garage door code")
+  assert abs(sum(value * value for value in vector.values()) - 1) < 1e-6 and retrieval.embed("") == {}
+
+
+def test_cancel_and_deadline_keep_the_partial_answer(home):
+  import client as oaic
+  import worker
+  from cancel import CancelToken, CANCELLED, DEADLINE
+  reply = " ".join(f"word{i}" for i in range(200))
+  with StubServer(token_rate=50, reply=lambda _: reply) as server:
+    client = oaic.Client(api_key="stub", base_url=server.base_url)
+    client.max_yx = lambda: (20, 80)
+    token = CancelToken()
+    key = client.send("Stopped", "Hi", lambda conv: len(conv.messages[-1]["content"]) > 20 and token.cancel(), token)
+    answer = client.conversations[key].messages[-1]
+    assert answer["truncated"] == CANCELLED and 20 < len(answer["content"]) < len(reply)
+    client.set_deadline(key, 0.3)
+    client.send(key, "Again")
+    answer = client.conversations[key].messages[-1]
+    assert answer["truncated"] == DEADLINE and reply.startswith(answer["content"])
+    assert "[deadline exceeded]" in "".join(client.conversations[key].values(0))
+    pool = worker.RequestPool(client)
+    client.set_deadline(key, None)
+    pool.submit(key, "Once more")
+    assert pool.events.get(timeout=10).kind == worker.RequestEvent.DELTA
+    assert pool.cancel(key)
+    pool.executor.shutdown(wait=True)
+    assert client.conversations[key].messages[-1]["truncated"] == CANCELLED
+    client.close()
+
+
+def test_deleting_a_chat_stops_its_request_and_keeps_it_deleted(home, monkeypatch):
+  import client as oaic
+  import worker
+  from cancel import CANCELLED
+  monkeypatch.setattr(oaic, "PARTIAL_SAVE_INTERVAL", 0)
+  reply = " ".join(f"word{i}" for i in range(200))
+  with StubServer(token_rate=50, reply=lambda _: reply) as server:
+    client = oaic.Client(api_key="stub", base_url=server.base_url)
+    client.max_yx = lambda: (20, 80)
+    pool = worker.RequestPool(client)
+    key = pool.submit(None, "Tell me a long story")
+    pool.submit(key, "And another one")
+    assert pool.events.get(timeout=10).kind == worker.RequestEvent.DELTA
+    client.saver.flush()
+    assert key in client.storage.entries()
+    conv = client.conversations[key]
+    client.delete(key)
+    pool.executor.shutdown(wait=True)
+    client.close()
+  assert conv.messages[-1]["truncated"] == CANCELLED
+  assert len([message for message in conv.messages if message["role"] == "user"]) == 1
+  reopened = oaic.Client(api_key="stub", base_url=server.base_url)
+  assert reopened.conversations == {} and reopened.storage.entries() == {}
+
+
+def test_daemon_serves_frontends_over_a_unix_socket(client, server):
+  import threading
+  import time
+  import daemon
+  import remote
+  import worker
+  service = daemon.Daemon(client)
+  service.listen()
+  threading.Thread(target=service.serve_forever, daemon=True).start()
+  first, second = remote.RemoteClient(remote.connect()), remote.RemoteClient(remote.connect())
+
+  backlog:dict[int, list[worker.RequestEvent]] = {id(first): [], id(second): []}
+
+  def wait(frontend:remote.RemoteClient, kind:str) -> worker.RequestEvent:
+    deadline = time.monotonic() + 10
+    events = backlog[id(frontend)]
+    while time.monotonic() < deadline:
+      events.extend(frontend.requests.drain())
+      for event in events:
+        if event.kind == kind:
+          events.remove(event)
+          return event
+      time.sleep(0.01)
+    raise TimeoutError(kind)
+
+  key = first.requests.submit(None, "Hi")
+  # the prompt may not be added yet, the pushed messages bring it
+  conv = second.add(key, first.ids[key])
+  wait(second, worker.RequestEvent.DONE)
+  assert [message["content"] for message in conv.messages] == ["Hi", "Hello there, how are you?"]
+  assert not second.requests.is_in_flight(conv.name) and second.telemetry.last is not None
+  renamed = wait(second, worker.RequestEvent.RENAMED)
+  assert conv.name == renamed.new_key == client.recency.first()
+  # the first frontend follows the name the conversation got in the daemon
+  assert wait(first, worker.RequestEvent.RENAMED).new_key == renamed.new_key
+  assert first.rename(renamed.new_key, "Shared") == "Shared" and "Shared" in client.conversations
+  wait(second, worker.RequestEvent.RENAMED)
+  assert [result.conv_key for result in second.search("hello")] == ["Shared"]
+  backlog[id(first)].clear()
+  second.delete("Shared")
+  assert wait(first, worker.RequestEvent.DONE).conv_key == "Shared"
+  assert "Shared" not in first.conversations and len(client.conversations) == 0
+  service.close()
+  assert not remote.available()
+  with pytest.raises(remote.RemoteError):
+    first.call("hello")